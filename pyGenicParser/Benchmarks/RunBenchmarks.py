@@ -0,0 +1,333 @@
+"""
+Benchmarks of the bgen, plink and vcf hot paths on synthetic data, reporting throughput and peak memory as json so that
+results can be compared across commits, alongside the time to import the package. Run from the directory above the
+package with
+
+    python -m pyGenicParser.Benchmarks.RunBenchmarks --samples 1000 --variants 5000 --output results.json
+"""
+from .SyntheticData import write_bgen, write_plink, write_vcf
+from .. import BgenObject, PlinkObject, VCFObject, GenotypeServer, GenotypeClient, ParserStats
+from ..bgenCodecs import available_backends
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from pathlib import Path
+import numpy as np
+import subprocess
+import tracemalloc
+import argparse
+import platform
+import json
+import sys
+import io
+
+COMPRESSION_NAMES = {0: "none", 1: "zlib", 2: "zstd"}
+
+# The statements timed by benchmark_import, and the heavy dependencies checked for after each
+IMPORT_STATEMENTS = {
+    "import_variant": "from pyGenicParser import Variant",
+    "import_bgen": "from pyGenicParser import BgenObject",
+    "import_plink": "from pyGenicParser import PlinkObject",
+    "import_vcf": "from pyGenicParser import VCFObject"
+}
+HEAVY_MODULES = ["numpy", "sqlite3", "zstd", "miscSupports"]
+
+
+def measure(function, setup=None, repeats=3):
+    """
+    Time a function as the best of repeats, then run it once more under tracemalloc for its peak memory, as tracing
+    slows down the code being timed
+
+    :param function: The function to benchmark
+    :type function: Callable
+
+    :param setup: A function to call before each run that is not timed, such as removing a file the function writes
+    :type setup: Callable | None
+
+    :param repeats: The number of timed runs
+    :type repeats: int
+
+    :return: The best time in seconds and the peak memory in bytes
+    :rtype: (float, int)
+    """
+    timings = []
+    for _ in range(repeats):
+        if setup:
+            setup()
+        start = perf_counter()
+        with redirect_stdout(io.StringIO()):
+            function()
+        timings.append(perf_counter() - start)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        with redirect_stdout(io.StringIO()):
+            function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return min(timings), peak
+
+
+def result_row(benchmark, file_format, seconds, peak, samples, variants, **settings):
+    """Construct a result with the throughput of the benchmark"""
+    return {"benchmark": benchmark, "format": file_format, **settings, "samples": samples, "variants": variants,
+            "seconds": seconds, "variants_per_second": variants / seconds if seconds else None,
+            "genotypes_per_second": samples * variants / seconds if seconds else None, "peak_memory_bytes": peak}
+
+
+def _remove(path):
+    """Setup function to remove a file written by a benchmark"""
+    def remove():
+        if Path(path).exists():
+            Path(path).unlink()
+    return remove
+
+
+def benchmark_bgen(directory, samples, variants, b, compression, repeats, lookup):
+    """Benchmark index creation and extraction of a bgen of a given bit depth and compression"""
+    bgen_path = Path(directory, f"bench_{b}_{compression}.bgen")
+    write_bgen(bgen_path, samples, variants, b, compression)
+    settings = {"bit_depth": b, "compression": COMPRESSION_NAMES[compression]}
+
+    bgi_path = Path(f"{bgen_path}.bgi")
+    results = [result_row("create_bgi", "bgen", *measure(
+        lambda: BgenObject(bgen_path, bgi_present=False).create_bgi(), _remove(bgi_path), repeats),
+        samples, variants, **settings)]
+
+    # The final traced run of measure leaves the .bgi in place for the benchmarks that need it
+    bgen = BgenObject(bgen_path)
+    benchmarks = {
+        "dosage_array": (bgen.dosage_array, variants),
+        "dosage_from_sid": (lambda: bgen.dosage_from_sid(lookup), len(lookup)),
+        "dosage_chunks": (lambda: [chunk for chunk in bgen.dosage_chunks()], variants),
+        "info_array": (bgen.info_array, variants),
+        "sid_to_index": (lambda: bgen.sid_to_index(lookup), len(lookup))
+    }
+    for name, (function, count) in benchmarks.items():
+        results.append(result_row(name, "bgen", *measure(function, repeats=repeats), samples, count, **settings))
+
+    # Opening and querying the variants through the sidecar rather than the .bgi
+    bgen.create_sidecar()
+    sidecar_benchmarks = {
+        "info_array_sidecar": (lambda: BgenObject(bgen_path, sidecar=True).info_array(), variants),
+        "info_from_sid_sidecar": (lambda: BgenObject(bgen_path, sidecar=True).info_from_sid(lookup), len(lookup))
+    }
+    for name, (function, count) in sidecar_benchmarks.items():
+        results.append(result_row(name, "bgen", *measure(function, repeats=repeats), samples, count, **settings))
+    return results
+
+
+def benchmark_plink(directory, samples, variants, repeats):
+    """Benchmark index creation and extraction of plink files"""
+    plink_root = Path(directory, "bench")
+    write_plink(plink_root, samples, variants)
+    bgi_path = Path(f"{plink_root}.bim.bgi")
+
+    def create_bim_bgi():
+        PlinkObject(plink_root).create_bim_bgi()
+
+    def dosage_chunks():
+        plink = PlinkObject(plink_root)
+        [chunk for chunk in plink.dosage_chunks()]
+        plink.close_all()
+
+    results = [result_row("create_bim_bgi", "plink", *measure(create_bim_bgi, _remove(bgi_path), repeats), samples,
+                          variants),
+               result_row("dosage_chunks", "plink", *measure(dosage_chunks, repeats=repeats), samples, variants)]
+
+    plink = PlinkObject(plink_root, True)
+    results.append(result_row("info_array", "plink", *measure(plink.info_array, repeats=repeats), samples, variants))
+    plink.close_all()
+    return results
+
+
+def benchmark_vcf(directory, samples, variants, repeats):
+    """Benchmark converting plain and gzipped vcf files to summary statistics"""
+    results = []
+    for suffix in [".vcf", ".vcf.gz"]:
+        vcf_path = Path(directory, f"bench{suffix}")
+        write_vcf(vcf_path, samples, variants)
+
+        def convert():
+            VCFObject(vcf_path).covert_to_summary(directory, "bench_summary")
+
+        results.append(result_row("covert_to_summary", "vcf", *measure(convert, repeats=repeats), samples, variants,
+                                  zipped=suffix == ".vcf.gz"))
+    return results
+
+
+def benchmark_server(directory, samples, variants, repeats, lookup, clients=8, requests=20):
+    """
+    Load test the genotype server with many concurrent clients each making a series of requests, against each request
+    being a short job that opens the bgen and its .bgi itself
+    """
+    bgen_path = Path(directory, "bench_server.bgen")
+    write_bgen(bgen_path, samples, variants, 16, 1)
+    BgenObject(bgen_path, bgi_present=False).create_bgi()
+
+    # Requests are consecutive slices of the lookup, which repeat once the lookup is exhausted
+    queries = [lookup[i % len(lookup):i % len(lookup) + 10] for i in range(clients * requests)]
+
+    def open_per_job(query):
+        return BgenObject(bgen_path).dosage_from_sid(query)
+
+    socket_path = Path(directory, "bench.sock")
+    server = GenotypeServer(socket_path, {"bench": BgenObject(bgen_path)}).start_background()
+
+    def client_requests(client):
+        with GenotypeClient(socket_path) as genotype_client:
+            return [genotype_client.dosage("bench", rsids=query) for query in queries[client::clients]]
+
+    try:
+        results = []
+        for name, function, items in [("query_open_per_job", open_per_job, queries),
+                                       ("query_server", client_requests, range(clients))]:
+            def load_test():
+                with ThreadPoolExecutor(clients) as executor:
+                    list(executor.map(function, items))
+
+            seconds, peak = measure(load_test, repeats=repeats)
+            row = result_row(name, "bgen", seconds, peak, samples, sum([len(query) for query in queries]),
+                             clients=clients, requests=len(queries))
+            row["requests_per_second"] = len(queries) / seconds if seconds else None
+            results.append(row)
+        results[-1]["coalesced"] = server.stats.counters["coalesced"]
+    finally:
+        server.stop_background()
+    return results
+
+
+def benchmark_codecs(directory, samples, variants, repeats):
+    """
+    Benchmark extracting the dosage of zlib and zstd bgen files through each installed decompression backend, with the
+    seconds spent decompressing the blocks recorded separately from the rest of the extraction
+    """
+    results = []
+    for compression in (1, 2):
+        bgen_path = Path(directory, f"bench_codec_{compression}.bgen")
+        write_bgen(bgen_path, samples, variants, 16, compression)
+        BgenObject(bgen_path, bgi_present=False).create_bgi()
+
+        for backend in available_backends(compression):
+            bgen = BgenObject(bgen_path, codec=backend)
+            row = result_row("dosage_array_codec", "bgen", *measure(bgen.dosage_array, repeats=repeats), samples,
+                             variants, compression=COMPRESSION_NAMES[compression], codec=backend)
+
+            stats = ParserStats()
+            BgenObject(bgen_path, codec=backend, stats=stats).dosage_array()
+            row["decompress_seconds"] = stats.timers["decompress"]
+            row["bytes_decompressed"] = stats.counters["bytes_decompressed"]
+            results.append(row)
+    return results
+
+
+def benchmark_import(repeats):
+    """
+    Benchmark the time to import from the package within a fresh interpreter, as paid by every short lived job, along
+    with which heavy dependencies each import loaded
+    """
+    script = "import sys, time, json\n" \
+             "start = time.perf_counter()\n" \
+             "{statement}\n" \
+             "print(json.dumps([time.perf_counter() - start, [m for m in {heavy} if m in sys.modules]]))"
+
+    results = []
+    for name, statement in IMPORT_STATEMENTS.items():
+        timings, loaded = [], []
+        for _ in range(repeats):
+            output = subprocess.run([sys.executable, "-c", script.format(statement=statement, heavy=HEAVY_MODULES)],
+                                    cwd=Path(__file__).parents[2], capture_output=True, text=True, check=True).stdout
+            seconds, loaded = json.loads(output)
+            timings.append(seconds)
+
+        results.append({"benchmark": name, "format": "import", "statement": statement, "seconds": min(timings),
+                        "modules_loaded": loaded})
+    return results
+
+
+def run_benchmarks(samples, variants, bit_depths=(8, 10, 16, 32), compressions=(0, 1, 2), repeats=3, lookups=100,
+                   formats=("bgen", "codecs", "plink", "vcf", "server", "import")):
+    """
+    Run all the benchmarks on freshly written synthetic data within a temporary directory
+
+    :param samples: The number of samples in each synthetic file
+    :type samples: int
+
+    :param variants: The number of variants in each synthetic file
+    :type variants: int
+
+    :param bit_depths: The bgen bit depths to benchmark
+    :type bit_depths: tuple[int]
+
+    :param compressions: The bgen compressions to benchmark, 0 for none, 1 for zlib, 2 for zstd
+    :type compressions: tuple[int]
+
+    :param repeats: The number of timed runs of each benchmark
+    :type repeats: int
+
+    :param lookups: The number of random rsids to extract in the benchmarks by snp name
+    :type lookups: int
+
+    :param formats: The file formats to benchmark, codecs for the decompression backends, server for the load test of
+        the genotype server, and import for the time to import the package
+    :type formats: tuple[str]
+
+    :return: The environment the benchmarks ran in, and a result for each benchmark
+    :rtype: dict
+    """
+    lookup = [f"rs{i}" for i in np.random.default_rng(0).choice(variants, min(lookups, variants), replace=False)]
+
+    results = []
+    with TemporaryDirectory() as directory:
+        if "bgen" in formats:
+            for compression in compressions:
+                for b in bit_depths:
+                    results += benchmark_bgen(directory, samples, variants, b, compression, repeats, lookup)
+        if "codecs" in formats:
+            results += benchmark_codecs(directory, samples, variants, repeats)
+        if "plink" in formats:
+            results += benchmark_plink(directory, samples, variants, repeats)
+        if "vcf" in formats:
+            results += benchmark_vcf(directory, samples, variants, repeats)
+        if "server" in formats:
+            results += benchmark_server(directory, samples, variants, repeats, lookup)
+    if "import" in formats:
+        results += benchmark_import(repeats)
+
+    return {"commit": _current_commit(), "python": platform.python_version(), "numpy": np.__version__,
+            "platform": platform.platform(), "results": results}
+
+
+def _current_commit():
+    """The git commit of the package, if it is within a git repository"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pyGenicParser on synthetic data")
+    parser.add_argument("--samples", type=int, default=1000)
+    parser.add_argument("--variants", type=int, default=2000)
+    parser.add_argument("--bit-depths", type=int, nargs="+", default=[8, 10, 16, 32])
+    parser.add_argument("--compressions", type=int, nargs="+", default=[0, 1, 2])
+    parser.add_argument("--formats", nargs="+", default=["bgen", "codecs", "plink", "vcf", "server", "import"])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", default=None, help="Path to write the json results, otherwise printed")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.samples, args.variants, tuple(args.bit_depths), tuple(args.compressions),
+                            args.repeats, formats=tuple(args.formats))
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(report, out, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
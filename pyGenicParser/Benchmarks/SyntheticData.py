@@ -0,0 +1,180 @@
+from .. import kernels as kn
+
+from pathlib import Path
+import numpy as np
+import struct
+import gzip
+import zlib
+
+
+def synthetic_genotypes(sample_number, variant_index, b, seed=0):
+    """
+    Generate the layout 2 integer probabilities of P(AA) and P(AB) for one unphased bi-allelic diploid variant. Each
+    variant has its own allele frequency and most samples are called with high certainty, as with imputed data. This
+    is deterministic on the variant_index and seed so that the written values can be regenerated for validation.
+
+    :param sample_number: The number of samples
+    :type sample_number: int
+
+    :param variant_index: The index of the variant within the file
+    :type variant_index: int
+
+    :param b: The number of bits used to store each probability
+    :type b: int
+
+    :param seed: The seed of the file
+    :type seed: int
+
+    :return: An integer array of (samples, 2)
+    :rtype: np.ndarray
+    """
+    rng = np.random.default_rng([seed, variant_index])
+    scale = kn.probability_scale(b)
+
+    # Draw hard genotypes under Hardy-Weinberg, then spread some of the probability to the other genotypes
+    frequency = rng.uniform(0.01, 0.5)
+    genotype = rng.binomial(2, frequency, sample_number)
+    certainty = np.where(rng.random(sample_number) < 0.9, rng.uniform(0.9, 1, sample_number),
+                         rng.uniform(0.34, 0.9, sample_number))
+
+    probs = np.column_stack([(1 - certainty) / 2] * 3)
+    probs[np.arange(sample_number), genotype] = certainty
+
+    first = np.round(probs[:, 0] * scale).astype(np.int64)
+    second = np.minimum(np.round(probs[:, 1] * scale).astype(np.int64), scale - first)
+    return np.column_stack([first, second]).astype(np.uint32)
+
+
+def write_bgen(file_path, sample_number, variant_number, b=16, compression=1, seed=0):
+    """
+    Write a synthetic layout 2 bgen file of unphased bi-allelic diploid variants on chromosome 1, with rsids of
+    rs{index}, and no sample identifiers
+
+    Spec at https://www.well.ox.ac.uk/~gav/bgen_format/spec/latest.html
+
+    :param file_path: The path to write the bgen to
+    :type file_path: Path | str
+
+    :param sample_number: The number of samples
+    :type sample_number: int
+
+    :param variant_number: The number of variants
+    :type variant_number: int
+
+    :param b: The number of bits used to store each probability, from 1 to 32
+    :type b: int
+
+    :param compression: 0 for uncompressed, 1 for zlib, 2 for zstd
+    :type compression: int
+
+    :param seed: The seed passed to synthetic_genotypes
+    :type seed: int
+
+    :return: Nothing, writes the file then stops
+    :rtype: None
+    """
+    if compression == 2:
+        import zstd
+        compress = zstd.compress
+    elif compression == 1:
+        compress = zlib.compress
+    else:
+        compress = None
+
+    with open(file_path, "wb") as bgen:
+        # Offset, then the header block of its length, variant and sample numbers, magic, and flags of layout 2
+        bgen.write(struct.pack("<IIII4sI", 20, 20, variant_number, sample_number, b"bgen", compression | (2 << 2)))
+
+        ploidy = struct.pack("<IHBB", sample_number, 2, 2, 2) + bytes([2]) * sample_number + struct.pack("<BB", 0, b)
+        for index in range(variant_number):
+            rsid = f"rs{index}".encode()
+            bgen.write(struct.pack("<H", len(rsid)) + rsid + struct.pack("<H", len(rsid)) + rsid)
+            bgen.write(struct.pack("<H", 1) + b"1" + struct.pack("<IH", 1000 + index * 10, 2))
+            bgen.write(struct.pack("<I", 1) + b"A" + struct.pack("<I", 1) + b"G")
+
+            data = ploidy + kn.pack_probabilities(synthetic_genotypes(sample_number, index, b, seed).ravel(), b)
+            if compress:
+                compressed = compress(data)
+                bgen.write(struct.pack("<II", len(compressed) + 4, len(data)) + compressed)
+            else:
+                bgen.write(struct.pack("<I", len(data)) + data)
+
+
+def write_plink(file_root, sample_number, variant_number, seed=0):
+    """
+    Write a synthetic hard called .bed, .bim and .fam with the same variants as write_bgen
+
+    :param file_root: The path to write the files to, without a suffix
+    :type file_root: Path | str
+
+    :param sample_number: The number of samples
+    :type sample_number: int
+
+    :param variant_number: The number of variants
+    :type variant_number: int
+
+    :param seed: The seed passed to synthetic_genotypes
+    :type seed: int
+
+    :return: Nothing, writes the files then stops
+    :rtype: None
+    """
+    # The .bed codes of each count of a2, being 00, 10, 11 for 0, 1 and 2
+    codes = np.array([0, 2, 3], dtype=np.uint8)
+    padding = (-sample_number) % 4
+
+    with open(f"{file_root}.bed", "wb") as bed, open(f"{file_root}.bim", "w") as bim:
+        bed.write(b"\x6c\x1b\x01")
+        for index in range(variant_number):
+            probs = synthetic_genotypes(sample_number, index, 8, seed)
+            last = kn.probability_scale(8) - probs.sum(axis=1, dtype=np.int64)
+            genotype = np.column_stack([probs, last]).argmax(axis=1)
+
+            packed = np.concatenate([codes[genotype], np.zeros(padding, dtype=np.uint8)]).reshape(-1, 4)
+            bed.write((packed << np.arange(0, 8, 2, dtype=np.uint8)).sum(axis=1, dtype=np.uint8).tobytes())
+            bim.write(f"1\trs{index}\t0\t{1000 + index * 10}\tA\tG\n")
+
+    with open(f"{file_root}.fam", "w") as fam:
+        fam.writelines([f"FAM{i}\tIID{i}\t0\t0\t{1 + i % 2}\t-9\n" for i in range(sample_number)])
+
+
+def write_vcf(file_path, sample_number, variant_number, seed=0):
+    """
+    Write a synthetic vcf, gzipped if the file_path ends in .gz, with an INFO column of allele frequency and INFO score
+    and FORMAT columns of genotype and dosage for each sample
+
+    :param file_path: The path to write the vcf to
+    :type file_path: Path | str
+
+    :param sample_number: The number of samples
+    :type sample_number: int
+
+    :param variant_number: The number of variants
+    :type variant_number: int
+
+    :param seed: The seed passed to synthetic_genotypes
+    :type seed: int
+
+    :return: Nothing, writes the file then stops
+    :rtype: None
+    """
+    headers = ["##fileformat=VCFv4.2",
+               "##INFO=<ID=AF,Number=1,Type=Float,Description=\"Allele frequency\">",
+               "##INFO=<ID=INFO,Number=1,Type=Float,Description=\"Imputation INFO score\">",
+               "##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">",
+               "##FORMAT=<ID=DS,Number=1,Type=Float,Description=\"Dosage\">",
+               "\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"] +
+                         [f"IID{i}" for i in range(sample_number)])]
+    calls = np.array(["0/0", "0/1", "1/1"])
+
+    opener = gzip.open if Path(file_path).suffix == ".gz" else open
+    with opener(file_path, "wt") as vcf:
+        vcf.write("\n".join(headers) + "\n")
+        for index in range(variant_number):
+            probs = synthetic_genotypes(sample_number, index, 8, seed) / kn.probability_scale(8)
+            dosage = 2 - 2 * probs[:, 0] - probs[:, 1]
+            genotype = np.column_stack([probs, 1 - probs.sum(axis=1)]).argmax(axis=1)
+
+            samples = [f"{call}:{value:.3f}" for call, value in zip(calls[genotype], dosage)]
+            vcf.write("\t".join(["1", str(1000 + index * 10), f"rs{index}", "A", "G", ".", "PASS",
+                                 f"AF={dosage.mean() / 2:.4f};INFO=1", "GT:DS"] + samples) + "\n")
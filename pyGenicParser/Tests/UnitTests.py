@@ -1,7 +1,15 @@
 from .. import *
+from .. import kernels as kn
+from ..bgenCodecs import BlockCodec, available_backends, get_codec
+from ..Benchmarks.SyntheticData import synthetic_genotypes, write_bgen
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import numpy as np
+import subprocess
 import unittest
+import struct
+import sys
 
 
 class MyTestCase(unittest.TestCase):
@@ -21,6 +29,32 @@ class MyTestCase(unittest.TestCase):
         """Call the bgen file"""
         return BgenObject(Path(Path(__file__).parent, "Data", "EUR.ldpred_21.bgen"))
 
+    @staticmethod
+    def _general_bgen(write_path):
+        """
+        Write an uncompressed 8 bit layout 2 bgen of four samples holding a variable ploidy block of ploidy 2, 1, 2, 2,
+        a phased block whose fourth sample is missing, and an unphased tri-allelic block, which BgenWriter cannot write
+        """
+        def string(value, length_format="<H"):
+            return struct.pack(length_format, len(value)) + value.encode()
+
+        def block(rsid, alleles, ploidy, phased, values, missing=()):
+            ploidy_bytes = bytes([p | (128 if i in missing else 0) for i, p in enumerate(ploidy)])
+            data = struct.pack("<IHBB", 4, len(alleles), min(ploidy), max(ploidy)) + ploidy_bytes + \
+                bytes([phased, 8]) + bytes(values)
+            return string(rsid) + string(rsid) + string("21") + struct.pack("<IH", 100 + len(rsid), len(alleles)) + \
+                b"".join([string(allele, "<I") for allele in alleles]) + struct.pack("<I", len(data)) + data
+
+        blocks = [block("rsU", ["A", "G"], [2, 1, 2, 2], 0, [255, 0, 0, 0, 255, 0, 0]),
+                  block("rsP", ["C", "T"], [2, 2, 2, 2], 1, [255, 0, 0, 0, 255, 255, 0, 0], missing=[3]),
+                  block("rsM", ["A", "C", "G"], [2, 2, 2, 2], 0, [0, 0, 0, 255, 0] + [0] * 5 + [255, 0, 0, 0, 0] +
+                        [0, 0, 255, 0, 0])]
+
+        # The flag sets no compression and layout 2, without sample identifiers
+        with open(write_path, "wb") as bgen:
+            bgen.write(struct.pack("<IIII4sI", 20, 20, len(blocks), 4, b"bgen", 2 << 2) + b"".join(blocks))
+        return write_path
+
     def test_bgen_bgi_write(self):
         """Test writing bgen.bgi"""
         write_path = Path(Path(__file__).parent, "Data", "Write")
@@ -124,6 +158,721 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(len(bgen.dosage_from_sid(sid_array)), 3)
         self.assertEqual(len(bgen.variant_from_sid(sid_array)), 3)
 
+    def test_iid_subset(self):
+        """Check decoding a subset of samples gives the same values as decoding all samples and then indexing"""
+        bgen = self._loader()
+        iid_index = [400, 3, 17, 17, 250]
+        full = bgen.dosage_array()
+
+        subset = bgen[iid_index, :]
+        self.assertEqual(subset.dosage_array().shape, (bgen.sid_count, 5))
+        self.assertTrue(np.array_equal(subset.dosage_array(), full[:, iid_index], equal_nan=True))
+        self.assertTrue(np.array_equal(subset.dosage_from_sid(['rs2801301']), full[1:2, iid_index], equal_nan=True))
+        self.assertEqual(subset.variant_array()[0][1].shape, (5, ))
+
+        # Unpacking selected probabilities of a bit depth that is not a whole byte must match unpacking them all
+        payload = np.random.default_rng(2).integers(0, 256, 125, dtype=np.uint8).tobytes()
+        indexes = np.array([99, 0, 5, 5, 42])
+        self.assertTrue(np.array_equal(kn.unpack_probabilities(payload, 10, 100, indexes),
+                                       kn.unpack_probabilities(payload, 10, 100)[indexes]))
+
+    def test_iter_variants(self):
+        """Check the prefetching iterators return every variant in order, and that bgen and plink agree"""
+        bgen = self._loader()
+        batches = list(bgen.iter_variants(batch_size=1000, prefetch=2))
+        self.assertEqual(len(batches), 8)
+        self.assertEqual(batches[0][0][0].snp_id, 'rs55776382')
+        self.assertTrue(np.array_equal(np.vstack([dosage for _, dosage in batches]), bgen.dosage_array(),
+                                       equal_nan=True))
+
+        # The plink files are the hard called bgen, with the .bed decoded as a count of a2 in the same way as bgen
+        plink = PlinkObject(Path(Path(__file__).parent, "Data", "EUR.ldpred_21"))
+        hard_calls = BgenObject(bgen.file_path, probability=0, hard_call_return=True)
+        variants, dosage = next(plink.iter_variants(batch_size=50, as_variant=True))
+        self.assertEqual(variants[0].snp_id, 'rs55776382')
+        self.assertTrue(np.array_equal(dosage, hard_calls[:, :50].dosage_array()))
+        plink.close_all()
+
+    def test_dosage_chunks(self):
+        """Check chunks cover the file in order whilst reusing a single buffer sized from the byte budget"""
+        bgen = self._loader()
+        chunks, buffers = [], set()
+        for variants, dosage in bgen.dosage_chunks(byte_budget=bgen.iid_count * 4 * 700):
+            self.assertEqual(len(variants), dosage.shape[1])
+            chunks.append(dosage.copy())
+            buffers.add(id(dosage.base))
+
+        self.assertEqual(len(chunks), 12)
+        self.assertEqual(len(buffers), 1)
+        self.assertTrue(np.array_equal(np.hstack(chunks), bgen.dosage_array().T, equal_nan=True))
+
+        probabilities = BgenObject(bgen.file_path, probability_return=True)[[1, 5, 7], :]
+        _, chunk = next(probabilities.dosage_chunks(chunk_size=2))
+        expected = probabilities.dosage_from_sid(['rs55776382', 'rs2801301'])
+        self.assertTrue(np.array_equal(chunk.transpose(1, 0, 2), expected, equal_nan=True))
+
+        plink = PlinkObject(Path(Path(__file__).parent, "Data", "EUR.ldpred_21"))
+        plink_chunks = np.hstack([dosage.copy() for _, dosage in plink.dosage_chunks(chunk_size=3000)])
+        self.assertTrue(np.array_equal(plink_chunks, np.vstack([dosage for _, dosage in plink.iter_variants()]).T))
+        plink.close_all()
+
+    def test_synthetic_bgen(self):
+        """Check synthetic bgen files of each compression and bit depth decode back to the probabilities written"""
+        write_path = Path(Path(__file__).parent, "Data", "Write", "synthetic.bgen")
+        for b, compression in [(8, 0), (10, 1), (16, 1), (32, 0)]:
+            write_bgen(write_path, 20, 15, b, compression)
+            BgenObject(write_path, bgi_present=False).create_bgi()
+
+            bgen = BgenObject(write_path, probability=0)
+            expected = [kn.dosage_kernel(synthetic_genotypes(20, i, b), b, np.zeros(20, dtype=bool), None,
+                                         np.empty(20, dtype=np.float32)) for i in range(15)]
+            self.assertTrue(np.array_equal(bgen.dosage_array(), np.array(expected)))
+
+            write_path.unlink()
+            Path(f"{write_path}.bgi").unlink()
+
+    def test_codecs(self):
+        """Check every installed decompression backend reads zlib and zstd bgen files the same as the default"""
+        write_path = Path(Path(__file__).parent, "Data", "Write", "codec.bgen")
+        for compression in [1, 2]:
+            payload = bytes(range(256)) * 20
+            for backend in available_backends(compression):
+                codec = get_codec(compression, backend)
+                self.assertEqual(codec.decompress(codec.compress(payload), len(payload)), payload)
+
+            write_bgen(write_path, 20, 15, 16, compression)
+            expected = BgenObject(write_path, bgi_present=False).dosage_array()
+            for backend in available_backends(compression):
+                self.assertTrue(np.array_equal(BgenObject(write_path, bgi_present=False, codec=backend).dosage_array(),
+                                               expected, equal_nan=True))
+            write_path.unlink()
+
+        with self.assertRaises(AssertionError):
+            get_codec(1, "zstd")
+
+        # A backend that does not implement both methods cannot be constructed
+        class Incomplete(BlockCodec):
+            def decompress(self, data, size=None):
+                return data
+
+        with self.assertRaises(TypeError):
+            Incomplete("incomplete")
+
+    def test_sparse_dosage(self):
+        """Check sparse dosage and hard calls from bgen and plink match the dense arrays, with missing kept as NaN"""
+        bgen = self._loader()[np.arange(0, 483, 2), :]
+        dense = bgen.dosage_array()
+        sparse = bgen.dosage_array(sparse=True)
+        self.assertEqual(sparse.shape, dense.T.shape)
+        self.assertTrue(np.array_equal(sparse.toarray(), dense.T, equal_nan=True))
+        self.assertEqual(sparse.missing_count, int(np.isnan(dense).sum()))
+        self.assertTrue(np.array_equal(sparse.select([4, 1]).toarray(), dense[[4, 1]].T, equal_nan=True))
+
+        hard_calls = bgen.as_hard_calls()
+        self.assertTrue(np.array_equal(hard_calls.dosage_array(sparse=True).toarray(), hard_calls.dosage_array().T,
+                                       equal_nan=True))
+        chunks = SparseDosage.concatenate([dosage for _, dosage in bgen.iter_variants(1000, sparse=True)])
+        self.assertTrue(np.array_equal(chunks.toarray(), dense.T, equal_nan=True))
+
+        plink = PlinkObject(Path(Path(__file__).parent, "Data", "EUR.ldpred_21"))
+        plink_dense = np.vstack([dosage for _, dosage in plink.iter_variants()])
+        plink_sparse = SparseDosage.concatenate([dosage for _, dosage in plink.dosage_chunks(1000, sparse=True)])
+        self.assertTrue(np.array_equal(plink_sparse.toarray(), plink_dense.T, equal_nan=True))
+        self.assertEqual(plink_sparse.nnz, int(np.count_nonzero(np.nan_to_num(plink_dense))))
+        plink.close_all()
+
+    def test_quantised_dosage(self):
+        """Check uint8 and float16 dosage are within their precision of float32 dosage, with missing kept"""
+        write_path = Path(Path(__file__).parent, "Data", "Write", "quantised.bgen")
+        for b in [8, 10, 16]:
+            write_bgen(write_path, 30, 20, b, 1)
+            bgen = BgenObject(write_path, bgi_present=False)
+            dosage = bgen.dosage_array()
+            quantised = bgen.dosage_array(dtype=np.uint8)
+
+            self.assertEqual(quantised.dtype, np.uint8)
+            self.assertTrue(np.array_equal(quantised, kn.quantise_dosage(dosage, np.empty_like(quantised))))
+            self.assertTrue(np.array_equal(np.isnan(kn.dequantise_dosage(quantised)), np.isnan(dosage)))
+            self.assertLessEqual(np.nanmax(np.abs(kn.dequantise_dosage(quantised) - dosage)), 0.5 / kn.QUANTISED_SCALE)
+            self.assertLessEqual(np.nanmax(np.abs(bgen.dosage_array(dtype=np.float16) - dosage)), 1e-3)
+            write_path.unlink()
+
+        plink = PlinkObject(Path(Path(__file__).parent, "Data", "EUR.ldpred_21"))
+        plink_dosage = np.vstack([dosage for _, dosage in plink.iter_variants()])
+        plink_quantised = np.hstack([dosage.copy() for _, dosage in plink.dosage_chunks(1000, dtype=np.uint8)])
+        self.assertTrue(np.array_equal(kn.dequantise_dosage(plink_quantised), plink_dosage.T, equal_nan=True))
+        plink.close_all()
+
+        with self.assertRaises(AssertionError):
+            self._loader().as_probabilities().dosage_array(dtype=np.uint8)
+
+    def test_grm_builder(self):
+        """Check the streamed relationship matrix against a direct computation, when tiled and when resumed"""
+        plink = PlinkObject(Path(Path(__file__).parent, "Data", "EUR.ldpred_21"))
+        dosage = np.vstack([dosage for _, dosage in plink.iter_variants()]).astype(np.float64)
+
+        present = ~np.isnan(dosage)
+        frequency = np.nansum(dosage, axis=1) / present.sum(axis=1) / 2
+        deviation = np.sqrt(2 * frequency * (1 - frequency))
+        kept = deviation > 0
+        standardised = np.where(present[kept], (dosage[kept] - 2 * frequency[kept, None]) / deviation[kept, None], 0)
+        expected = standardised.T @ standardised / kept.sum()
+
+        builder = GRMBuilder(plink, batch_size=500)
+        grm = builder.build()
+        self.assertEqual(builder.variant_count, kept.sum())
+        self.assertTrue(np.allclose(grm, expected, atol=1e-5))
+        self.assertTrue(np.allclose(GRMBuilder.assemble([(tile, builder.build(tile)) for tile in builder.tiles(3)]),
+                                    grm, atol=1e-6))
+
+        # A bgen returning probabilities is still built from its dosage
+        probabilities = BgenObject(self._loader().file_path, probability_return=True)[:, :300]
+        self.assertTrue(np.allclose(GRMBuilder(probabilities, batch_size=100).build(),
+                                    GRMBuilder(self._loader()[:, :300], batch_size=100).build(), atol=1e-6))
+
+        # A build stopped after two batches resumes from its checkpoint
+        checkpoint = Path(Path(__file__).parent, "Data", "Write", "grm.npz")
+        batches = plink._dosage_batches
+        plink._dosage_batches = lambda *args: (batch for _, batch in zip(range(2), batches(*args)))
+        GRMBuilder(plink, batch_size=500, checkpoint=checkpoint, checkpoint_every=1).build()
+        del plink._dosage_batches
+        self.assertTrue(np.allclose(GRMBuilder(plink, batch_size=500, checkpoint=checkpoint).build(), grm, atol=1e-6))
+
+        # A checkpoint is not resumed by a build of other samples of the same number, or of another file
+        with self.assertRaises(AssertionError):
+            GRMBuilder(plink, batch_size=500, samples=np.arange(483)[::-1], checkpoint=checkpoint).build()
+        with self.assertRaises(AssertionError):
+            GRMBuilder(self._loader(), batch_size=500, checkpoint=checkpoint).build()
+        checkpoint.unlink()
+        plink.close_all()
+
+    def test_sample_major_store(self):
+        """Check individuals read from a transposed store match the columns of the variant major dosage"""
+        write_path = Path(Path(__file__).parent, "Data", "Write", "transposed.smg")
+        plink = PlinkObject(Path(Path(__file__).parent, "Data", "EUR.ldpred_21"))
+        dosage = np.vstack([dosage for _, dosage in plink.iter_variants()])
+
+        for compression in [0, 1]:
+            # A small budget forces many batches through the external transpose
+            plink.to_sample_major(write_path, chunk_samples=7, compression=compression, memory_budget=2 ** 20)
+            with SampleMajorStore(write_path) as store:
+                self.assertEqual(store.shape, dosage.T.shape)
+                self.assertTrue(np.array_equal(store.sample(100), dosage[:, 100], equal_nan=True))
+                self.assertTrue(np.array_equal(store.samples([482, 0, 13]), dosage[:, [482, 0, 13]].T, equal_nan=True))
+                if compression == 0:
+                    self.assertTrue(np.array_equal(kn.dequantise_dosage(np.asarray(store.as_memmap())), dosage.T,
+                                                   equal_nan=True))
+            write_path.unlink()
+        plink.close_all()
+
+        # Objects returning probabilities are still transposed as dosage
+        bgen = BgenObject(Path(Path(__file__).parent, "Data", "EUR.ldpred_21.bgen"), probability_return=True)
+        bgen = bgen[[3, 9, 100], 10:500]
+        bgen.to_sample_major(write_path, memory_budget=10000)
+        with SampleMajorStore(write_path) as store:
+            self.assertTrue(np.array_equal(store.samples([2, 0], np.uint8),
+                                           bgen._view(None, None).dosage_array(dtype=np.uint8)[:, [2, 0]].T))
+        write_path.unlink()
+
+    def test_genotype_array(self):
+        """Check indexing a lazy array view reads the same dosage as reading every variant"""
+        bgen = self._loader()[::2, 100:]
+        dosage = bgen.dosage_array()
+        view = bgen.as_array(chunk_variants=3000)
+
+        self.assertEqual(view.shape, dosage.shape)
+        self.assertEqual(sum(view.chunks[0]), view.shape[0])
+        self.assertTrue(np.array_equal(np.asarray(view), dosage, equal_nan=True))
+        self.assertTrue(np.array_equal(view[5], dosage[5], equal_nan=True))
+        self.assertTrue(np.array_equal(view[[7, 2, 9], 3:20], dosage[[7, 2, 9], 3:20], equal_nan=True))
+        self.assertTrue(np.array_equal(view[view.chunk_slices()[-1]], dosage[-view.chunks[0][-1]:], equal_nan=True))
+
+        mask = np.zeros(len(view), dtype=bool)
+        mask[[1, 50]] = True
+        self.assertTrue(np.array_equal(view[mask], dosage[mask], equal_nan=True))
+        self.assertEqual(bgen.as_array(np.uint8)[:2].dtype, np.uint8)
+
+        # Index arrays of both axes are broadcast together as NumPy does, rather than selecting every pair
+        for item in [([1, 2], [3, 4]), (5, [1, 2]), (np.array([[1], [2]]), np.array([[3, 4, 5]])), ([-1, 0], 1)]:
+            self.assertEqual(view[item].shape, dosage[item].shape)
+            self.assertTrue(np.array_equal(view[item], dosage[item], equal_nan=True))
+
+        # An object returning probabilities still gives a view of its dosage
+        probabilities = BgenObject(bgen.file_path, probability_return=True)[::2, 100:]
+        self.assertTrue(np.array_equal(probabilities.as_array()[:2], dosage[:2], equal_nan=True))
+
+        plink = PlinkObject(Path(Path(__file__).parent, "Data", "EUR.ldpred_21"))
+        dosage = np.vstack([dosage for _, dosage in plink.iter_variants()])
+        view = plink.as_array()
+        self.assertTrue(np.array_equal(view[10:20], dosage[10:20], equal_nan=True))
+        self.assertTrue(np.array_equal(view[[30, 4], ::3], dosage[[30, 4], ::3], equal_nan=True))
+        plink.close_all()
+
+    def test_sample_identifiers(self):
+        """Check embedded ids of fixed and varied length, and .sample ids, are read once and shared with views"""
+        bgen = self._loader()
+        subset = bgen[:5, :3]
+        write_path = Path(Path(__file__).parent, "Data", "Write", "identifiers.bgen")
+
+        for sample_ids in [["id01", "id02", "id03", "id04", "id05"], ["a", "bb", "", "dddd", "é"]]:
+            with BgenWriter(write_path, 5, 8, 1, sample_ids, bgi=False) as writer:
+                writer.write_bgen(subset)
+            # A view sliced before any ids are read loads them for its parent too
+            written = BgenObject(write_path, bgi_present=False)
+            self.assertEqual(written[[4, 1], :].iid_array().tolist(), [sample_ids[4], sample_ids[1]])
+            self.assertIsNotNone(written._iid_table[0])
+            self.assertEqual(written.iid_array().tolist(), sample_ids)
+            write_path.unlink()
+
+        sample_path = Path(Path(__file__).parent, "Data", "Write", "identifiers.sample")
+        with open(sample_path, "w") as sample_file:
+            sample_file.write("ID_1 ID_2 missing sex\n0 0 0 D\n")
+            sample_file.writelines([f"F{i} I{i} 0 {i % 2 + 1}\n" for i in range(bgen.iid_count)])
+        with_samples = BgenObject(bgen.file_path, sample_path=sample_path)
+        self.assertEqual(with_samples[[2, 0], :].iid_array().tolist(), [["F2", "I2"], ["F0", "I0"]])
+        self.assertEqual(with_samples.iid_to_index([np.array(["F7", "I7"])]).tolist(), [7])
+
+        # A short line followed by a long line has as many fields as the columns, but would shift the ids after it
+        with open(sample_path, "w") as sample_file:
+            sample_file.write("ID_1 ID_2 missing sex\n0 0 0 D\nF0 I0 0\nF1 I1 0 1 1\n")
+        with self.assertRaises(AssertionError):
+            BgenObject(bgen.file_path, sample_path=sample_path).iid_array()
+        sample_path.unlink()
+
+    def test_index_free(self):
+        """Check a bgen without a .bgi reads the same as with one, and the scanned variant table persists as a .bgi"""
+        bgen = self._loader()
+        scanned = BgenObject(bgen.file_path, bgi_present=False)
+        snps = ['rs55776382', 'rs2801301']
+
+        self.assertEqual(len(scanned.variant_table()), bgen.sid_count)
+        self.assertTrue(np.array_equal(scanned.sid_array(), bgen.sid_array()))
+        self.assertEqual([variant.items() for variant in scanned.info_from_sid(snps)],
+                         [variant.items() for variant in bgen.info_from_sid(snps)])
+        self.assertTrue(np.array_equal(scanned[:, :20].dosage_array(), bgen[:, :20].dosage_array(), equal_nan=True))
+        self.assertTrue(np.array_equal(scanned[:10, :].dosage_from_sid(snps), bgen[:10, :].dosage_from_sid(snps),
+                                       equal_nan=True))
+
+        write_path = Path(Path(__file__).parent, "Data", "Write")
+        scanned.create_bgi(write_path)
+        out_path = Path(write_path, "EUR.ldpred_21.bgen.bgi")
+        persisted = BgenObject(bgen.file_path, bgi_present=str(out_path))
+        self.assertEqual(persisted.variant_table().rows(["file_start_position", "size_in_bytes", "rsid"]),
+                         scanned.variant_table().rows(["file_start_position", "size_in_bytes", "rsid"]))
+        out_path.unlink()
+
+    def test_sidecar(self):
+        """Check sidecars made from a .bgi, or from the .bim, give the same variants as the sqlite indexes"""
+        bgen = self._loader()
+        write_path = Path(Path(__file__).parent, "Data", "Write")
+        snps = ['rs118189563', 'rs55776382', 'not_a_snp']
+
+        sidecar_path = bgen.create_sidecar(Path(write_path, "EUR.ldpred_21.bgen.vti"))
+        indexed = BgenObject(bgen.file_path, bgi_present=False, sidecar=sidecar_path)
+        self.assertTrue(np.array_equal(indexed.sid_array(), bgen.sid_array()))
+        self.assertEqual([variant.items() for variant in indexed.info_from_sid(snps)],
+                         [variant.items() for variant in bgen.info_from_sid(snps)])
+        self.assertTrue(np.array_equal(indexed[:, 5:9].dosage_array(), bgen[:, 5:9].dosage_array(), equal_nan=True))
+        self.assertTrue(np.array_equal(indexed.dosage_from_sid(snps), bgen.dosage_from_sid(snps), equal_nan=True))
+        sidecar_path.unlink()
+
+        plink_path = Path(Path(__file__).parent, "Data", "EUR.ldpred_21")
+        plink = PlinkObject(plink_path, True)
+        sidecar_path = PlinkObject(plink_path).create_sidecar(Path(write_path, "EUR.ldpred_21.bim.vti"))
+        indexed = PlinkObject(plink_path, sidecar=sidecar_path)
+        self.assertEqual([variant.items() for variant in indexed.info_from_sid(snps, True)],
+                         [variant.items() for variant in plink.info_from_sid(snps, True)])
+        self.assertEqual([variant.items() for variant in indexed.info_array()],
+                         [variant.items() for variant in plink.info_array()])
+        sidecar_path.unlink()
+        plink.close_all()
+        indexed.close_all()
+
+    def test_bgen_writer(self):
+        """Check a subset written with BgenWriter reads back the same, and its .bgi matches one made by create_bgi"""
+        bgen = BgenObject(Path(Path(__file__).parent, "Data", "EUR.ldpred_21.bgen"), probability_return=True)
+        subset = bgen[[5, 1, 300], 10:60]
+        write_path = Path(Path(__file__).parent, "Data", "Write", "writer.bgen")
+
+        with BgenWriter(write_path, subset.iid_count, 16, 1, ["a", "b", "c"], workers=2, chunk_size=16) as writer:
+            writer.write_bgen(subset, batch_size=20)
+
+        written = BgenObject(write_path, probability_return=True)
+        self.assertEqual((written.iid_count, written.sid_count), (3, 50))
+        self.assertEqual(written.iid_array().tolist(), ["a", "b", "c"])
+        self.assertTrue(np.array_equal(written.dosage_array(), subset.dosage_array(), equal_nan=True))
+        columns = ["file_start_position", "size_in_bytes", "position", "rsid", "allele1", "allele2"]
+        self.assertEqual(written.variant_table().rows(columns),
+                         BgenObject(write_path, bgi_present=False).variant_table().rows(columns))
+
+        # Dosage are written as the probabilities of the least uncertainty that keep the same expected count
+        dosage = np.array([[0, 0.25, 1, 1.5, 2, np.nan]], dtype=np.float32)
+        with BgenWriter(write_path, 6, 8, 0, workers=0) as writer:
+            writer.write([Variant(1, 100, "rs1", "A", "G")], dosage)
+        self.assertTrue(np.allclose(BgenObject(write_path, probability=0).dosage_array(), dosage, atol=1 / 255,
+                                    equal_nan=True))
+
+        write_path.unlink()
+        Path(f"{write_path}.bgi").unlink()
+
+    def test_plink_conversion(self):
+        """Check bgen to plink writes the hard calls, and plink to bgen reads back the same calls"""
+        bgen = BgenObject(Path(Path(__file__).parent, "Data", "EUR.ldpred_21.bgen"))[[5, 1, 300, 7, 9], 10:60]
+        write_root = Path(Path(__file__).parent, "Data", "Write", "converted")
+        bgen.to_plink(write_root, batch_size=16)
+
+        plink = PlinkObject(write_root, bgi_present=True)
+        calls = np.concatenate([dosage for _, dosage in plink.iter_variants(16)])
+        self.assertTrue(np.array_equal(calls, bgen.as_hard_calls().dosage_array(), equal_nan=True))
+        self.assertEqual(plink.info_array(as_variant=True)[0].snp_id, bgen.sid_array()[0])
+
+        plink.to_bgen(f"{write_root}.bgen", workers=2, batch_size=16)
+        converted = BgenObject(f"{write_root}.bgen", probability=0)
+        self.assertTrue(np.array_equal(converted.dosage_array(), calls, equal_nan=True))
+        self.assertEqual(converted.iid_array().tolist(), ["5", "1", "300", "7", "9"])
+
+        plink.close_all()
+        for suffix in [".bed", ".bim", ".fam", ".bim.bgi", ".bgen", ".bgen.bgi"]:
+            Path(f"{write_root}{suffix}").unlink()
+
+    def test_variant_qc(self):
+        """Check variant qc matches the same statistics computed directly, and plink and bgen agree on hard calls"""
+        bgen = self._loader()[[5, 1, 300, 7, 9, 11], :20]
+        qc = bgen.variant_qc(batch_size=8)
+        self.assertEqual(len(qc), 20)
+        self.assertEqual(qc.column("rsid").tolist(), bgen.sid_array().tolist())
+
+        probs = bgen.as_probabilities().dosage_array().astype(np.float64)
+        dosage = probs[..., 1] + 2 * probs[..., 2]
+        frequency = dosage.sum(axis=1) / (2 * bgen.iid_count)
+        self.assertTrue(np.allclose(qc.column("a2_frequency"), frequency))
+        self.assertTrue(np.allclose(qc.column("maf"), np.minimum(frequency, 1 - frequency)))
+
+        # A variant in Hardy Weinberg equilibrium, one far from it, one monomorphic and one with every sample missing
+        calls = np.array([[0, 0, 0, 0, 1, 1, 1, 2], [0, 0, 0, 0, 2, 2, 2, 2], [0] * 8, [np.nan] * 8])
+        statistics = kn.variant_qc_kernel(kn.hard_calls_to_probabilities(calls))
+        self.assertTrue(np.allclose(statistics["call_rate"], [1, 1, 1, 0]))
+        self.assertTrue(np.allclose(statistics["hwe_p"][:3], [0.7188608680, 0.0046777350, 1]))
+        self.assertTrue(np.allclose(statistics["info"][:3], 1))
+        self.assertTrue(np.isnan(statistics["maf"][3]) and np.isnan(statistics["hwe_p"][3]))
+
+        plink = PlinkObject(Path(Path(__file__).parent, "Data", "EUR.ldpred_21"))
+        plink_qc = plink.variant_qc(batch_size=64)
+        self.assertTrue(np.allclose(plink_qc.column("maf")[:20], self._loader()[:, :20].variant_qc().column("maf")))
+        plink.close_all()
+
+    def test_sample_qc(self):
+        """Check sample accumulators of merged batches match statistics of the full dosage array"""
+        bgen = self._loader()[:, 100:400]
+        summary = bgen.sample_qc(batch_size=32, workers=3).summary()
+        dosage = bgen.dosage_array().astype(np.float64)
+        self.assertTrue(np.allclose(summary["mean_dosage"], np.nanmean(dosage, axis=0)))
+        self.assertTrue(np.allclose(summary["dosage_variance"], np.nanvar(dosage, axis=0)))
+
+        # Missing samples are excluded from every rate, and merging matches a single update
+        calls = np.array([[0, 1, np.nan], [1, 1, np.nan], [2, 1, 0], [1, 0, np.nan]])
+        probs = kn.hard_calls_to_probabilities(calls)
+        merged = SampleAccumulator(3).update(probs[:1]).merge(SampleAccumulator(3).update(probs[1:]))
+        self.assertEqual(merged.variant_number, 4)
+        summary = merged.summary()
+        self.assertTrue(np.allclose(summary["missing_rate"], [0, 0, 0.75]))
+        self.assertTrue(np.allclose(summary["heterozygosity"], [0.5, 0.75, 0]))
+        self.assertTrue(np.allclose(summary["mean_dosage"], [1, 0.75, 0]))
+
+    def test_polygenic_score(self):
+        """Check scores from a weight file match a direct product of the aligned dosage, for both bgen and plink"""
+        bgen = self._loader()[[3, 1, 4, 1, 5], :]
+        rows = bgen._index_rows(["rsid", "allele1", "allele2"])[::40]
+        weight_path = Path(Path(__file__).parent, "Data", "Write", "weights.txt")
+        with open(weight_path, "w") as weight_file:
+            weight_file.write("rsid\teffect\tfirst\tsecond\n")
+            for i, (rsid, a1, a2) in enumerate(rows):
+                weight_file.write(f"{rsid}\t{a1 if i % 2 else a2.lower()}\t{i / 10}\t{1 - i}\n")
+            weight_file.write("rs_absent\tA\t1\t1\n")
+
+        weights = ScoreWeights.from_file(weight_path)
+        self.assertEqual(weights.names, ["first", "second"])
+        scores = bgen.polygenic_score(weight_path, batch_size=16, workers=2)
+
+        # Weights of the first allele count two minus the dosage of the second
+        dosage = bgen.dosage_array()[::40].astype(np.float64)
+        dosage = np.where(np.arange(len(rows))[:, None] % 2, 2 - dosage, dosage)
+        self.assertTrue(np.allclose(scores, dosage.T @ weights.weights[:-1]))
+        self.assertEqual(bgen.stats.counters["score_variants"], len(rows))
+
+        plink = PlinkObject(Path(Path(__file__).parent, "Data", "EUR.ldpred_21"))
+        self.assertTrue(np.allclose(plink.polygenic_score(weights)[[3, 1, 4, 1, 5]], scores))
+        plink.close_all()
+
+        # The rows of a duplicated rsid are summed, and a file of only a header scores zero
+        rsids, effect = [row[0] for row in rows], [row[2] for row in rows]
+        doubled = bgen.polygenic_score(ScoreWeights(rsids * 2, effect * 2, np.ones(2 * len(rows))))
+        self.assertTrue(np.allclose(doubled, 2 * bgen.polygenic_score(ScoreWeights(rsids, effect, np.ones(len(rows))))))
+        self.assertEqual(bgen.stats.counters["score_duplicates"], len(rows))
+
+        with open(weight_path, "w") as weight_file:
+            weight_file.write("rsid\teffect\tfirst\tsecond\n")
+        self.assertTrue(np.array_equal(bgen.polygenic_score(weight_path), np.zeros((5, 2))))
+        weight_path.unlink()
+
+        # Missing dosage are imputed as the mean of the variant
+        self.assertTrue(np.allclose(kn.score_kernel(np.array([[0, 2, np.nan]]), np.array([[1.0]])), [[0], [2], [1]]))
+
+    def test_concurrent_readers(self):
+        """Check one opened bgen and plink object return the same results from many threads as they do serially"""
+        bgen = self._loader()
+        names = [str(name) for name in bgen.sid_array()]
+
+        def read_bgen(start):
+            return bgen.dosage_from_sid(names[start:start + 25]), bgen.iid_array()[:3].tolist()
+
+        plink = PlinkObject(Path(Path(__file__).parent, "Data", "EUR.ldpred_21"), bgi_present=True)
+        seeks = list(plink.construct_bim_index().values())
+
+        def read_plink(start):
+            return [str(plink.get_variant(seek)) for seek in seeks[start:start + 25]], \
+                [str(variant) for variant in plink.info_from_sid(names[start:start + 25])]
+
+        starts = list(range(0, 1000, 31))
+        with ThreadPoolExecutor(8) as executor:
+            bgen_results = list(executor.map(read_bgen, starts))
+            plink_results = list(executor.map(read_plink, starts))
+
+        for start, (dosage, iid) in zip(starts, bgen_results):
+            self.assertTrue(np.array_equal(dosage, read_bgen(start)[0]))
+            self.assertEqual(iid, read_bgen(start)[1])
+        self.assertEqual(plink_results, [read_plink(start) for start in starts])
+
+        # Objects opened from a sidecar decode their string columns on first use, which threads must not race on
+        write_path = Path(Path(__file__).parent, "Data", "Write")
+        bgen_sidecar = bgen.create_sidecar(Path(write_path, "EUR.ldpred_21.bgen.vti"))
+        plink_sidecar = plink.create_sidecar(Path(write_path, "EUR.ldpred_21.bim.vti"))
+        expected_bgen = [[str(variant) for variant in bgen.info_from_sid(names[:25])], bgen.sid_array().tolist()]
+        expected_plink = [str(variant) for variant in plink.info_array()]
+
+        for _ in range(5):
+            bgen_indexed = BgenObject(bgen.file_path, bgi_present=False, sidecar=bgen_sidecar)
+            plink_indexed = PlinkObject(plink.bed_file_path.with_suffix(""), sidecar=plink_sidecar)
+
+            def read_sidecars(thread):
+                if thread % 2:
+                    return bgen_indexed.sid_array().tolist(), [str(variant) for variant in plink_indexed.info_array()]
+                return [str(variant) for variant in bgen_indexed.info_from_sid(names[:25])], \
+                    [str(variant) for variant in plink_indexed.info_from_sid(names[:25])]
+
+            with ThreadPoolExecutor(8) as executor:
+                sidecar_results = list(executor.map(read_sidecars, range(16)))
+            for thread, (bgen_result, plink_result) in enumerate(sidecar_results):
+                self.assertEqual(bgen_result, expected_bgen[thread % 2])
+                if thread % 2:
+                    self.assertEqual(plink_result, expected_plink)
+            plink_indexed.close_all()
+
+        bgen_sidecar.unlink()
+        plink_sidecar.unlink()
+        plink.close_all()
+
+    def test_genotype_server(self):
+        """Check the genotype server answers rsid, region and sample queries as the objects do, and reports errors"""
+        bgen = self._loader()
+        plink = PlinkObject(Path(Path(__file__).parent, "Data", "EUR.ldpred_21"))
+        socket_path = Path(Path(__file__).parent, "Data", "Write", "genotypes.sock")
+        server = GenotypeServer(socket_path, {"bgen": bgen, "plink": plink}, workers=4).start_background()
+
+        names = [str(name) for name in bgen.sid_array()[10:20]]
+        try:
+            with GenotypeClient(socket_path) as client:
+                self.assertEqual(client.datasets()["plink"], {"iid_count": 483, "sid_count": 7909})
+
+                variants, dosage = client.dosage("bgen", rsids=names, samples=[3, 1, 4])
+                self.assertEqual([variant.snp_id for variant in variants], names)
+                self.assertTrue(np.array_equal(dosage, bgen.dosage_from_sid(names)[:, [3, 1, 4]]))
+
+                variants, dosage = client.dosage("plink", region=(21, 14595742, 14652908))
+                self.assertEqual([variant.snp_id for variant in variants], ["rs55776382", "rs2801301", "rs3869758"])
+                self.assertTrue(np.array_equal(dosage, bgen.dosage_array()[:3]))
+
+                with self.assertRaises(ValueError):
+                    client.dosage("missing", rsids=names)
+
+            def query(_):
+                with GenotypeClient(socket_path) as concurrent_client:
+                    return concurrent_client.dosage("bgen", rsids=names)[1]
+
+            with ThreadPoolExecutor(8) as executor:
+                self.assertTrue(all([np.array_equal(dosage, bgen.dosage_from_sid(names))
+                                     for dosage in executor.map(query, range(16))]))
+        finally:
+            server.stop_background()
+        self.assertFalse(socket_path.exists())
+
+    def test_genetic_dataset(self):
+        """Check a dataset of split files answers rsid and region queries as the single file they were split from"""
+        bgen = self._loader()
+        write_path = Path(Path(__file__).parent, "Data", "Write")
+        splits = [(2, slice(0, 100)), (10, slice(100, 250))]
+        for split, sid_slice in splits:
+            with BgenWriter(Path(write_path, f"split{split}.bgen"), bgen.iid_count, workers=0) as writer:
+                writer.write_bgen(bgen[:, sid_slice])
+            bgen[:, sid_slice].to_plink(Path(write_path, f"split{split}"), bim_bgi=False)
+
+        names = [str(name) for name in bgen.sid_array()[[5, 90, 120, 240, 300]]]
+        for paths in [str(Path(write_path, "split*.bgen")), str(Path(write_path, "split{chromosome}.bed"))]:
+            with GeneticDataset(paths, chromosomes=[2, 10], workers=2) as dataset:
+                self.assertEqual(dataset.sid_count, 250)
+                self.assertEqual(dataset.sid_to_index(names).tolist(), [5, 90, 120, 240])
+                self.assertEqual([variant.snp_id for variant in dataset.info_from_sid(names)], names[:4])
+                self.assertTrue(np.array_equal(dataset.dosage_from_sid(names, [4, 2]),
+                                               bgen.dosage_from_sid(names[:4])[:, [4, 2]]))
+                self.assertEqual(dataset.dosage_from_sid(["rs_absent"]).shape, (0, bgen.iid_count))
+
+        # A region spanning both files of the glob, ordered by file with chr2 before chr10
+        with GeneticDataset(str(Path(write_path, "split*.bgen"))) as dataset:
+            variants, dosage = dataset.dosage_from_region(21, bgen.info_array()[95].bp_position,
+                                                          bgen.info_array()[104].bp_position)
+        self.assertEqual([variant.snp_id for variant in variants], bgen.sid_array()[95:105].tolist())
+        self.assertTrue(np.array_equal(dosage, bgen.dosage_array()[95:105]))
+
+        for split, _ in splits:
+            for suffix in [".bgen", ".bgen.bgi", ".bed", ".bim", ".fam"]:
+                Path(write_path, f"split{split}{suffix}").unlink()
+
+    def test_parser_stats(self):
+        """Check stats are shared with sliced views and count the work of each stage, and progress is reported"""
+        bgen = self._loader()
+        bgen[:, :5].dosage_array()
+
+        summary = bgen.stats.summary()
+        self.assertEqual(summary["counters"]["blocks_decoded"], 5)
+        self.assertEqual(summary["counters"]["sql_rows"], bgen.sid_count)
+        self.assertTrue(summary["counters"]["bytes_decompressed"] > summary["counters"]["bytes_read"] > 0)
+        self.assertTrue(all([stage in summary["timers"] for stage in ["sql", "read", "decompress", "decode"]]))
+
+        bgen.stats.reset()
+        bgen.dosage_from_sid(['rs55776382'])
+        self.assertEqual(bgen.stats.counters["sql_rows"], 1)
+
+        # Tables loaded by an earlier call, by this object or a view sharing them, are counted as cache hits
+        bgen.variant_table()
+        bgen.iid_array()
+        self.assertNotIn("cache_hits", bgen.stats.counters)
+        bgen[:5, :].variant_table()
+        bgen[:5, :].iid_array()
+        self.assertEqual(bgen.stats.counters["cache_hits"], 2)
+
+        updates = []
+        stats = ParserStats(updates.append)
+        stats.progress("Extracted", 10, 20)
+        self.assertEqual([(update["operation"], update["count"], update["total"]) for update in updates],
+                         [("Extracted", 10, 20)])
+
+    def test_lazy_import(self):
+        """Check importing variants does not load the parsers, which are still loaded on first access"""
+        script = "import sys\nfrom pyGenicParser import Variant\n" \
+                 "print('numpy' in sys.modules, 'sqlite3' in sys.modules)"
+        output = subprocess.run([sys.executable, "-c", script], cwd=Path(__file__).parents[2], capture_output=True,
+                                text=True, check=True).stdout
+        self.assertEqual(output.split(), ["False", "False"])
+
+        import pyGenicParser
+        self.assertTrue(all([name in dir(pyGenicParser) for name in pyGenicParser.__all__]))
+        self.assertIs(pyGenicParser.BgenObject, BgenObject)
+
+    def test_kernels(self):
+        """Check the integer kernels match computing dosage from probabilities divided into float64"""
+        rng = np.random.default_rng(1)
+        for b in [8, 10, 16]:
+            scale = 2 ** b - 1
+            first = rng.integers(0, scale + 1, 500)
+            probs = np.column_stack([first, rng.integers(0, scale + 1 - first)]).astype(np.uint32)
+            missing = rng.random(500) < 0.1
+
+            float_probs = probs / scale
+            last = 1 - float_probs.sum(axis=1)
+            expected = 2 * last + float_probs[:, 1]
+            expected[~(np.any(float_probs >= 0.9, axis=1) | (last >= 0.9)) | missing] = np.nan
+
+            dosage = kn.dosage_kernel(probs, b, missing, kn.quality_cutoff(0.9, b), np.empty(500, dtype=np.float32))
+            self.assertTrue(np.array_equal(np.isnan(dosage), np.isnan(expected)))
+            self.assertTrue(np.allclose(dosage, expected, atol=1e-6, equal_nan=True))
+
+            full = kn.probability_kernel(probs, b, missing, np.empty((500, 3), dtype=np.float32))
+            self.assertTrue(np.allclose(full[:, 2], np.where(missing, np.nan, last), atol=1e-6, equal_nan=True))
+
+            calls = kn.hard_call_kernel(probs, b, missing, None, np.empty(500, dtype=np.float32))
+            best = np.column_stack([float_probs, last]).argmax(axis=1)
+            self.assertTrue(np.array_equal(calls[~missing], best[~missing]))
+
+    def test_general_bgen(self):
+        """Check phased, multi-allelic and variable ploidy blocks of a bgen decode through BgenObject"""
+        write_path = Path(Path(__file__).parent, "Data", "Write")
+        bgen = BgenObject(self._general_bgen(Path(write_path, "general.bgen")), bgi_present=False)
+
+        # a2 is the second allele, with every allele of a multi-allelic variant returned alongside its allele dosage
+        self.assertEqual([variant.a2 for variant in bgen.info_array()], ["G", "T", "C"])
+        alleles, allele_dosage = bgen.allele_dosage_from_sid(["rsM"], return_alleles=True)
+        self.assertEqual(alleles, [["A", "C", "G"]])
+        self.assertTrue(np.array_equal(allele_dosage[0], [[1, 0, 1], [0, 0, 2], [2, 0, 0], [0, 2, 0]]))
+
+        # Subsets decode the same values, including a subset of only the diploid samples of the variable ploidy block
+        dosage = np.array([[0, 1, 1, 2], [1, 2, 0, np.nan], [1, 2, 0, 2]])
+        self.assertTrue(np.array_equal(bgen.dosage_array(), dosage, equal_nan=True))
+        for samples in [[0, 1, 2, 3], [0, 3], [3, 1, 1], [2]]:
+            subset = bgen[samples, :]
+            self.assertTrue(np.array_equal(subset.dosage_array(), dosage[:, samples], equal_nan=True))
+            self.assertTrue(np.array_equal(subset.dosage_from_sid(["rsU"]), dosage[:1, samples]))
+            self.assertTrue(np.array_equal(subset.haplotype_from_sid(["rsP"]),
+                                           bgen.haplotype_from_sid(["rsP"])[:, samples], equal_nan=True))
+            self.assertTrue(np.array_equal(subset.allele_dosage_from_sid(["rsM"])[0], allele_dosage[0][samples]))
+
+            # Blocks without a dedicated sparse or quantised kernel are split or quantised from their dense column
+            self.assertTrue(np.array_equal(subset.dosage_array(sparse=True).toarray(), dosage[:, samples].T,
+                                           equal_nan=True))
+            self.assertTrue(np.array_equal(kn.dequantise_dosage(subset.dosage_array(dtype=np.uint8)),
+                                           dosage[:, samples], equal_nan=True))
+        self.assertTrue(np.array_equal(bgen.haplotype_from_sid(["rsP"])[0], [[0, 1], [1, 1], [0, 0], [np.nan] * 2],
+                                       equal_nan=True))
+
+        # Plink files only hold bi-allelic variants, so the multi-allelic variant is skipped
+        bgen.to_plink(Path(write_path, "general"))
+        with open(Path(write_path, "general.bim")) as bim:
+            self.assertEqual([line.split()[4:] for line in bim], [["A", "G"], ["C", "T"]])
+        self.assertEqual(bgen.stats.counters["variants_skipped"], 1)
+        self.assertTrue(np.array_equal(np.vstack([dosage for _, dosage in PlinkObject(
+            Path(write_path, "general")).iter_variants()]), bgen.dosage_array()[:2], equal_nan=True))
+
+        for suffix in [".bgen", ".bed", ".bim", ".bim.bgi", ".fam"]:
+            Path(write_path, f"general{suffix}").unlink()
+
+    def test_general_kernels(self):
+        """Check phased, multi-allelic and variable ploidy blocks decode to the expected allele counts"""
+        # Two phased diploid samples and one haploid sample, with three alleles stored as P(A), P(B) per haplotype
+        ploidy = np.array([2, 2, 1], dtype=np.uint8)
+        values = np.array([255, 0, 0, 255, 0, 0, 0, 0, 255, 0], dtype=np.uint32)
+        missing = np.array([False, False, True])
+
+        alleles = kn.allele_dosage_kernel(values, 8, ploidy, missing, True, 3, np.empty((3, 3), dtype=np.float32))
+        self.assertTrue(np.allclose(alleles[:2], [[1, 1, 0], [0, 0, 2]]))
+        self.assertTrue(np.isnan(alleles[2]).all())
+
+        haplotypes = kn.haplotype_kernel(values, 8, ploidy, np.zeros(3, dtype=bool), 3,
+                                         np.empty((3, 2), dtype=np.float32))
+        self.assertTrue(np.allclose(haplotypes, [[0, 1], [1, 1], [0, np.nan]], equal_nan=True))
+
+        dosage = kn.general_dosage_kernel(values, 8, ploidy, missing, True, 3, None, np.empty(3, dtype=np.float32))
+        self.assertTrue(np.allclose(dosage, [1, 2, np.nan], equal_nan=True))
+
+        # Unphased tri-allelic diploid samples store five of the six genotypes AA, AB, BB, AC, BC, CC
+        ploidy = np.array([2, 2], dtype=np.uint8)
+        values = np.array([0, 0, 0, 255, 0, 0, 0, 0, 0, 0], dtype=np.uint32)
+        alleles = kn.allele_dosage_kernel(values, 8, ploidy, np.zeros(2, dtype=bool), False, 3,
+                                          np.empty((2, 3), dtype=np.float32))
+        self.assertTrue(np.allclose(alleles, [[1, 0, 1], [0, 0, 2]]))
+
+        calls = kn.general_dosage_kernel(values, 8, ploidy, np.zeros(2, dtype=bool), False, 3,
+                                         kn.quality_cutoff(0.9, 8), np.empty(2, dtype=np.float32), hard_call=True)
+        self.assertTrue(np.allclose(calls, [1, 2]))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,34 @@
-from .plinkObject import PlinkObject
-from .bgenObject import BgenObject
 from .variantObjects import *
-from.vcfObject import VCFObject
+from importlib import import_module
+
+# The parsers pull in numpy, sqlite3 and the codecs, so they are only imported when first accessed
+_LAZY_ATTRIBUTES = {
+    "PlinkObject": ".plinkObject",
+    "BgenObject": ".bgenObject",
+    "BgenWriter": ".bgenWriter",
+    "VCFObject": ".vcfObject",
+    "ParserStats": ".stats",
+    "SampleAccumulator": ".sampleAccumulator",
+    "ScoreWeights": ".polygenicScore",
+    "SparseDosage": ".sparseDosage",
+    "GRMBuilder": ".relationshipMatrix",
+    "SampleMajorStore": ".sampleMajorStore",
+    "GenotypeArray": ".genotypeArray",
+    "GenotypeServer": ".genotypeServer",
+    "GenotypeClient": ".genotypeClient",
+    "GeneticDataset": ".geneticDataset"
+}
+
+__all__ = ["Variant", "BimVariant", "FamId", "Nucleotide"] + list(_LAZY_ATTRIBUTES.keys())
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        attribute = getattr(import_module(_LAZY_ATTRIBUTES[name], __name__), name)
+        globals()[name] = attribute
+        return attribute
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + list(_LAZY_ATTRIBUTES.keys()))
@@ -0,0 +1,193 @@
+from . import errors_codes as ec
+
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from threading import local
+import zlib
+
+# The backends of each compression flag of the bgen header, fastest first, where 0 is uncompressed, 1 zlib and 2 zstd
+BACKENDS = {0: ["none"], 1: ["libdeflate", "isal", "zlib"], 2: ["zstandard", "zstd"]}
+
+
+class BlockCodec(ABC):
+    def __init__(self, name):
+        """
+        Compresses and decompresses genotype data blocks. Decompression is given the decompressed size D stored before
+        each compressed block, so backends allocate the output once at its exact size rather than growing it. Backends
+        must implement both decompress and compress, otherwise they cannot be constructed.
+
+        :param name: The name of the backend
+        :type name: str
+        """
+        self.name = name
+
+    def __repr__(self):
+        return f"{type(self).__name__} -> {self.name}"
+
+    @abstractmethod
+    def decompress(self, data, size=None):
+        """
+        Decompress a block
+
+        :param data: The compressed block
+        :type data: bytes
+
+        :param size: The decompressed size of the block if known, such as D of layout 2
+        :type size: int | None
+
+        :return: The decompressed block
+        :rtype: bytes
+        """
+
+    @abstractmethod
+    def compress(self, data):
+        """
+        Compress a block
+
+        :param data: The block
+        :type data: bytes
+
+        :return: The compressed block
+        :rtype: bytes
+        """
+
+
+class NoCodec(BlockCodec):
+    def decompress(self, data, size=None):
+        return data
+
+    def compress(self, data):
+        return data
+
+
+class ZlibCodec(BlockCodec):
+    def __init__(self, name, module):
+        """A zlib compatible module, being zlib or isal.isal_zlib, which both accept the output size as bufsize"""
+        super().__init__(name)
+        self._module = module
+
+    def decompress(self, data, size=None):
+        return self._module.decompress(data, bufsize=size or zlib.DEF_BUF_SIZE)
+
+    def compress(self, data):
+        return self._module.compress(data)
+
+
+class LibdeflateCodec(BlockCodec):
+    def __init__(self, name, module):
+        """The deflate bindings of libdeflate, which decompress whole buffers of a known size in a single call"""
+        super().__init__(name)
+        self._module = module
+
+    def decompress(self, data, size=None):
+        if size is None:
+            return zlib.decompress(data)
+        return self._module.zlib_decompress(data, size)
+
+    def compress(self, data):
+        return self._module.zlib_compress(data)
+
+
+class ZstandardCodec(BlockCodec):
+    def __init__(self, name, module):
+        """
+        The zstandard bindings, whose decompression and compression contexts are reused for every block of a thread
+        rather than set up for each block, as contexts cannot be shared between threads
+        """
+        super().__init__(name)
+        self._module = module
+        self._contexts = local()
+
+    def decompress(self, data, size=None):
+        context = getattr(self._contexts, "decompressor", None)
+        if context is None:
+            context = self._contexts.decompressor = self._module.ZstdDecompressor()
+        return context.decompress(data, max_output_size=size or 0)
+
+    def compress(self, data):
+        context = getattr(self._contexts, "compressor", None)
+        if context is None:
+            context = self._contexts.compressor = self._module.ZstdCompressor()
+        return context.compress(data)
+
+
+class ZstdCodec(BlockCodec):
+    def __init__(self, name, module):
+        """The zstd bindings, which only offer one shot functions"""
+        super().__init__(name)
+        self._module = module
+
+    def decompress(self, data, size=None):
+        return self._module.decompress(data)
+
+    def compress(self, data):
+        return self._module.compress(data)
+
+
+def available_backends(compression):
+    """
+    The names of the backends of a compression flag that are installed, fastest first
+
+    :param compression: 0 for uncompressed, 1 for zlib, 2 for zstd
+    :type compression: int
+
+    :return: The names
+    :rtype: list[str]
+    """
+    backends = []
+    for name in BACKENDS[compression]:
+        try:
+            _load_backend(name)
+            backends.append(name)
+        except ImportError:
+            pass
+    return backends
+
+
+@lru_cache(maxsize=None)
+def get_codec(compression, backend=None):
+    """
+    The codec of a compression flag, shared by every caller of the same backend so its contexts are reused
+
+    :param compression: 0 for uncompressed, 1 for zlib, 2 for zstd
+    :type compression: int
+
+    :param backend: The name of the backend from BACKENDS, defaults to the fastest installed
+    :type backend: str | None
+
+    :return: The codec
+    :rtype: BlockCodec
+
+    :raises ImportError: If the backend, or every backend of the compression if none was named, is not installed
+    """
+    assert compression in BACKENDS, ec.compression_violation("", compression)
+    if backend is not None:
+        assert backend in BACKENDS[compression], ec.codec_violation(backend, BACKENDS[compression])
+        return _load_backend(backend)
+
+    for name in BACKENDS[compression]:
+        try:
+            return _load_backend(name)
+        except ImportError:
+            pass
+    raise ImportError(ec.codec_missing(BACKENDS[compression]))
+
+
+def _load_backend(name):
+    """Construct the codec of a backend, importing its module, which raises ImportError if it is not installed"""
+    if name == "none":
+        return NoCodec(name)
+    elif name == "zlib":
+        return ZlibCodec(name, zlib)
+    elif name == "isal":
+        from isal import isal_zlib
+        return ZlibCodec(name, isal_zlib)
+    elif name == "libdeflate":
+        import deflate
+        return LibdeflateCodec(name, deflate)
+    elif name == "zstandard":
+        import zstandard
+        return ZstandardCodec(name, zstandard)
+    else:
+        import zstd
+        return ZstdCodec(name, zstd)
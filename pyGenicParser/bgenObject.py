@@ -1,25 +1,36 @@
 from .variantObjects import Variant
+from .variantTable import VariantTable
+from .sampleAccumulator import SampleAccumulator
+from .sparseDosage import SparseDosage
+from .sampleMajorStore import write_sample_major
+from .genotypeArray import GenotypeArray
+from .polygenicScore import ScoreWeights
+from .plinkObject import PlinkObject
+from .bgenCodecs import get_codec
+from .stats import ParserStats
 from . import errors_codes as ec
+from . import kernels as kn
 from . import misc as mc
 
+from threading import Lock, local
 from pathlib import Path
+from io import BytesIO
 import numpy as np
-import sqlite3
 import struct
-import zlib
-import zstd
+import os
 
 
 class BgenObject:
     def __init__(self, file_path, bgi_present=True, probability_return=None, probability=0.9, sample_path=None,
-                 iid_index=slice(None, None, None), sid_index=slice(None, None, None),
-                 ):
+                 iid_index=slice(None, None, None), sid_index=slice(None, None, None), hard_call_return=None,
+                 stats=None, sidecar=None, codec=None):
         """
 
         :param file_path:
 
         :param bgi_present: Takes a value of True if the .bgi is in the same directory and named file_path.bgi
-            otherwise can ec passed as a path if it is in a different directory.
+            otherwise can ec passed as a path if it is in a different directory. If False, the variant headers are
+            scanned into an in memory VariantTable the first time they are needed instead.
         :type bgi_present: bool | str
 
         :param iid_index: The default slice or np.ndarray that was create from getitem for the iid
@@ -29,37 +40,69 @@ class BgenObject:
         :type sid_index: slice | np.ndarray
 
         :param probability:
+
+        :param hard_call_return: If True, return the most likely genotype as a count of the second allele rather than
+            the dosage, with calls below probability set to NaN
+        :type hard_call_return: bool | None
+
+        :param stats: Records per stage timers and counters of the work done, shared with any sliced views. A new one is
+            created if not provided
+        :type stats: ParserStats | None
+
+        :param sidecar: Takes a value of True if a sidecar made by create_sidecar is in the same directory and named
+            file_path.vti, otherwise can be passed as a path. If set, variants are looked up from the memory mapped
+            sidecar rather than the .bgi
+        :type sidecar: bool | str | Path | None
+
+        :param codec: The backend decompressing genotype blocks from bgenCodecs.BACKENDS, such as isal, libdeflate or
+            zlib for zlib files and zstandard or zstd for zstd files. Defaults to the fastest installed
+        :type codec: str | None
         """
 
         # Construct paths
         self.file_path = Path(file_path)
-        self._bgen_binary = open(file_path, "rb")
         self._sample_path = sample_path
+        self.stats = stats if stats is not None else ParserStats()
+        self._codec = codec
 
         # Set indexers
         self.iid_index = iid_index
         self.sid_index = sid_index
 
         # Extract from header
-        self._offset, self._headers_size, self._variant_number, self._sample_number, self._compression, \
-            self._compressed, self._layout, self._sample_identifiers, self._variant_start = self._parse_header()
+        with open(self.file_path, "rb") as bgen_binary:
+            self._offset, self._headers_size, self._variant_number, self._sample_number, self._compression, \
+                self._compressed, self._layout, self._sample_identifiers, self._variant_start = \
+                self._parse_header(bgen_binary)
 
         # Index our sid and iid values if we have indexes, else the value is the same as variant/sample_number
         self.iid_count = len(np.arange(self._sample_number)[self.iid_index])
         self.sid_count = len(np.arange(self._variant_number)[self.sid_index])
 
+        # The samples to decode, or None when every sample is requested in file order so no selection is needed
+        self._samples = self._set_samples()
+
         # Store numbers for altering functionality
         self._probability_return = probability_return
         self._probability = probability
+        self._hard_call_return = hard_call_return
 
-        # Set the bgi file if present, and store this for indexing if required.
+        # Set the bgi file if present, and store this for indexing if required. Each thread queries the .bgi through
+        # its own read only connection, as sqlite connections and cursors cannot be shared between threads
         self._bgi_present = bgi_present
         self._bgi_file = mc.set_bgi(self._bgi_present, self.file_path)
+        self._thread_index = local()
         if self._bgi_file:
             self._bgen_connection, self._bgen_index, self._last_variant_block = self._connect_to_bgi_index()
+            self._thread_index.cursor = self._bgen_index
         else:
             self._bgen_connection, self._bgen_index, self._last_variant_block = None, None, None
-        self._bgen_binary.close()
+        self._variant_table = self._open_sidecar(mc.set_sidecar(sidecar, self.file_path))
+        self._table_lock = Lock()
+
+        # The identifiers of every sample within the file, held in a list shared with sliced views so whichever object
+        # calls iid_array first loads them for all of them
+        self._iid_table = [None]
 
     def __repr__(self):
         return f"Bgen iid:sid -> {self.iid_count}:{self.sid_count}"
@@ -70,8 +113,28 @@ class BgenObject:
         assert len(item) == 2, ec.slice_error(type(item), len(item))
         iid_slicer, sid_slicer = item
 
-        return BgenObject(self.file_path, self._bgi_present, self._probability_return, self._probability,
-                          self._sample_path, self._set_slice(iid_slicer), self._set_slice(sid_slicer, False))
+        sliced = BgenObject(self.file_path, self._bgi_present, self._probability_return, self._probability,
+                            self._sample_path, self._set_slice(iid_slicer), self._set_slice(sid_slicer, False),
+                            self._hard_call_return, self.stats, codec=self._codec)
+
+        # Share the scanned variant headers and sample identifiers so a sliced view does not need to read them again
+        sliced._variant_table = self._variant_table
+        sliced._iid_table = self._iid_table
+        return sliced
+
+    def _set_samples(self):
+        """
+        Decoding only gathers the samples within iid_index, so we store these as an array of indexes unless all samples
+        are requested in order
+
+        :return: The indexes of the samples to decode, or None for all samples
+        :rtype: np.ndarray | None
+        """
+        samples = np.arange(self._sample_number)[self.iid_index]
+        if len(samples) == self._sample_number and np.array_equal(samples, np.arange(self._sample_number)):
+            return None
+        else:
+            return samples
 
     def _set_slice(self, slice_object, iid=True):
         """
@@ -81,20 +144,19 @@ class BgenObject:
         :param slice_object: The slicing slice or list of indexes
         :type slice_object: slice | list
 
-        :return: Numpy array of indexes
-        :rtype: np.ndarray
+        :return: The slice, or a numpy array of indexes
+        :rtype: slice | np.ndarray
 
         :raises TypeError: If the slicer is not a slice or list
         """
 
+        # Slices are kept as is, so that indexing results that are shorter than the file, such as from snp names,
+        # does not fail when the full file was requested via :
         if isinstance(slice_object, slice):
-            if iid:
-                return np.arange(self._sample_number)[slice_object]
-            else:
-                return np.arange(self._variant_number)[slice_object]
+            return slice_object
 
         elif isinstance(slice_object, (list, np.ndarray)):
-            assert all([isinstance(index, (int, np.int32)) for index in slice_object]), ec.slice_list_type()
+            assert all([isinstance(index, (int, np.integer)) for index in slice_object]), ec.slice_list_type()
 
             # If failures are turned on in sid_to_index we will get negative indexes which we want to remove
             valid_values = [v for v in slice_object if v >= 0]
@@ -108,11 +170,7 @@ class BgenObject:
 
     def sid_array(self):
         """Construct an array of all the snps that exist in this file"""
-        assert self._bgen_index, ec.index_violation("sid_array")
-
-        # Fetching all the seek positions
-        self._bgen_index.execute("SELECT rsid FROM Variant")
-        return np.array([name for name in self._bgen_index.fetchall()])[self.sid_index].flatten()
+        return np.array([name for name in self._index_rows(["rsid"])])[self.sid_index].flatten()
 
     def iid_array(self):
         """
@@ -120,19 +178,28 @@ class BgenObject:
         been tested and am unsure if sex and missing stored in bgen as is with .sample files?
 
         If a path to the samples has been provided, then we can load the information within it. Sample files contain
-        both the FID and the IID as well as missing and sex allowing us more options akin to .fam files.
+        both the FID and the IID as well as missing and sex allowing us more options akin to .fam files, so the ID_1
+        and ID_2 of each sample are returned.
 
         If Nothing is provided, and nothing is embedded, we create a list of id's on then number of id's after indexing.
 
+        The identifiers of every sample are read once then held, and shared with sliced views, which only index them.
 
         :return: An array of id information
         """
-        if self._sample_identifiers:
-            return np.array(self._parse_sample_block())
-        elif self._sample_path:
-            raise NotImplementedError("Sorry this needs to be tested")
+        if self._iid_table[0] is None:
+            if self._sample_identifiers:
+                iid_table = self._parse_sample_block()
+            elif self._sample_path:
+                iid_table = mc.read_sample_file(self._sample_path)
+                assert len(iid_table) == self._sample_number, ec.sample_size_violation(
+                    self._sample_number, len(iid_table))
+            else:
+                iid_table = np.column_stack([np.arange(self._sample_number)] * 2)
+            self._iid_table[0] = iid_table
         else:
-            return np.array([[i, i] for i in np.arange(self._sample_number)[self.iid_index]])
+            self.stats.add("cache_hits")
+        return self._iid_table[0][self.iid_index]
 
     def sid_to_index(self, snps, set_failed=False):
         """Convert a list of snps to a array of indexes"""
@@ -155,14 +222,18 @@ class BgenObject:
             return np.array([i for i, snp in enumerate(self.sid_array()[self.sid_index]) if snp in set(snps)])
 
     def iid_to_index(self, iid_list, set_failed=False):
-        """Isolate the iid indexes of the iid in the iid_list"""
+        """
+        Isolate the iid indexes of the iid in the iid_list. As slicing is relative to the file, indexes are returned
+        relative to the file even if this object has already been sliced on iid.
+        """
         if set_failed:
             # todo implement it
             raise NotImplementedError("Sorry, set failed not yet implemented")
         else:
-            iid_indexed = self.iid_array()[self.iid_index]
+            iid_indexed = self.iid_array()
             iid_indexed_values = [self._index_idd(current_id, iid_indexed) for current_id in iid_list]
-            return np.array([iid for iid in iid_indexed_values if iid or iid == 0])
+            indexes = np.array([iid for iid in iid_indexed_values if iid or iid == 0], dtype=int)
+            return indexes if self._samples is None else self._samples[indexes]
 
     @staticmethod
     def _index_idd(current_id, iid_indexed):
@@ -184,128 +255,746 @@ class BgenObject:
 
     def info_array(self):
         """Return an array of all the variants in the bgen file"""
-        assert self._bgen_index, ec.index_violation("info_array")
-
-        self._bgen_index.execute("SELECT chromosome, position, rsid, allele1, allele2 FROM Variant")
+        rows = self._index_rows(["chromosome", "position", "rsid", "allele1", "allele2"])
         return np.array([Variant(chromosome, position, snp_id, a1, a2) for chromosome, position, snp_id, a1, a2
-                         in self._bgen_index.fetchall()])[self.sid_index]
+                         in rows])[self.sid_index]
+
+    def dosage_array(self, sparse=False, dtype=np.float32):
+        """
+        Extract all the dosage information in the array
 
-    def dosage_array(self):
-        """Extract all the dosage information in the array"""
-        assert self._bgen_index, ec.index_violation("dosage_array")
-        self._bgen_binary = open(self.file_path, "rb")
+        :param sparse: If True, return a SparseDosage of (iid, variants) decoded straight from the integer probabilities
+            rather than a dense array of (variants, iid), for rare variants whose dosage is mostly zero
+        :type sparse: bool
 
-        self._bgen_index.execute("SELECT file_start_position FROM Variant")
-        dosage = np.array([self._get_variant(seek[0], True) for seek in self._bgen_index.fetchall()])[self.sid_index]
-        self._bgen_binary.close()
-        return dosage
+        :param dtype: The type of the dense dosage, float32, float16 or uint8. uint8 is quantised dosage, see
+            kernels.quantised_dosage_kernel, computed in integers from the payload
+        :type dtype: type
+
+        :return: The dosage of every variant within sid_index
+        :rtype: np.ndarray | SparseDosage
+        """
+        blocks = self._variant_blocks()
+        if sparse:
+            return self._sparse_dosage(self._decode_blocks(blocks, sparse=True))
+        return np.array([dosage for _, dosage in self._decode_blocks(blocks, dtype=dtype)])
 
     def variant_array(self):
         """Return an array of all the variants, where a variant is both the info + dosage"""
-        assert self._bgen_index, ec.index_violation("variant_array")
-        self._bgen_binary = open(self.file_path, "rb")
-
-        self._bgen_index.execute("SELECT file_start_position FROM Variant")
-        variants = np.array([self._get_variant(seek[0]) for seek in self._bgen_index.fetchall()],
-                            dtype=object)
-
-        self._bgen_binary.close()
-        return self._index_variants(variants)
+        blocks = self._variant_blocks()
+        return self._index_variants(self._decode_blocks(blocks))
 
     def info_from_sid(self, snp_names):
         """Construct an array of variant identifiers for all the snps provided to snp_names"""
-        assert self._bgen_index, ec.index_violation("variant_info_from_sid")
-
-        # Select all the variants where the rsid is in the names provided
-        if len(snp_names) > 1:
-            self._bgen_index.execute(f"SELECT chromosome, position, rsid, allele1, allele2 FROM Variant"
-                                     f" WHERE rsid IN {tuple(snp_names)}")
-        elif len(snp_names) == 1:
-            self._bgen_index.execute(f"SELECT chromosome, position, rsid, allele1, allele2 FROM Variant"
-                                     f" WHERE rsid = '{snp_names[0]}'")
-        else:
-            print("No names passed - skipping")
-
+        rows = self._index_rows(["chromosome", "position", "rsid", "allele1", "allele2"], snp_names)
         return np.array([Variant(chromosome, position, snp_id, a1, a2) for chromosome, position, snp_id, a1, a2
-                         in self._bgen_index.fetchall()])[self.sid_index]
+                         in rows])[self.sid_index]
 
-    def dosage_from_sid(self, snp_names):
-        """Construct the dosage for all snps provide as a list or tuple of snp_names"""
-        self._set_snp_names_file_positions(snp_names)
+    def dosage_from_sid(self, snp_names, sparse=False, dtype=np.float32):
+        """
+        Construct the dosage for all snps provide as a list or tuple of snp_names, as a SparseDosage of (iid, variants)
+        if sparse is True, otherwise of dtype as in dosage_array
+        """
+        blocks = self._set_snp_names_file_positions(snp_names)
+        if sparse:
+            return self._sparse_dosage(self._decode_blocks(blocks, sparse=True)).select(self.sid_index)
 
-        dosage = np.array([self._get_variant(seek[0], True)[self.iid_index] for seek in self._bgen_index.fetchall()])
-        self._bgen_binary.close()
+        dosage = np.array([dosage for _, dosage in self._decode_blocks(blocks, dtype=dtype)])
         # todo This is causing errors in pgp, should we really be indexing on SID when we are taken a tuple of names?
         return dosage[self.sid_index]
 
+    def allele_dosage_from_sid(self, snp_names, return_alleles=False):
+        """
+        The expected count of every allele for all snps provided as a list or tuple of snp_names. Unlike dosage this
+        supports multi-allelic variants, so a list of (iid, alleles) arrays is returned with alleles in the order they
+        are stored within the file, being a1, a2 and then any further alleles. As a Variant only holds a1 and a2, the
+        alleles of each variant are also returned as a list of lists if return_alleles is True.
+        """
+        blocks = self._set_snp_names_file_positions(snp_names)
+        file_descriptor = mc.open_positional(self.file_path)
+        try:
+            alleles, dosage = [], []
+            for start, size in blocks:
+                binary = BytesIO(self._read_block(file_descriptor, start, size))
+                alleles.append(self._get_curr_variant_info(binary=binary, all_alleles=True)[1])
+                dosage.append(self._get_curr_variant_alleles(False, binary))
+        finally:
+            os.close(file_descriptor)
+        return (alleles, dosage) if return_alleles else dosage
+
+    def haplotype_from_sid(self, snp_names):
+        """
+        For phased files, the probability each haplotype carries an allele other than a1 for all snps provided as a list
+        or tuple of snp_names. Returns an array of (sid, iid, ploidy), where haplotypes beyond a sample's ploidy are NaN
+        """
+        blocks = self._set_snp_names_file_positions(snp_names)
+        haplotypes = [haplotype for _, haplotype in self._decode_blocks(blocks, haplotypes=True)]
+
+        # Variable ploidy may lead to different widths between variants, so pad to the widest
+        ploidy = max([haplotype.shape[1] for haplotype in haplotypes], default=0)
+        padded = np.full((len(haplotypes), self.iid_count, ploidy), np.nan, dtype=np.float32)
+        for i, haplotype in enumerate(haplotypes):
+            padded[i, :, :haplotype.shape[1]] = haplotype
+        return padded
+
     def variant_from_sid(self, snp_names):
         """Variant information for all snps within snp_names"""
-        self._set_snp_names_file_positions(snp_names)
-        variants = np.array([self._get_variant(seek[0]) for seek in self._bgen_index.fetchall()],
-                            dtype=object)
+        blocks = self._set_snp_names_file_positions(snp_names)
+        return self._index_variants(self._decode_blocks(blocks))[self.sid_index]
 
-        self._bgen_binary.close()
-        return self._index_variants(variants)
+    def iter_variants(self, batch_size=1000, prefetch=4, workers=None, sparse=False, dtype=np.float32):
+        """
+        Iterate through the variants within sid_index in batches, whilst a pool of background threads reads and
+        decompresses the following batches so that disk reads and decompression overlap with whatever is done with
+        each batch.
 
-    def _index_variants(self, variant):
-        """Variants need to be indexed after fetch all as it returns a tuple of np.ndarrays"""
-        return np.array([np.array((info, dosage[self.iid_index]), dtype=object) for info, dosage in variant]
-                        )[self.sid_index]
+        :param batch_size: The number of variants in each batch
+        :type batch_size: int
 
-    def _set_snp_names_file_positions(self, snp_names):
-        """A tuple of 1 will lead to sql crashing if using IN, so we need to account for length 1 arrays"""
-        assert self._bgen_index, ec.index_violation("dosage_from_sid")
-        self._bgen_binary = open(self.file_path, "rb")
-
-        # Select all the variants where the rsid is in the names provided
-        if len(snp_names) > 1:
-            self._bgen_index.execute(f"SELECT file_start_position FROM Variant WHERE rsid IN {tuple(snp_names)}")
-        elif len(snp_names) == 1:
-            self._bgen_index.execute(f"SELECT file_start_position FROM Variant WHERE rsid = '{snp_names[0]}'")
-        else:
+        :param prefetch: The number of batches to read ahead of the consumer
+        :type prefetch: int
+
+        :param workers: The number of background threads, defaults to prefetch
+        :type workers: int | None
+
+        :param sparse: If True, each batch of dosage or hard calls is a SparseDosage of (iid, variants)
+        :type sparse: bool
+
+        :param dtype: The type of the dense dosage, float32, float16 or uint8 as in dosage_array
+        :type dtype: type
+
+        :return: A generator of (variants, dosage) where variants is an array of Variant and dosage is an array of
+            (variants, iid), or of probabilities / hard calls if set
+        :rtype: Generator
+        """
+        blocks = self._variant_blocks()
+
+        # A file descriptor read positionally can be shared between the threads without them moving each others seek
+        file_descriptor = mc.open_positional(self.file_path)
+        try:
+            yield from mc.prefetch_map(lambda batch: self._read_variant_batch(file_descriptor, batch, sparse, dtype),
+                                       mc.batch_items(blocks, batch_size), workers, prefetch)
+        finally:
+            os.close(file_descriptor)
+
+    def dosage_chunks(self, chunk_size=1000, byte_budget=None, prefetch=2, sparse=False, dtype=np.float32):
+        """
+        Iterate through the variants within sid_index in contiguous chunks, decoding each chunk into a single
+        preallocated (iid, chunk) buffer that is reused for every chunk, so a full pass of the file runs in bounded
+        memory. The raw blocks of the following chunks are read in the background whilst the current chunk is used.
+
+        Note
+        -----
+        As the buffer is reused, the dosage yielded is overwritten by the next chunk so copy it if it needs keeping.
+
+        :param chunk_size: The number of variants in each chunk
+        :type chunk_size: int
+
+        :param byte_budget: If set, the chunk size is instead the number of variants whose dosage fit within this many
+            bytes
+        :type byte_budget: int | None
+
+        :param prefetch: The number of chunks to read ahead of the consumer
+        :type prefetch: int
+
+        :param sparse: If True, each chunk is instead a new SparseDosage of (iid, variants), so no buffer is allocated
+            and byte_budget is ignored
+        :type sparse: bool
+
+        :param dtype: The type of the buffer, float32, float16 or uint8 as in dosage_array, so smaller types fit more
+            variants within byte_budget
+        :type dtype: type
+
+        :return: A generator of (variants, dosage) where variants is an array of Variant and dosage is a view of the
+            buffer of (iid, variants), or of (iid, variants, 3) if returning probabilities
+        :rtype: Generator
+        """
+        if sparse:
+            yield from self.iter_variants(chunk_size, prefetch, 1, sparse=True)
+            return
+
+        blocks = self._variant_blocks()
+
+        dtype = mc.output_dtype(dtype)
+        width = 3 if self._probability_return else 1
+        chunk_size = mc.chunk_size_from_budget(chunk_size, byte_budget, self.iid_count * width * dtype.itemsize)
+        shape = (self.iid_count, chunk_size, 3) if self._probability_return else (self.iid_count, chunk_size)
+        buffer = np.empty(shape, dtype=dtype, order="F")
+
+        file_descriptor = mc.open_positional(self.file_path)
+        try:
+            for raw_blocks in mc.prefetch_map(lambda chunk: self._read_blocks(file_descriptor, chunk),
+                                              mc.batch_items(blocks, chunk_size), prefetch=prefetch):
+
+                variants = np.empty(len(raw_blocks), dtype=object)
+                for i, block in enumerate(raw_blocks):
+                    variants[i] = self._decode_block(block, buffer[:, i])[0]
+                yield variants, buffer[:, :len(raw_blocks)]
+        finally:
+            os.close(file_descriptor)
+
+    def as_hard_calls(self):
+        """A view of this bgen with the same slicing and stats that returns hard calls rather than dosage"""
+        return self._view(None, True)
+
+    def as_probabilities(self):
+        """A view of this bgen with the same slicing and stats that returns genotype probabilities rather than dosage"""
+        return self._view(True, None)
+
+    def _view(self, probability_return, hard_call_return):
+        """A new BgenObject with the same slicing, stats and variant table but returning a different output"""
+        view = BgenObject(self.file_path, self._bgi_present, probability_return, self._probability, self._sample_path,
+                          self.iid_index, self.sid_index, hard_call_return, self.stats, codec=self._codec)
+        view._variant_table = self._variant_table
+        view._iid_table = self._iid_table
+        return view
+
+    def variant_qc(self, batch_size=100, prefetch=4, workers=None):
+        """
+        Compute the minor allele frequency, call rate, Hardy Weinberg p value and the IMPUTE info and MaCH r2 scores of
+        every variant within sid_index, for the samples within iid_index, in a single streaming pass of the genotype
+        probabilities. Batches are read, decoded and summarised by a pool of background threads.
+
+        :param batch_size: The number of variants in each batch
+        :type batch_size: int
+
+        :param prefetch: The number of batches to summarise ahead of the consumer
+        :type prefetch: int
+
+        :param workers: The number of background threads, defaults to prefetch
+        :type workers: int | None
+
+        :return: A table of VariantTable.QC_COLUMNS, with a row for each variant
+        :rtype: VariantTable
+        """
+        return VariantTable.from_variant_qc(self._map_probabilities(
+            lambda variants, probs: (variants, kn.variant_qc_kernel(probs)), batch_size, prefetch, workers))
+
+    def sample_qc(self, batch_size=100, prefetch=4, workers=None):
+        """
+        Accumulate the missing rate, heterozygosity and dosage of every sample within iid_index over the variants within
+        sid_index in a single streaming pass, in memory proportional to the number of samples. Each batch is summed by a
+        pool of background threads into its own accumulator, which are merged as they complete.
+
+        :param batch_size: The number of variants in each batch
+        :type batch_size: int
+
+        :param prefetch: The number of batches to sum ahead of the merge
+        :type prefetch: int
+
+        :param workers: The number of background threads, defaults to prefetch
+        :type workers: int | None
+
+        :return: The accumulated sums, whose summary gives the statistics of each sample of iid_array
+        :rtype: SampleAccumulator
+        """
+        accumulator = SampleAccumulator(self.iid_count)
+        for batch_accumulator in self._map_probabilities(
+                lambda variants, probs: SampleAccumulator(self.iid_count).update(probs), batch_size, prefetch, workers):
+            accumulator.merge(batch_accumulator)
+        return accumulator
+
+    def polygenic_score(self, weights, batch_size=1000, prefetch=4, workers=None):
+        """
+        Score every sample within iid_index on one or more polygenic scores. The variants of the weights are resolved
+        to their position within the file with a single lookup of the index, and their alleles aligned to the weights
+        before any genotype data is read. Batches are then read in file order, with the batches of each chromosome
+        scored by a pool of background threads and summed.
+
+        Missing dosage are imputed as the mean dosage of the variant, and variants whose alleles do not include the
+        effect allele are skipped, being counted as score_mismatched within stats alongside score_variants. The weights
+        of an rsid with many rows are summed, each row after the first being counted as score_duplicates.
+
+        :param weights: The weights, or the path to a weight file of rsid, effect allele and weights
+        :type weights: ScoreWeights | Path | str
+
+        :param batch_size: The number of variants in each batch
+        :type batch_size: int
+
+        :param prefetch: The number of batches to score ahead of the sum
+        :type prefetch: int
+
+        :param workers: The number of background threads, defaults to prefetch
+        :type workers: int | None
+
+        :return: A float64 array of (iid, scores) of the score of each sample, in the order of weights.names
+        :rtype: np.ndarray
+        """
+        weights = ScoreWeights.load(weights)
+        rows = self._index_rows(["file_start_position", "size_in_bytes", "chromosome", "rsid", "allele1", "allele2"],
+                                weights.rsids)
+        blocks = np.array([row[:2] for row in rows], dtype=np.int64).reshape(-1, 2)
+        chromosome, rsid, a1, a2 = [np.array([row[i] for row in rows], dtype=object) for i in range(2, 6)]
+
+        variant_weights, offset, mismatched, duplicates = weights.align(rsid, a1, a2)
+        self.stats.add("score_variants", len(rows) - mismatched)
+        self.stats.add("score_mismatched", mismatched)
+        self.stats.add("score_duplicates", duplicates)
+
+        dosage_view = self._view(None, self._hard_call_return)
+
+        def score_batch(indexes):
+            _, dosage = dosage_view._read_variant_batch(file_descriptor, blocks[indexes])
+            with self.stats.time("score"):
+                return kn.score_kernel(dosage.reshape(len(indexes), self.iid_count), variant_weights[indexes])
+
+        scores = np.tile(offset, (self.iid_count, 1))
+        file_descriptor = mc.open_positional(self.file_path)
+        try:
+            for batch_scores in mc.prefetch_map(score_batch, mc.group_batches(chromosome, batch_size), workers,
+                                                prefetch):
+                scores += batch_scores
+        finally:
+            os.close(file_descriptor)
+        return scores
+
+    def _map_probabilities(self, function, batch_size, prefetch, workers):
+        """
+        Read the genotype probabilities of the variants within sid_index in batches, yielding function(variants, probs)
+        of each batch in order, where probs is an array of (variants, iid, 3). Batches are read, decoded and passed to
+        function by a pool of background threads, with the time spent within function recorded as the qc stage.
+        """
+        probabilities = self.as_probabilities()
+
+        def map_batch(batch):
+            variants, probs = probabilities._read_variant_batch(file_descriptor, batch)
+            with self.stats.time("qc"):
+                return function(variants, probs.reshape(len(variants), self.iid_count, 3))
+
+        file_descriptor = mc.open_positional(self.file_path)
+        try:
+            yield from mc.prefetch_map(map_batch, mc.batch_items(probabilities._variant_blocks(), batch_size), workers,
+                                       prefetch)
+        finally:
+            os.close(file_descriptor)
+
+    def to_plink(self, write_root, batch_size=1000, prefetch=4, workers=None, bim_bgi=True):
+        """
+        Convert the variants and samples within sid_index and iid_index into a .bed, .bim and .fam at write_root. Each
+        genotype is called as its most likely genotype, or missing if below probability. Batches are read, called and
+        packed by a pool of background threads whilst the completed batches are written in order, so the conversion
+        runs in bounded memory. Plink files only hold bi-allelic variants, so multi-allelic variants are skipped and
+        counted as variants_skipped within stats.
+
+        :param write_root: The path to write the plink files to, without a plink suffix
+        :type write_root: Path | str
+
+        :param batch_size: The number of variants in each batch
+        :type batch_size: int
+
+        :param prefetch: The number of batches to read ahead of the writer
+        :type prefetch: int
+
+        :param workers: The number of background threads, defaults to prefetch
+        :type workers: int | None
+
+        :param bim_bgi: If True, create the .bim.bgi of the written files
+        :type bim_bgi: bool
+
+        :return: Nothing, writes the files then stops
+        :rtype: None
+        """
+        hard_calls = self.as_hard_calls()
+
+        def encode_batch(batch):
+            blocks = hard_calls._read_blocks(file_descriptor, batch)
+            decoded = [hard_calls._decode_block(block) for block in blocks
+                       if len(self._get_curr_variant_info(binary=BytesIO(block), all_alleles=True)[1]) == 2]
+            self.stats.add("variants_skipped", len(blocks) - len(decoded))
+
+            variants = [variant for variant, _ in decoded]
+            calls = np.array([calls for _, calls in decoded], dtype=np.float32).reshape(len(decoded), self.iid_count)
+            with self.stats.time("encode"):
+                return variants, kn.bed_encode_kernel(calls)
+
+        file_descriptor = mc.open_positional(self.file_path)
+        try:
+            with open(f"{write_root}.bed", "wb") as bed, open(f"{write_root}.bim", "w") as bim:
+                # See https://www.cog-genomics.org/plink/1.9/formats#bed, the magic number and variant major mode
+                bed.write(b"\x6c\x1b\x01")
+                for variants, packed in mc.prefetch_map(encode_batch, mc.batch_items(hard_calls._variant_blocks(),
+                                                                                     batch_size), workers, prefetch):
+                    with self.stats.time("write"):
+                        bed.write(packed.tobytes())
+                        bim.writelines([f"{v.chromosome}\t{v.snp_id}\t0\t{v.bp_position}\t{v.a1}\t{v.a2}\n"
+                                        for v in variants])
+                    self.stats.add("bytes_written", packed.nbytes)
+        finally:
+            os.close(file_descriptor)
+
+        # Embedded sample identifiers are used as both the FID and IID, otherwise the FID and IID are the index
+        with open(f"{write_root}.fam", "w") as fam:
+            for sample in self.iid_array():
+                fid, iid = (sample, sample) if np.ndim(sample) == 0 else sample
+                fam.write(f"{fid}\t{iid}\t0\t0\t0\t-9\n")
+
+        if bim_bgi:
+            bgi_path = Path(f"{write_root}.bim.bgi")
+            if bgi_path.exists():
+                bgi_path.unlink()
+
+            plink = PlinkObject(write_root)
+            plink.create_bim_bgi()
+            plink.close_all()
+
+    def as_array(self, dtype=np.float32, chunk_variants=1000):
+        """
+        A lazy view of the dosage of the variants and samples within sid_index and iid_index as an array of
+        (variants, iid), as dosage_array would return, which only reads the blocks of the variants it is indexed by
+
+        :param dtype: The type of the dosage, float32, float16 or uint8 as in dosage_array
+        :type dtype: type
+
+        :param chunk_variants: The number of variants of each chunk described to schedulers such as Dask
+        :type chunk_variants: int
+
+        :return: The view
+        :rtype: GenotypeArray
+        """
+        # Read through a dosage view, so an object returning probabilities still gives a view of its dosage
+        dosage_view = self._view(None, self._hard_call_return)
+        return GenotypeArray((self.sid_count, self.iid_count), dosage_view._read_variant_indexes, dtype, chunk_variants)
+
+    def _read_variant_indexes(self, indexes, dtype=np.float32):
+        """
+        Read the dosage of the variants at indexes within sid_index, looking their blocks up from the variant table so
+        the index is only loaded once across reads
+
+        :return: The dosage as an array of (variants, iid)
+        :rtype: np.ndarray
+        """
+        rows = np.arange(self._variant_number)[self.sid_index][indexes]
+        table = self.variant_table()
+        blocks = np.column_stack([table.column("file_start_position", rows), table.column("size_in_bytes", rows)])
+
+        file_descriptor = mc.open_positional(self.file_path)
+        try:
+            return self._read_variant_batch(file_descriptor, blocks, dtype=dtype)[1].reshape(-1, self.iid_count)
+        finally:
+            os.close(file_descriptor)
+
+    def to_sample_major(self, write_path, chunk_samples=16, compression=1, memory_budget=2 ** 28, prefetch=4,
+                        workers=None):
+        """
+        Transpose the dosage of the variants and samples within sid_index and iid_index into a sample major store read
+        by SampleMajorStore, so every genotype of an individual is a single contiguous read. Dosage is stored
+        quantised as uint8, see kernels.quantised_dosage_kernel, and the transpose runs in bounded memory.
+
+        :param write_path: The path to write the store to
+        :type write_path: Path | str
+
+        :param chunk_samples: The number of samples compressed together, which are decompressed as a whole to read any
+            one of them
+        :type chunk_samples: int
+
+        :param compression: 0 for uncompressed, which can be memory mapped, 1 for zlib, 2 for zstd
+        :type compression: int
+
+        :param memory_budget: The bytes the batches of variants being transposed may take, including those read ahead
+        :type memory_budget: int
+
+        :param prefetch: The number of batches to read ahead of the transpose
+        :type prefetch: int
+
+        :param workers: The number of background threads, defaults to prefetch
+        :type workers: int | None
+
+        :return: Nothing, writes the store then stops
+        :rtype: None
+        """
+        # Each genotype takes four bytes decoded and one quantised
+        batch_size = mc.chunk_size_from_budget(None, memory_budget // (prefetch + 1), self.iid_count * 5)
+        write_sample_major(write_path, self._dosage_batches(batch_size, 0, prefetch, workers), self.iid_count,
+                           self.sid_count, chunk_samples, compression, self.stats)
+
+    def _dosage_batches(self, batch_size, first_batch=0, prefetch=4, workers=None):
+        """
+        The dosage of each batch of variants within sid_index, as an array of (variants, iid), from first_batch onwards
+        so a pass that was interrupted can be resumed from the batch it reached. Batches are read and decoded by a pool
+        of background threads. Batches are read through a dosage view, so this returns dosage even if this object
+        returns probabilities.
+        """
+        blocks = self._variant_blocks()[first_batch * batch_size:]
+        dosage_view = self._view(None, self._hard_call_return)
+
+        file_descriptor = mc.open_positional(self.file_path)
+        try:
+            yield from mc.prefetch_map(lambda batch: dosage_view._read_variant_batch(file_descriptor, batch)[1],
+                                       mc.batch_items(blocks, batch_size), workers, prefetch)
+        finally:
+            os.close(file_descriptor)
+
+    def _variant_blocks(self):
+        """The file start position and size in bytes of every variant within sid_index"""
+        rows = self._index_rows(["file_start_position", "size_in_bytes"])
+        return np.array(rows, dtype=np.int64).reshape(-1, 2)[self.sid_index]
+
+    def _read_blocks(self, file_descriptor, blocks):
+        """Read the raw bytes of each (file_start_position, size_in_bytes) variant block"""
+        return [self._read_block(file_descriptor, start, size) for start, size in blocks]
+
+    def _read_block(self, file_descriptor, start, size):
+        """Read the raw bytes of a variant block"""
+        with self.stats.time("read"):
+            block = mc.positional_read(file_descriptor, int(start), int(size))
+        self.stats.add("bytes_read", len(block))
+        return block
+
+    def _decode_blocks(self, blocks, haplotypes=None, sparse=False, dtype=np.float32):
+        """
+        Read and decode each (file_start_position, size_in_bytes) variant block in turn
+
+        :param blocks: The file start position and size in bytes of each variant
+        :type blocks: np.ndarray | list
+
+        :param haplotypes: If None, decode the dosage. Otherwise decode the allele dosage, or haplotypes if True
+        :type haplotypes: bool | None
+
+        :param sparse: If True, decode the dosage as sparse columns
+        :type sparse: bool
+
+        :param dtype: The type of the dense dosage
+        :type dtype: type
+
+        :return: A list of the Variant and decoded data of each block
+        :rtype: list
+        """
+        file_descriptor = mc.open_positional(self.file_path)
+        try:
+            return [self._decode_block(self._read_block(file_descriptor, start, size), haplotypes=haplotypes,
+                                       sparse=sparse, dtype=dtype) for start, size in blocks]
+        finally:
+            os.close(file_descriptor)
+
+    def _index_rows(self, columns, snp_names=None):
+        """
+        Fetch columns of the Variant table for all variants, or only those whose rsid is within snp_names, in file
+        order. Rows come from the variant table if it has been loaded, such as from a sidecar, then from the .bgi if
+        there is one, otherwise from the in memory variant table scanned from the file.
+
+        :param columns: The names of the columns of the Variant table to fetch
+        :type columns: list[str]
+
+        :param snp_names: The rsids of the variants to fetch, or None for all variants
+        :type snp_names: list | np.ndarray | None
+
+        :return: The rows
+        :rtype: list
+        """
+        if snp_names is not None and len(snp_names) == 0:
             print("No names passed - skipping")
+            return []
+
+        if self._variant_table is None and self._bgen_index:
+            sql = f"SELECT {', '.join(columns)} FROM Variant"
+
+            # A tuple of 1 will lead to sql crashing if using IN, so we need to account for length 1 arrays
+            if snp_names is not None and len(snp_names) > 1:
+                sql += f" WHERE rsid IN {tuple(snp_names)}"
+            elif snp_names is not None:
+                sql += f" WHERE rsid = '{snp_names[0]}'"
+            return self._query(sql)
 
-    def _get_variant(self, seek, dosage=False):
+        table = self.variant_table()
+        with self.stats.time("index"):
+            rows = table.rows(columns, None if snp_names is None else table.rsid_indexes(snp_names))
+        self.stats.add("index_rows", len(rows))
+        return rows
 
+    def variant_table(self):
         """
-        Use the index of seek to move to the location of the variant in the file, then return the variant as Variant
+        The in memory VariantTable of this file's variant headers, scanned from the file the first time it is requested
+        so that a bgen without a .bgi can still be read. If a .bgi is set, it is loaded from the .bgi instead.
+
+        :return: The variant table
+        :rtype: VariantTable
+        """
+        with self._table_lock:
+            if self._variant_table is None:
+                if self._bgen_index:
+                    self._variant_table = VariantTable.from_rows(self._query(
+                        f"SELECT {', '.join(VariantTable.COLUMNS)} FROM Variant"))
+                else:
+                    self._variant_table = self._scan_variant_headers()
+            else:
+                self.stats.add("cache_hits")
+        return self._variant_table
+
+    def create_sidecar(self, write_path=None):
         """
-        self._bgen_binary.seek(seek)
-        variant = self._get_curr_variant_info()
+        Write the variant table as a sidecar, a compact binary index that can be memory mapped, which is quicker to open
+        and query than the .bgi. The table is taken from the .bgi if there is one, otherwise it is scanned from the
+        file.
 
-        if dosage:
-            return self._get_curr_variant_data()
+        :param write_path: The path to write the sidecar to, defaults to file_path.vti
+        :type write_path: Path | str | None
+
+        :return: The path the sidecar was written to
+        :rtype: Path
+        """
+        write_path = Path(f"{self.file_path.absolute()}.vti") if write_path is None else Path(write_path)
+        self.variant_table().to_sidecar(write_path)
+        return write_path
+
+    def _open_sidecar(self, sidecar_path):
+        """Open the sidecar if one was requested, checking it holds the variants of this file"""
+        if sidecar_path is None:
+            return None
+
+        with self.stats.time("index"):
+            table = VariantTable.from_sidecar(sidecar_path)
+        first_position = int(table.column("file_start_position")[0]) if len(table) else self._variant_start
+        assert len(table) == self._variant_number and first_position == self._variant_start, \
+            ec.sidecar_violation(sidecar_path, self._variant_number, len(table), first_position, self._variant_start)
+        return table
+
+    def _scan_variant_headers(self):
+        """
+        Scan the header of each variant block in turn, using the size of each genotype data block to skip over it
+        without reading it, to construct the same information a .bgi would hold.
+
+        Spec at https://www.well.ox.ac.uk/~gav/bgen_format/spec/latest.html
+
+        :return: The variant table
+        :rtype: VariantTable
+        """
+        rows = []
+        with self.stats.time("scan"), open(self.file_path, "rb", buffering=1 << 20) as binary:
+            binary.seek(self._variant_start)
+            for _ in range(self._variant_number):
+                start_position = binary.tell()
+                variant = self._get_curr_variant_info(as_list=True, binary=binary)
+
+                # Layout 1 uncompressed blocks have no size and hold 3 two byte probabilities for each sample
+                if self._layout == 1 and not self._compressed:
+                    dosage_size = 6 * self._sample_number
+                else:
+                    dosage_size = self._unpack("<I", 4, binary=binary)
+
+                binary.seek(dosage_size, 1)
+                rows.append([start_position, binary.tell() - start_position] + variant)
+
+        self.stats.add("variants_scanned", len(rows))
+        return VariantTable.from_rows(rows)
+
+    def _index_cursor(self):
+        """The cursor of this thread's read only connection to the .bgi, connecting on the first query of the thread"""
+        cursor = getattr(self._thread_index, "cursor", None)
+        if cursor is None:
+            cursor = mc.connect_read_only(self._bgi_path()).cursor()
+            self._thread_index.cursor = cursor
+        return cursor
+
+    def _bgi_path(self):
+        """The path to the .bgi, which is either provided as bgi_present or is file_path.bgi"""
+        if isinstance(self._bgi_present, str):
+            return Path(self._bgi_present)
+        return Path(f"{self.file_path.absolute()}.bgi")
+
+    def _query(self, sql):
+        """
+        Execute a query against the index and fetch all of its rows
+
+        :param sql: The query
+        :type sql: str
+
+        :return: The rows
+        :rtype: list
+        """
+        with self.stats.time("sql"):
+            rows = self._index_cursor().execute(sql).fetchall()
+        self.stats.add("sql_rows", len(rows))
+        return rows
+
+    def _read_variant_batch(self, file_descriptor, blocks, sparse=False, dtype=np.float32):
+        """
+        Read and decode a batch of variant blocks, which holds no state on the object so can be run within threads
+
+        :param file_descriptor: A file descriptor from mc.open_positional
+        :type file_descriptor: int
+
+        :param blocks: An array of (file_start_position, size_in_bytes) of each variant
+        :type blocks: np.ndarray
+
+        :param sparse: If True, return the dosage as a SparseDosage
+        :type sparse: bool
+
+        :param dtype: The type of the dense dosage
+        :type dtype: type
+
+        :return: An array of Variant, and the dosage of these variants
+        :rtype: (np.ndarray, np.ndarray | SparseDosage)
+        """
+        decoded = [self._decode_block(block, sparse=sparse, dtype=dtype)
+                   for block in self._read_blocks(file_descriptor, blocks)]
+
+        variants = np.empty(len(decoded), dtype=object)
+        variants[:] = [variant for variant, _ in decoded]
+        if sparse:
+            return variants, self._sparse_dosage(decoded)
+        return variants, np.array([dosage for _, dosage in decoded])
+
+    def _sparse_dosage(self, decoded):
+        """The SparseDosage of the sparse columns of a list of decoded (Variant, column)"""
+        return SparseDosage.from_columns([column for _, column in decoded], self.iid_count)
+
+    def _decode_block(self, block, out=None, haplotypes=None, sparse=False, dtype=np.float32):
+        """
+        Decode a variant block that has already been read into memory as its Variant and dosage, or its allele dosage
+        or haplotypes if haplotypes is not None, or its dosage as a sparse column if sparse. The dosage is written into
+        out if given, otherwise into a new array of dtype.
+        """
+        binary = BytesIO(block)
+        variant = self._get_curr_variant_info(binary=binary)
+
+        if haplotypes is None:
+            if out is None and not sparse:
+                out = np.empty((self.iid_count, 3) if self._probability_return else self.iid_count,
+                               dtype=mc.output_dtype(dtype))
+            return variant, self._get_curr_variant_data(binary, out, sparse)
         else:
-            return variant, self._get_curr_variant_data()
+            return variant, self._get_curr_variant_alleles(haplotypes, binary)
 
-    def _get_curr_variant_info(self, as_list=False):
-        """Gets the current variant's information."""
+    @staticmethod
+    def _index_variants(variant):
+        """Variants are returned as an array of (Variant, dosage) arrays"""
+        return np.array([np.array((info, dosage), dtype=object) for info, dosage in variant])
+
+    def _set_snp_names_file_positions(self, snp_names):
+        """The file start position and size in bytes of each variant whose rsid is within snp_names"""
+        return self._index_rows(["file_start_position", "size_in_bytes"], snp_names)
+
+    def _get_curr_variant_info(self, as_list=False, binary=None, all_alleles=False):
+        """
+        Gets the current variant's information. a2 is always the second allele, as bgenix indexes it, so a
+        multi-allelic variant also returns the list of all its alleles alongside if all_alleles is True
+        """
 
         if self._layout == 1:
-            assert self._unpack("<I", 4) == self.iid_count, ec
+            assert self._unpack("<I", 4, binary=binary) == self.iid_count, ec
 
         # Reading the variant id (may be in form chr1:8045045:A:G or just a duplicate of rsid and not used currently)
-        self._read_bgen("<H", 2)
+        self._read_bgen("<H", 2, binary)
 
         # Reading the variant rsid
-        rs_id = self._read_bgen("<H", 2)
+        rs_id = self._read_bgen("<H", 2, binary)
 
         # Reading the chromosome
-        chromosome = self._read_bgen("<H", 2)
+        chromosome = self._read_bgen("<H", 2, binary)
 
         # Reading the position
-        pos = self._unpack("<I", 4)
+        pos = self._unpack("<I", 4, binary=binary)
 
         # Getting the alleles
-        alleles = [self._read_bgen("<I", 4) for _ in range(self._set_number_of_alleles())]
+        alleles = [self._read_bgen("<I", 4, binary) for _ in range(self._set_number_of_alleles(binary))]
 
-        # Return the Variant - currently only supports first two alleles
         if as_list:
-            return [chromosome, pos, rs_id, alleles[0], alleles[1]]
+            variant = [chromosome, pos, rs_id, alleles[0], alleles[1]]
         else:
-            return Variant(chromosome, pos, rs_id, alleles[0], alleles[1])
+            variant = Variant(chromosome, pos, rs_id, alleles[0], alleles[1])
+        return (variant, alleles) if all_alleles else variant
 
-    def _set_number_of_alleles(self):
+    def _set_number_of_alleles(self, binary=None):
         """
         Bgen version 2 can allow for more than 2 alleles, so if it is version 2 then unpack the number stored else
         return 2
@@ -313,63 +1002,130 @@ class BgenObject:
         :rtype: int
         """
         if self._layout == 2:
-            return self._unpack("<H", 2)
+            return self._unpack("<H", 2, binary=binary)
         else:
             return 2
 
-    def _get_curr_variant_data(self):
-        """Gets the current variant's dosage or probabilities."""
+    def _get_curr_variant_data(self, binary=None, out=None, sparse=False):
+        """
+        Gets the current variant's dosage or probabilities.
+
+        :param binary: The stream to read from, such as a BytesIO of a variant block
+        :type binary: BinaryIO
+
+        :param out: A buffer of (iid) or (iid, 3) if returning probabilities to write into, otherwise a new float32
+            array is allocated. A uint8 buffer is written as quantised dosage
+        :type out: np.ndarray | None
+
+        :param sparse: If True, return the dosage or hard calls as the sparse column of kernels.sparse_dosage_kernel
+            and ignore out
+        :type sparse: bool
+
+        :return: The dosage or probabilities
+        :rtype: np.ndarray | (np.ndarray, np.ndarray, np.ndarray)
+        """
+        assert not (sparse and self._probability_return), ec.sparse_probability_violation()
 
         if self._layout == 1:
             print("WARNING - UNTESTED CODE FROM PY-BGEN")
             # Getting the probabilities
-            probs = self._get_curr_variant_probs_layout_1()
+            probs = self._get_curr_variant_probs_layout_1(binary)
+            if self._samples is not None:
+                probs = probs[self._samples]
 
             if self._probability_return:
                 # Returning the probabilities
-                return probs
+                data = probs
 
             else:
                 # Returning the dosage
-                return self._layout_1_probs_to_dosage(probs)
+                data = self._layout_1_probs_to_dosage(probs)
+
+            if sparse:
+                return kn.sparse_column(data)
+            if out is None:
+                return data
+            if out.dtype == np.uint8:
+                assert not self._probability_return, ec.quantised_probability_violation()
+                return kn.quantise_dosage(data, out)
+            out[:] = data
+            return out
 
         else:
-            # Getting the probabilities
-            probs, missing_data = self._get_curr_variant_probs_layout_2()
+            # Getting the integer probabilities, which the kernels convert straight into float32 outputs
+            probs, missing_data, b, ploidy, phased, nb_alleles = self._get_curr_variant_probs_layout_2(binary)
+            with self.stats.time("decode"):
+                return self._layout_2_kernel(probs, missing_data, b, ploidy, phased, nb_alleles, out, sparse)
 
-            if self._probability_return:
-                # Getting the alternative allele homozygous probabilities
-                last_probs = self._get_layout_2_last_probs(probs)
+    def _layout_2_kernel(self, probs, missing_data, b, ploidy, phased, nb_alleles, out, sparse=False):
+        """Convert the integer probabilities of a layout 2 block with the kernel for the output requested"""
+        self.stats.add("blocks_decoded")
+        cutoff = kn.quality_cutoff(self._probability, b)
 
-                # Stacking the probabilities
-                last_probs.shape = (last_probs.shape[0], 1)
-                full_probs = np.hstack((probs, last_probs))
+        if sparse:
+            if self._standard_block(ploidy, phased, nb_alleles):
+                return kn.sparse_dosage_kernel(probs, b, missing_data, cutoff, bool(self._hard_call_return))
 
-                # Setting the missing to NaN
-                full_probs[missing_data] = np.nan
+            # Other blocks have no dedicated sparse kernel, so their dense column is split instead
+            return kn.sparse_column(self._layout_2_kernel(probs, missing_data, b, ploidy, phased, nb_alleles, None))
 
-                # Returning the probabilities
-                return full_probs
+        # The sparse and quantised fallbacks decode a dense column with out of None, which is allocated below
+        if out is not None and out.dtype == np.uint8:
+            assert not self._probability_return, ec.quantised_probability_violation()
+            if self._standard_block(ploidy, phased, nb_alleles):
+                return kn.quantised_dosage_kernel(probs, b, missing_data, cutoff, out, bool(self._hard_call_return))
 
-            else:
-                # Computing the dosage
-                dosage = self._layout_2_probs_to_dosage(probs)
+            # Other blocks have no dedicated quantised kernel, so their dense column is quantised instead
+            return kn.quantise_dosage(self._layout_2_kernel(probs, missing_data, b, ploidy, phased, nb_alleles, None),
+                                      out)
 
-                # Setting the missing to NaN
-                dosage[missing_data] = np.nan
+        if out is None:
+            out = np.empty((len(ploidy), 3) if self._probability_return else len(ploidy), dtype=np.float32)
 
-                # Returning the dosage
-                return dosage
+        if not self._standard_block(ploidy, phased, nb_alleles):
+            assert not self._probability_return, ec.genotype_probability_violation(self.file_path.name)
+            return kn.general_dosage_kernel(probs, b, ploidy, missing_data, phased, nb_alleles, cutoff, out,
+                                            self._hard_call_return)
 
-    def _get_curr_variant_probs_layout_1(self):
+        elif self._probability_return:
+            return kn.probability_kernel(probs, b, missing_data, out)
+
+        elif self._hard_call_return:
+            return kn.hard_call_kernel(probs, b, missing_data, cutoff, out)
+
+        else:
+            return kn.dosage_kernel(probs, b, missing_data, cutoff, out)
+
+    def _get_curr_variant_alleles(self, haplotypes=False, binary=None):
+        """
+        Gets the current variant's expected count of each allele, or for phased data the probability that each haplotype
+        carries an allele other than the first
+        """
+        assert self._layout == 2, ec.layout_violation(self.file_path.name, self._layout)
+        probs, missing_data, b, ploidy, phased, nb_alleles = self._get_curr_variant_probs_layout_2(binary)
+
+        if haplotypes:
+            assert phased, ec.phased_violation(self.file_path.name)
+            return kn.haplotype_kernel(probs.ravel(), b, ploidy, missing_data, nb_alleles,
+                                       np.empty((len(ploidy), ploidy.max(initial=0)), dtype=np.float32))
+        else:
+            return kn.allele_dosage_kernel(probs.ravel(), b, ploidy, missing_data, phased, nb_alleles,
+                                           np.empty((len(ploidy), nb_alleles), dtype=np.float32))
+
+    @staticmethod
+    def _standard_block(ploidy, phased, nb_alleles):
+        """If a layout 2 block is unphased, bi-allelic and diploid for every sample, which has dedicated kernels"""
+        return (not phased) and (nb_alleles == 2) and bool(np.all(ploidy == 2))
+
+    def _get_curr_variant_probs_layout_1(self, binary=None):
         """Gets the current variant's probabilities (layout 1)."""
         c = self._sample_number
         if self._compressed:
-            c = self._unpack("<I", 4)
+            c = self._unpack("<I", 4, binary=binary)
 
         # Getting the probabilities
         probs = np.frombuffer(
-            self._compression(self._bgen_binary.read(c)),
+            self._compression.decompress(binary.read(c), 6 * self._sample_number),
             dtype="u2",
         ) / 32768
         probs.shape = (self._sample_number, 3)
@@ -385,10 +1141,11 @@ class BgenObject:
 
         return dosage
 
-    def _get_curr_variant_probs_layout_2(self):
+    def _get_curr_variant_probs_layout_2(self, binary=None):
         """Gets the current variant's probabilities (layout 2)."""
+
         # The total length C of the rest of the data for this variant
-        c = self._unpack("<I", 4)
+        c = self._unpack("<I", 4, binary=binary)
 
         # The number of bytes to read
         to_read = c
@@ -398,11 +1155,14 @@ class BgenObject:
         if self._compressed:
             # The total length D of the probability data after
             # decompression
-            d = self._unpack("<I", 4)
+            d = self._unpack("<I", 4, binary=binary)
             to_read = c - 4
 
-        # Reading the data and checking
-        data = self._compression(self._bgen_binary.read(to_read))
+        # Reading the data and checking, as a memoryview so that moving through the payload does not copy it
+        raw = binary.read(to_read)
+        with self.stats.time("decompress"):
+            data = memoryview(self._compression.decompress(raw, d))
+        self.stats.add("bytes_decompressed", len(data))
         assert len(data) == d, "INVALID HERE"
 
         # Checking the number of samples
@@ -411,182 +1171,164 @@ class BgenObject:
 
         data = data[4:]
 
-        # Checking the number of alleles (we only accept 2 alleles)
+        # Checking the number of alleles
         nb_alleles = mc.struct_unpack("<H", data[:2])
-        assert nb_alleles == 2, "INVALID HERE"
         data = data[2:]
 
-        # TODO: Check ploidy for sexual chromosomes
-        # The minimum and maximum for ploidy (we only accept ploidy of 2)
+        # The minimum and maximum for ploidy, which are 0 to 63 so we can skip reading each sample's ploidy if the two
+        # are equal
         min_ploidy = mc.byte_to_int(data[0])
         max_ploidy = mc.byte_to_int(data[1])
-        if min_ploidy != 2 and max_ploidy != 2:
-            raise ValueError("INVALID HERE")
-
         data = data[2:]
 
-        # Check the list of N bytes for missingness (since we assume only
-        # diploid values for each sample)
+        # The list of N bytes, where the least significant 6 bits are the ploidy and the most significant is missingness
         ploidy_info = np.frombuffer(data[:n], dtype=np.uint8)
-        ploidy_info = np.unpackbits(
-            ploidy_info.reshape(1, ploidy_info.shape[0]).T,
-            axis=1,
-        )
-        missing_data = ploidy_info[:, 0] == 1
+        if min_ploidy == max_ploidy:
+            ploidy = np.full(n, min_ploidy, dtype=np.uint8)
+        else:
+            ploidy = ploidy_info & 63
         data = data[n:]
 
-        # TODO: Permit phased data
+        # Only gather the ploidy bytes of the samples requested via iid_index
+        if self._samples is not None:
+            ploidy_info = ploidy_info[self._samples]
+        missing_data = (ploidy_info & 128) != 0
+
         # Is the data phased?
         is_phased = data[0] == 1
-        if is_phased:
-            raise ValueError(
-                "{}: only accepting unphased data".format("INVALID")
-            )
         data = data[1:]
 
         # The number of bits used to encode each probabilities
         b = mc.byte_to_int(data[0])
         data = data[1:]
 
-        # Reading the probabilities (don't forget we allow only for diploid
-        # values)
-        if b == 8:
-            probs = np.frombuffer(data, dtype=np.uint8)
-
-        elif b == 16:
-            probs = np.frombuffer(data, dtype=np.uint16)
-
-        elif b == 32:
-            probs = np.frombuffer(data, dtype=np.uint32)
-
+        # Reading the integer probabilities, these are left as integers so the kernels can convert them in a single
+        # pass. Unphased bi-allelic diploid data is shaped as (samples, 2) for the dedicated kernels.
+        standard = self._standard_block(ploidy, is_phased, nb_alleles)
+        if standard:
+            count = n * 2
+        else:
+            count = int(kn.values_per_sample(ploidy, is_phased, nb_alleles).sum())
+
+        # If we only want a subset of samples, then we only unpack the probabilities of those samples
+        if self._samples is None:
+            probs = kn.unpack_probabilities(data, b, count)
+        elif standard:
+            indexes = (self._samples[:, None] * 2 + np.arange(2)).ravel()
+            probs = kn.unpack_probabilities(data, b, count, indexes)
+            ploidy = ploidy[self._samples]
         else:
-            probs = mc.pack_bits(data, b)
+            indexes = kn.sample_value_indexes(ploidy, is_phased, nb_alleles, self._samples)
+            probs = kn.unpack_probabilities(data, b, count, indexes)
+            ploidy = ploidy[self._samples]
 
-        # Changing shape and computing dosage
-        probs.shape = (self._sample_number, 2)
+        # The kernels check the ploidy of the samples requested, which may all be diploid within a variable ploidy
+        # block, so the shape is set from this rather than from the ploidy of every sample
+        if self._standard_block(ploidy, is_phased, nb_alleles):
+            probs = probs.reshape(-1, 2)
 
-        return probs / (2 ** b - 1), missing_data
+        return probs, missing_data, b, ploidy, is_phased, nb_alleles
 
-    @staticmethod
-    def _get_layout_2_last_probs(probs):
-        """
-        Gets the layout 2 last probabilities (homo alternative).
-        :rtype: np.ndarray
-        """
-        return 1 - np.sum(probs, axis=1)
-
-    def _layout_2_probs_to_dosage(self, probs):
-        """Transforms probability values to dosage (from layout 2)."""
-        # Computing the last genotype's probabilities
-        last_probs = self._get_layout_2_last_probs(probs)
-
-        # Constructing the dosage
-        dosage = 2 * last_probs + probs[:, 1]
-
-        # Setting low quality to NaN
-        if self._probability > 0:
-            good_probs = (
-                    np.any(probs >= self._probability, axis=1) |
-                    (last_probs >= self._probability)
-            )
-            dosage[~good_probs] = np.nan
-
-        return dosage
-
-    def _parse_header(self):
+    def _parse_header(self, binary):
         """
         Extract information from the header of the bgen file.
 
         Spec at https://www.well.ox.ac.uk/~gav/bgen_format/spec/latest.html
 
+        :param binary: The bgen file, opened at its start
+        :type binary: BinaryIO
+
         :return: offset, headers, variant_number, sample_number, compression, layout, and sample_identifiers
         """
 
         # Check the header block is not larger than offset
-        offset = self._unpack("<I", 4)
-        headers_size = self._unpack("<I", 4)
-        assert headers_size <= offset, ec.offset_violation(self._bgen_binary.name, offset, headers_size)
+        offset = self._unpack("<I", 4, binary=binary)
+        headers_size = self._unpack("<I", 4, binary=binary)
+        assert headers_size <= offset, ec.offset_violation(binary.name, offset, headers_size)
         variant_start = offset + 4
 
         # Extract the number of variants and samples
-        variant_number = self._unpack("<I", 4)
-        sample_number = self._unpack("<I", 4)
+        variant_number = self._unpack("<I", 4, binary=binary)
+        sample_number = self._unpack("<I", 4, binary=binary)
 
         # Check the file is valid
-        magic = self._unpack("4s", 4)
-        assert (magic == b'bgen') or (struct.unpack("<I", magic)[0] == 0), ec.magic_violation(self._bgen_binary.name)
+        magic = self._unpack("4s", 4, binary=binary)
+        assert (magic == b'bgen') or (struct.unpack("<I", magic)[0] == 0), ec.magic_violation(binary.name)
 
         # Skip the free data area
-        self._bgen_binary.read(headers_size - 20)
+        binary.read(headers_size - 20)
 
         # Extract the flag, then set compression layout and sample identifiers from it
-        compression, compressed, layout, sample_identifiers = self._header_flag()
+        compression, compressed, layout, sample_identifiers = self._header_flag(binary)
         return (offset, headers_size, variant_number, sample_number, compression, compressed, layout,
                 sample_identifiers, variant_start)
 
-    def _header_flag(self):
+    def _header_flag(self, binary):
         """
         The flag represents a 4 byte unsigned int, where the bits relates to the compressedSNPBlock at bit 0-1, Layout
         at 2-5, and sampleIdentifiers at 31
 
         Spec at https://www.well.ox.ac.uk/~gav/bgen_format/spec/latest.html
 
-        :return: Compression, layout, sampleIdentifiers
+        :return: The BlockCodec of the compression, if compressed, layout, sampleIdentifiers
         """
         # Reading the flag
-        flag = np.frombuffer(self._bgen_binary.read(4), dtype=np.uint8)
+        flag = np.frombuffer(binary.read(4), dtype=np.uint8)
         flag = np.unpackbits(flag.reshape(1, flag.shape[0]), bitorder="little")
 
         # [N1] Bytes are stored right to left hence the reverse, see shorturl.at/cOU78
         # Check the compression of the data
         compression_flag = mc.bits_to_int(flag[0: 2][::-1])
-        assert 0 <= compression_flag < 3, ec.compression_violation(self._bgen_binary.name, compression_flag)
-        if compression_flag == 0:
-            compressed = False
-            compression = mc.no_decompress
-        elif compression_flag == 1:
-            compressed = True
-            compression = zlib.decompress
-        else:
-            compressed = True
-            compression = zstd.decompress
+        assert 0 <= compression_flag < 3, ec.compression_violation(binary.name, compression_flag)
+        compressed = compression_flag > 0
+
+        # Faster backends, and zstd itself, are optional dependencies so are only imported when a file needs them
+        try:
+            compression = get_codec(compression_flag, self._codec)
+        except ImportError:
+            if compression_flag == 2 and self._codec is None:
+                raise ImportError(ec.zstd_missing(binary.name))
+            raise
 
         # Check the layout is either 1 or 2, see [N1]
         layout = mc.bits_to_int(flag[2:6][::-1])
-        assert 1 <= layout < 3, ec.layout_violation(self._bgen_binary.name, layout)
+        assert 1 <= layout < 3, ec.layout_violation(binary.name, layout)
 
         # Check if the sample identifiers are in the file or not, then return
-        assert flag[31] == 0 or flag[31] == 1, ec.sample_identifier_violation(self._bgen_binary.name, flag[31])
+        assert flag[31] == 0 or flag[31] == 1, ec.sample_identifier_violation(binary.name, flag[31])
         if flag[31] == 0:
             return compression, compressed, layout, False
         else:
             return compression, compressed, layout, True
 
     def _parse_sample_block(self):
-        """Parses the sample block."""
-        self._bgen_binary = open(self.file_path, "rb")
-        self._parse_header()
-
-        # Getting the block size
-        block_size = self._unpack("<I", 4)
+        """
+        Parses the sample block, which follows the header block, in a single positional read then splits the length
+        prefixed identifiers with misc.length_prefixed_strings
+        """
+        file_descriptor = mc.open_positional(self.file_path)
+        try:
+            block = mc.positional_read(file_descriptor, 4 + self._headers_size, self._offset - self._headers_size)
+        finally:
+            os.close(file_descriptor)
+        self.stats.add("bytes_read", len(block))
+
+        # Getting the block size and checking the number of samples
+        block_size, n = mc.struct_unpack("<II", block[:8], list_return=True)
         assert block_size + self._headers_size == self._offset, ec.sample_block_violation(
             self._headers_size, self._offset, block_size)
-
-        # Checking the number of samples
-        n = self._unpack("<I", 4)
         assert n == self._sample_number, ec.sample_size_violation(self._sample_number, n)
 
         # Getting the sample information
-        samples = [self._read_bgen("<H", 2) for _ in range(self._sample_number)]
+        samples = mc.length_prefixed_strings(block[8:block_size], self._sample_number)
 
         # Check the samples extract are equal to the number present then return
-        self._bgen_binary.close()
         assert len(samples) == self._sample_number, ec.sample_size_violation(self._sample_number, len(samples))
         return samples
 
     def _connect_to_bgi_index(self):
         """Connect to the index (which is an SQLITE database)."""
-        bgen_file = sqlite3.connect(str(self.file_path.absolute()) + ".bgi")
+        bgen_file = mc.connect_read_only(self._bgi_path())
         bgen_index = bgen_file.cursor()
 
         # Fetching the number of variants and the first and last seek position
@@ -614,7 +1356,8 @@ class BgenObject:
 
     def create_bgi(self, bgi_write_path=None):
         """
-        Mimic bgenix .bgi via python
+        Mimic bgenix .bgi via python, persisting the variant table so later objects can be opened with the .bgi rather
+        than scanning the variant headers again
 
         Note
         -----
@@ -636,52 +1379,9 @@ class BgenObject:
         if Path(write_path).exists():
             print(f"Bgi Already exists for {self.file_path.name}")
         else:
-            # Establish the connection
-            connection = sqlite3.connect(write_path)
-            c = connection.cursor()
-
-            # Create our core table that mimics Variant bgi from bgenix
-            c.execute('''
-                 CREATE TABLE Variant (
-                 file_start_position INTEGER,
-                 size_in_bytes INTEGER,
-                 chromosome INTEGER,
-                 position INTEGER,
-                 rsid TEXT,
-                 allele1 TEXT,
-                 allele2 TEXT
-                   )''')
-
-            # Write values to table
-            self._bgen_binary = open(self.file_path, "rb")
-            self._bgen_binary.seek(self._variant_start)
-            for value in [self._set_bgi_lines() for _ in range(self.sid_count)]:
-                c.execute(f'INSERT INTO Variant VALUES {tuple(value)}')
-
-            # Commit the file
-            connection.commit()
-            connection.close()
-            self._bgen_binary.close()
-
-    def _set_bgi_lines(self):
-        """This will extract a given start position of the dosage, the size of the dosage, and the variant array"""
-        # Isolate the block start position
-        start_position = self._bgen_binary.tell()
-
-        # Extract the Bim information, Then append the start position and then bim information
-        variant = self._get_curr_variant_info(as_list=True)
-
-        # Get the dosage size, then skip this size + the current position to get the position of the next block
-        dosage_size = self._unpack("<I", 4)
-
-        # Calculate the variant size in bytes
-        size_in_bytes = (self._bgen_binary.tell() - start_position) + dosage_size
-
-        # Append this information to lines, then seek past the dosage block
-        self._bgen_binary.seek(self._bgen_binary.tell() + dosage_size)
-        return [start_position, size_in_bytes] + variant
-
-    def _read_bgen(self, struct_format, size):
+            self.variant_table().to_bgi(write_path)
+
+    def _read_bgen(self, struct_format, size, binary=None):
         """
         Sometimes we need to read the number of bytes read via unpack
 
@@ -692,12 +1392,15 @@ class BgenObject:
         :param size: The byte size
         :type size: int
 
+        :param binary: The stream to read from, such as a BytesIO of a variant block
+        :type binary: BinaryIO
+
         :return: Decoded bytes that where read
         """
-        return self._bgen_binary.read(self._unpack(struct_format, size)).decode()
+        return binary.read(self._unpack(struct_format, size, binary=binary)).decode()
 
     # todo: Update to use miscSupports instead
-    def _unpack(self, struct_format, size, list_return=False):
+    def _unpack(self, struct_format, size, list_return=False, binary=None):
         """
         Use a given struct formatting to unpack a byte code
 
@@ -716,10 +1419,13 @@ class BgenObject:
             only one element then we often just index the first element to return it directly. Defaults to false.
         :type list_return: bool
 
+        :key binary: The stream to read from, such as a BytesIO of a variant block
+        :type binary: BinaryIO
+
         :return: Whatever was unpacked
         :rtype: Any
         """
         if list_return:
-            return struct.unpack(struct_format, self._bgen_binary.read(size))
+            return struct.unpack(struct_format, binary.read(size))
         else:
-            return struct.unpack(struct_format, self._bgen_binary.read(size))[0]
+            return struct.unpack(struct_format, binary.read(size))[0]
@@ -0,0 +1,263 @@
+from .variantTable import VariantTable
+from .bgenCodecs import get_codec
+from .stats import ParserStats
+from . import errors_codes as ec
+from . import kernels as kn
+
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from pathlib import Path
+import numpy as np
+import struct
+import os
+
+
+def encode_genotype_blocks(data, probabilities, b, compression):
+    """
+    Encode the genotype data block of each variant as layout 2 unphased bi-allelic diploid probabilities, compressing
+    each block. This holds no state so can run in a worker process.
+
+    Spec at https://www.well.ox.ac.uk/~gav/bgen_format/spec/latest.html
+
+    :param data: A float array of (variants, samples) dosage of the second allele, or (variants, samples, 3) genotype
+        probabilities if probabilities is True, where NaN is missing
+    :type data: np.ndarray
+
+    :param probabilities: If data holds genotype probabilities rather than dosage
+    :type probabilities: bool
+
+    :param b: The number of bits used to store each probability, from 1 to 32
+    :type b: int
+
+    :param compression: 0 for uncompressed, 1 for zlib, 2 for zstd
+    :type compression: int
+
+    :return: The bytes of each genotype data block, including its length fields
+    :rtype: list[bytes]
+    """
+    compress = get_codec(compression).compress if compression else None
+
+    blocks = []
+    for variant_data in data:
+        probs = variant_data if probabilities else kn.dosage_to_probabilities(variant_data)
+        integers, missing = kn.quantise_probabilities(probs, b)
+
+        # Sample number, allele number, min and max ploidy, ploidy with bit 7 for missing, phased flag and bit depth
+        sample_number = len(integers)
+        ploidy = np.where(missing, 0x82, 2).astype(np.uint8).tobytes()
+        payload = struct.pack("<IHBB", sample_number, 2, 2, 2) + ploidy + struct.pack("<BB", 0, b) + \
+            kn.pack_probabilities(integers.ravel(), b)
+
+        if compress:
+            compressed = compress(payload)
+            blocks.append(struct.pack("<II", len(compressed) + 4, len(payload)) + compressed)
+        else:
+            blocks.append(struct.pack("<I", len(payload)) + payload)
+    return blocks
+
+
+class BgenWriter:
+    def __init__(self, file_path, sample_number, bit_depth=16, compression=1, sample_ids=None, bgi=True,
+                 workers=None, chunk_size=100, stats=None):
+        """
+        Write layout 2 bgen files of unphased bi-allelic diploid variants from dosage or probability arrays, or from a
+        sliced BgenObject. Genotype blocks are compressed by a pool of worker processes whilst the main process writes
+        the completed blocks in order, recording the .bgi as each block is written.
+
+        Use as a context manager, or call close, as the variant count of the header and the .bgi are written on close.
+
+        :param file_path: The path to write the bgen to
+        :type file_path: Path | str
+
+        :param sample_number: The number of samples within every variant
+        :type sample_number: int
+
+        :param bit_depth: The number of bits used to store each probability, from 1 to 32
+        :type bit_depth: int
+
+        :param compression: 0 for uncompressed, 1 for zlib, 2 for zstd
+        :type compression: int
+
+        :param sample_ids: The identifier of each sample, written within the sample identifier block if provided
+        :type sample_ids: list[str] | np.ndarray | None
+
+        :param bgi: Write a .bgi alongside the bgen if True, or at this path if a path is provided
+        :type bgi: bool | Path | str
+
+        :param workers: The number of worker processes compressing blocks, defaults to the cpu count. If 0, blocks are
+            encoded within this process
+        :type workers: int | None
+
+        :param chunk_size: The number of variants encoded by a worker at a time
+        :type chunk_size: int
+
+        :param stats: Records the time spent encoding and writing, and the bytes written
+        :type stats: ParserStats | None
+        """
+        assert 1 <= bit_depth <= 32, ec.bit_depth_violation(bit_depth)
+        assert 0 <= compression < 3, ec.compression_violation(file_path, compression)
+        assert sample_ids is None or len(sample_ids) == sample_number, \
+            ec.sample_size_violation(sample_number, len(sample_ids))
+
+        self.file_path = Path(file_path)
+        self.sample_number = sample_number
+        self.variant_number = 0
+        self.stats = stats if stats is not None else ParserStats()
+
+        self._bit_depth = bit_depth
+        self._compression = compression
+        self._chunk_size = chunk_size
+        self._bgi_path = self._set_bgi_path(bgi)
+        self._bgi_rows = []
+
+        self._workers = os.cpu_count() if workers is None else workers
+        self._executor = ProcessPoolExecutor(self._workers) if self._workers > 0 else None
+        self._pending = deque()
+
+        self._bgen_binary = open(self.file_path, "wb")
+        self._write_header(sample_ids)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        return f"BgenWriter iid:sid -> {self.sample_number}:{self.variant_number}"
+
+    def _set_bgi_path(self, bgi):
+        """The path to write the .bgi to, or None if it should not be written"""
+        if not bgi:
+            return None
+        elif isinstance(bgi, (str, Path)):
+            return Path(bgi)
+        else:
+            return Path(f"{self.file_path}.bgi")
+
+    def _write_header(self, sample_ids):
+        """
+        Write the header block, and the sample identifier block if there are sample ids. The variant count is written as
+        zero and updated on close.
+
+        Spec at https://www.well.ox.ac.uk/~gav/bgen_format/spec/latest.html
+        """
+        if sample_ids is not None:
+            encoded = [str(iid).encode() for iid in sample_ids]
+            identifiers = b"".join([struct.pack("<H", len(iid)) + iid for iid in encoded])
+            sample_block = struct.pack("<II", len(identifiers) + 8, self.sample_number) + identifiers
+        else:
+            sample_block = b""
+
+        # The compression is stored in bits 0-1 of the flag, the layout in bits 2-5 and sample identifiers in bit 31
+        flag = self._compression | (2 << 2) | ((sample_ids is not None) << 31)
+        self._bgen_binary.write(struct.pack("<IIII4sI", 20 + len(sample_block), 20, 0, self.sample_number, b"bgen",
+                                            flag))
+        self._bgen_binary.write(sample_block)
+
+    def write(self, variants, data, probabilities=None):
+        """
+        Queue variants to be written
+
+        :param variants: The Variant of each variant to write, where a1 is the first allele and a2 the allele counted by
+            the dosage
+        :type variants: list | np.ndarray
+
+        :param data: A float array of (variants, samples) dosage, or (variants, samples, 3) genotype probabilities
+            of P(a1a1), P(a1a2) and P(a2a2), where NaN is missing
+        :type data: np.ndarray
+
+        :param probabilities: If data holds probabilities, otherwise inferred from the shape of data
+        :type probabilities: bool | None
+
+        :return: Nothing, the variants are written as the workers finish them
+        :rtype: None
+        """
+        data = np.asarray(data)
+        probabilities = data.ndim == 3 if probabilities is None else probabilities
+        assert len(variants) == len(data), ec.variant_data_violation(len(variants), len(data))
+        assert data.shape[1] == self.sample_number, ec.sample_size_violation(self.sample_number, data.shape[1])
+
+        for start in range(0, len(variants), self._chunk_size):
+            chunk = (data[start:start + self._chunk_size], probabilities, self._bit_depth, self._compression)
+            if self._executor:
+                self._pending.append((variants[start:start + self._chunk_size],
+                                      self._executor.submit(encode_genotype_blocks, *chunk)))
+            else:
+                with self.stats.time("encode"):
+                    blocks = encode_genotype_blocks(*chunk)
+                self._write_blocks(variants[start:start + self._chunk_size], blocks)
+
+            # Keep a bounded number of chunks in flight, writing the oldest as it completes so the file stays in order
+            while len(self._pending) > 2 * self._workers:
+                self._write_pending()
+
+    def write_bgen(self, bgen, batch_size=1000):
+        """
+        Write every variant of a BgenObject, such as a subset from bgen[iid_index, sid_index], as it is read. If the
+        object returns probabilities they are written, otherwise its dosage is.
+
+        :param bgen: The bgen to write
+        :type bgen: pyGenicParser.BgenObject
+
+        :param batch_size: The number of variants read at a time
+        :type batch_size: int
+
+        :return: Nothing, the variants are written as the workers finish them
+        :rtype: None
+        """
+        for variants, data in bgen.iter_variants(batch_size):
+            self.write(variants, data)
+
+    def close(self):
+        """Write any variants still being encoded, update the variant count within the header, and write the .bgi"""
+        if self._bgen_binary.closed:
+            return
+
+        while self._pending:
+            self._write_pending()
+        if self._executor:
+            self._executor.shutdown()
+
+        self._bgen_binary.seek(8)
+        self._bgen_binary.write(struct.pack("<I", self.variant_number))
+        self._bgen_binary.close()
+
+        if self._bgi_path:
+            if self._bgi_path.exists():
+                self._bgi_path.unlink()
+            VariantTable.from_rows(self._bgi_rows).to_bgi(self._bgi_path)
+
+    def _write_pending(self):
+        """Wait for the oldest chunk of variants to be encoded then write it"""
+        variants, future = self._pending.popleft()
+        with self.stats.time("encode"):
+            blocks = future.result()
+        self._write_blocks(variants, blocks)
+
+    def _write_blocks(self, variants, blocks):
+        """Write the variant identifying data then genotype data of each variant, recording its .bgi row"""
+        with self.stats.time("write"):
+            for variant, block in zip(variants, blocks):
+                start_position = self._bgen_binary.tell()
+                header = self._variant_header(variant)
+                self._bgen_binary.write(header)
+                self._bgen_binary.write(block)
+
+                self._bgi_rows.append([start_position, len(header) + len(block), variant.chromosome,
+                                       variant.bp_position, variant.snp_id, variant.a1, variant.a2])
+                self.stats.add("bytes_written", len(header) + len(block))
+
+        self.variant_number += len(blocks)
+
+    @staticmethod
+    def _variant_header(variant):
+        """The variant identifying data of a layout 2 variant, using the rsid as the variant id"""
+        alleles = [variant.a1, variant.a2]
+        assert "," not in variant.a2, ec.multi_allelic_write_violation(variant.snp_id)
+
+        snp_id = str(variant.snp_id).encode()
+        chromosome = str(variant.chromosome).encode()
+        header = struct.pack("<H", len(snp_id)) + snp_id + struct.pack("<H", len(snp_id)) + snp_id + \
+            struct.pack("<H", len(chromosome)) + chromosome + struct.pack("<IH", variant.bp_position, len(alleles))
+        return header + b"".join([struct.pack("<I", len(allele.encode())) + allele.encode() for allele in alleles])
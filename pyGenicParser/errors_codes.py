@@ -16,12 +16,26 @@ def offset_violation(file_name, offset, header_block_length):
            f"Offset: {offset} header_block_length {header_block_length}"
 
 
+def bed_magic_violation(file_name, magic):
+    return f"INVALID BED FILE for file at path: {file_name}\n" \
+           f"Bed files start with the magic number 0x6c 0x1b followed by 0x01 for variant major files, which is the " \
+           f"only mode supported. Yet found\n" \
+           f"Magic: {magic}"
+
+
 def sample_block_violation(header, offset, block_size):
     return f"INVALID BLOCK SIZE\n" \
            f"The header block + the offset should equal the length of the sample block yet found\n" \
            f"header {header}, offset {offset}, block_size {block_size}"
 
 
+def sample_file_violation(sample_path, header):
+    return f"INVALID SAMPLE FILE\n" \
+           f"A .sample file should start with a header of ID_1 ID_2 then further columns, followed by a line of the\n" \
+           f"type of each column, with a value of every column on each line after, yet {sample_path} has the header\n" \
+           f"{header} or a line without a value for every column"
+
+
 def sample_size_violation(sample_size, found_size):
     return f"INVALID SAMPLE SIZE\n" \
            f"The sample size for this file is set to {sample_size} yet the file found {found_size}"
@@ -41,6 +55,18 @@ def layout_violation(file_name, layout_flag):
            f"Layout flag: {layout_flag}"
 
 
+def genotype_probability_violation(file_name):
+    return f"INVALID PROBABILITY RETURN for file at path: {file_name}\n" \
+           f"Genotype probabilities of AA, AB and BB can only be returned for unphased, bi-allelic, diploid " \
+           f"variants. Use allele_dosage_from_sid or haplotype_from_sid for phased, multi-allelic, or non-diploid " \
+           f"variants"
+
+
+def phased_violation(file_name):
+    return f"UNPHASED DATA for file at path: {file_name}\n" \
+           f"Haplotypes can only be extracted from variants that are stored as phased"
+
+
 def sample_identifier_violation(file_name, sample_identifier):
     return f"INVALID SAMPLE IDENTIFIER FLAG for file at path: {file_name}\n" \
            f"Bgen files have a flag, where bit 31 represents if sample identifiers as within the file at 1 or not" \
@@ -86,3 +112,133 @@ def slice_list_type():
     return f"SLICE LIST IS NOT A LIST OF INTS\n" \
            f"Slicing takes a slice, or a list of ints that are the indexes.\nDid you forget to convert iids/sids into " \
            f"indexes?"
+
+
+def zstd_missing(file_name):
+    return f"ZSTD NOT INSTALLED for file at path: {file_name}\n" \
+           f"This bgen file is compressed via z-standard, which requires the optional zstandard or zstd package. " \
+           f"Install either via pip install zstandard"
+
+
+def column_length_violation():
+    return f"INVALID VARIANT TABLE\n" \
+           f"Every column of a variant table must hold a value for each variant, yet columns of different lengths " \
+           f"were found"
+
+
+def sidecar_magic_violation(file_name):
+    return f"INVALID SIDECAR for file at path: {file_name}\n" \
+           f"Sidecar index files start with the magic number b'GPVTI001', so this file was not written by to_sidecar"
+
+
+def sidecar_violation(file_name, variant_number, table_length, first_position, variant_start):
+    return f"SIDECAR DOES NOT MATCH FILE at path: {file_name}\n" \
+           f"The sidecar should hold every variant of the file starting at the first variant block, yet found\n" \
+           f"Variants: {variant_number} sidecar variants {table_length}, first variant block {variant_start} " \
+           f"sidecar first position {first_position}"
+
+
+def bit_depth_violation(bit_depth):
+    return f"INVALID BIT DEPTH\n" \
+           f"Layout 2 bgen files store each probability in 1 to 32 bits, yet found a bit depth of {bit_depth}"
+
+
+def variant_data_violation(variant_number, data_number):
+    return f"VARIANTS DO NOT MATCH DATA\n" \
+           f"Each variant requires a row of data, yet found {variant_number} variants and {data_number} rows of data"
+
+
+def multi_allelic_write_violation(snp_id):
+    return f"MULTI-ALLELIC VARIANT {snp_id}\n" \
+           f"BgenWriter only writes bi-allelic variants, yet a2 holds multiple alleles"
+
+
+def dataset_paths_violation(paths):
+    return f"NO FILES FOUND for paths: {paths}\n" \
+           f"A dataset requires at least one bgen or plink file, yet the paths matched none"
+
+
+def server_query_violation(keys):
+    return f"INVALID GENOTYPE QUERY\n" \
+           f"Dosage queries select variants by either rsids or region, yet the request only held {keys}"
+
+
+def server_dataset_violation(dataset, datasets):
+    return f"UNKNOWN DATASET {dataset}\n" \
+           f"The genotype server only serves the datasets {datasets}"
+
+
+def server_request_violation(error):
+    return f"GENOTYPE SERVER REQUEST FAILED\n" \
+           f"The server could not answer the request due to {error}"
+
+
+def server_connection_violation(socket_path):
+    return f"GENOTYPE SERVER DISCONNECTED at socket: {socket_path}\n" \
+           f"The server closed the connection before sending the full response"
+
+
+def codec_violation(backend, backends):
+    return f"INVALID CODEC {backend}\n" \
+           f"The compression of this bgen file can only be decompressed by the backends {backends}"
+
+
+def codec_missing(backends):
+    return f"CODEC NOT INSTALLED\n" \
+           f"None of the backends {backends} able to decompress this bgen file are installed"
+
+
+def scipy_missing():
+    return f"SCIPY NOT INSTALLED\n" \
+           f"Converting sparse dosage to a scipy matrix requires the optional scipy package. Install it via " \
+           f"pip install scipy"
+
+
+def sparse_probability_violation():
+    return f"SPARSE PROBABILITIES REQUESTED\n" \
+           f"Sparse output holds a single dosage or hard call per genotype, so is not available when returning " \
+           f"genotype probabilities"
+
+
+def output_dtype_violation(dtype):
+    return f"INVALID DOSAGE TYPE {dtype}\n" \
+           f"Dense dosage can only be returned as float32, float16, or uint8 for quantised dosage"
+
+
+def quantised_probability_violation():
+    return f"QUANTISED PROBABILITIES REQUESTED\n" \
+           f"Quantised uint8 output holds a single dosage or hard call per genotype, so is not available when " \
+           f"returning genotype probabilities"
+
+
+def checkpoint_violation(checkpoint, found, expected):
+    return f"MISMATCHED CHECKPOINT at path: {checkpoint}\n" \
+           f"The file, samples, number of variants, tile and batch size of a build must match the checkpoint it\n" \
+           f"resumes, yet the checkpoint was saved by a build of\n{found}\nand cannot be resumed by a build of\n" \
+           f"{expected}"
+
+
+def store_magic_violation(file_name, magic):
+    return f"INVALID SAMPLE MAJOR STORE at path: {file_name}\n" \
+           f"Stores written by to_sample_major start with the magic number SMGS, yet found {magic}"
+
+
+def store_sample_violation(sample_number, indexes):
+    return f"SAMPLE OUT OF RANGE\n" \
+           f"The store holds {sample_number} samples, yet the indexes requested were {indexes}"
+
+
+def store_memmap_violation(file_name, compression):
+    return f"COMPRESSED STORE at path: {file_name}\n" \
+           f"Only uncompressed stores can be memory mapped, yet this store has a compression flag of {compression}"
+
+
+def array_index_violation(index_length):
+    return f"TOO MANY INDEXES FOR GENOTYPE ARRAY\n" \
+           f"Genotype arrays are (variants, iid) so take at most two indexes, yet found {index_length}"
+
+
+def dask_missing():
+    return f"DASK NOT INSTALLED\n" \
+           f"Converting a genotype array to a dask array requires the optional dask package. Install it via " \
+           f"pip install dask"
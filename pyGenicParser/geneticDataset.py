@@ -0,0 +1,303 @@
+from .variantObjects import Variant
+from .variantTable import VariantTable
+from .plinkObject import PlinkObject
+from .bgenObject import BgenObject
+from .stats import ParserStats
+from . import errors_codes as ec
+from . import misc as mc
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from pathlib import Path
+from glob import glob
+import numpy as np
+import re
+import os
+
+
+class GenotypeFile:
+    def __init__(self, genetic_object):
+        """
+        An opened BgenObject or PlinkObject whose variants are held in memory and whose genotype file is held open for
+        positional reads, so reads pay neither the cost of opening the files nor of querying the .bgi. Reads hold no
+        state so can be made from many threads at once.
+
+        :param genetic_object: The opened object
+        :type genetic_object: pyGenicParser.BgenObject | pyGenicParser.PlinkObject
+        """
+        self.genetic_object = genetic_object
+        if isinstance(genetic_object, BgenObject):
+            self.table = genetic_object.variant_table()
+            self.sample_number = genetic_object.iid_count
+            self._file_descriptor = mc.open_positional(genetic_object.file_path)
+        else:
+            self.table = genetic_object.load_variant_table()
+            self.sample_number = genetic_object._sample_number()
+            self._file_descriptor = mc.open_positional(genetic_object.bed_file_path)
+
+        self.chromosomes = self.table.column("chromosome").astype(str)
+        self.positions = self.table.column("position")
+
+    def __len__(self):
+        return len(self.table)
+
+    def close(self):
+        """Close the genotype file"""
+        os.close(self._file_descriptor)
+
+    def rsid_indexes(self, snp_names):
+        """The indexes of the variants whose rsid is within snp_names, in file order"""
+        return self.table.rsid_indexes(snp_names)
+
+    def region_indexes(self, chromosome, start, end):
+        """The indexes of the variants on chromosome from start to end, both inclusive, in file order"""
+        return np.flatnonzero((self.chromosomes == str(chromosome)) & (self.positions >= start) &
+                              (self.positions <= end))
+
+    def variants(self, indexes):
+        """The Variant of each variant at indexes"""
+        variants = np.empty(len(indexes), dtype=object)
+        variants[:] = [Variant(*row) for row in self.variant_rows(indexes)]
+        return variants
+
+    def variant_rows(self, indexes):
+        """The chromosome, position, rsid, a1 and a2 of each variant at indexes"""
+        return self.table.rows(["chromosome", "position", "rsid", "allele1", "allele2"], indexes)
+
+    def dosage(self, indexes, samples=None):
+        """
+        Read the dosage of the variants at indexes
+
+        :param indexes: The indexes of the variants within the table
+        :type indexes: np.ndarray
+
+        :param samples: The indexes of the samples to return, or None for every sample
+        :type samples: list[int] | np.ndarray | None
+
+        :return: The dosage as an array of (variants, iid)
+        :rtype: np.ndarray
+        """
+        if len(indexes) == 0:
+            dosage = np.empty((0, self.sample_number), dtype=np.float32)
+        elif isinstance(self.genetic_object, BgenObject):
+            blocks = np.column_stack([self.table.column("file_start_position", indexes),
+                                      self.table.column("size_in_bytes", indexes)])
+            dosage = self.genetic_object._read_variant_batch(self._file_descriptor, blocks)[1]
+        else:
+            dosage = self.genetic_object._read_bed_variants(
+                self._file_descriptor, self.table.column("bed_start_position", indexes), self.sample_number)
+
+        return dosage if samples is None else dosage[:, samples]
+
+
+class GeneticDataset:
+    def __init__(self, paths, chromosomes=None, workers=None, stats=None, **open_kwargs):
+        """
+        A set of bgen or plink files with the same samples, such as a release split by chromosome, queried as if it was
+        a single file. Files are opened the first time they are needed, and rsid queries are routed to the files
+        holding them through a merged index of every variant. Reads of each file run in parallel, and results are
+        combined in the order of the files then of the variants within each file.
+
+        :param paths: A glob such as ukb_chr*.bgen, a template such as ukb_chr{chromosome}.bgen, or a list of paths.
+            Plink files may be given by any of their suffixes or their root. Globbed files are ordered with numbers in
+            numerical order, so chr2 is before chr10
+        :type paths: str | Path | list
+
+        :param chromosomes: The chromosome of each file of a template, defaults to 1 to 22. Region queries of a
+            template only open the file of the chromosome requested
+        :type chromosomes: list | None
+
+        :param workers: The number of threads reading files, defaults to that of ThreadPoolExecutor
+        :type workers: int | None
+
+        :param stats: Shared by the object of every file. A new one is created if not provided
+        :type stats: ParserStats | None
+
+        :param open_kwargs: Passed to BgenObject or PlinkObject as each file is opened, such as bgi_present or sidecar
+        """
+        self.stats = stats if stats is not None else ParserStats()
+        self.file_paths, self.chromosomes = self._set_paths(paths, chromosomes)
+        assert len(self.file_paths) > 0, ec.dataset_paths_violation(paths)
+
+        self._open_kwargs = open_kwargs
+        self._files = [None] * len(self.file_paths)
+        self._file_locks = [Lock() for _ in self.file_paths]
+        self._index_lock = Lock()
+        self._index = None
+        self._offsets = None
+        self._executor = ThreadPoolExecutor(workers)
+
+    def __repr__(self):
+        return f"GeneticDataset files -> {len(self.file_paths)}"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close_all()
+
+    @staticmethod
+    def _set_paths(paths, chromosomes):
+        """The path of every file, and the chromosome of each if they come from a template"""
+        if isinstance(paths, (list, tuple)):
+            return [Path(path) for path in paths], None
+
+        elif "{chromosome}" in str(paths):
+            chromosomes = list(range(1, 23)) if chromosomes is None else list(chromosomes)
+            return [Path(str(paths).format(chromosome=chromosome)) for chromosome in chromosomes], chromosomes
+
+        else:
+            def natural_key(path):
+                return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", path)]
+            return [Path(path) for path in sorted(glob(str(paths)), key=natural_key)], None
+
+    def close_all(self):
+        """Close every opened file, and the pool of threads reading them"""
+        for genotype_file in self._files:
+            if genotype_file is not None:
+                genotype_file.close()
+                if isinstance(genotype_file.genetic_object, PlinkObject):
+                    genotype_file.genetic_object.close_all()
+        self._files = [None] * len(self.file_paths)
+        self._executor.shutdown()
+
+    def file(self, file_index):
+        """
+        The GenotypeFile of a file, opening it if it has not yet been opened
+
+        :param file_index: The index of the file within file_paths
+        :type file_index: int
+
+        :return: The opened file
+        :rtype: GenotypeFile
+        """
+        with self._file_locks[file_index]:
+            if self._files[file_index] is None:
+                path = self.file_paths[file_index]
+                if path.suffix == ".bgen":
+                    genetic_object = BgenObject(path, stats=self.stats, **self._open_kwargs)
+                else:
+                    genetic_object = PlinkObject(path, stats=self.stats, **self._open_kwargs)
+                self._files[file_index] = GenotypeFile(genetic_object)
+        return self._files[file_index]
+
+    @property
+    def iid_count(self):
+        """The number of samples, which every file shares"""
+        return self.file(0).sample_number
+
+    @property
+    def sid_count(self):
+        """The number of variants across every file"""
+        return int(self._merged_index()[1][-1])
+
+    def _merged_index(self):
+        """
+        The merged index of every file, built the first time it is needed, which opens every file. This is a table of
+        the rsid of every variant across the files, with sorted hashes of the rsids for lookup, alongside the global
+        index of the first variant of each file and the total number of variants.
+
+        :return: The table, and the offset of each file followed by the total
+        :rtype: (VariantTable, np.ndarray)
+        """
+        with self._index_lock:
+            if self._index is None:
+                files = list(self._executor.map(self.file, range(len(self.file_paths))))
+                for genotype_file in files[1:]:
+                    assert genotype_file.sample_number == files[0].sample_number, ec.sample_size_violation(
+                        files[0].sample_number, genotype_file.sample_number)
+
+                with self.stats.time("index"):
+                    rsids = np.concatenate([genotype_file.table.column("rsid") for genotype_file in files])
+                    hashes = VariantTable.rsid_hash(rsids)
+                    order = np.argsort(hashes, kind="stable")
+                    self._index = VariantTable({"rsid": rsids}, rsid_hashes=(hashes[order], order))
+                    self._offsets = np.cumsum([0] + [len(genotype_file) for genotype_file in files])
+            return self._index, self._offsets
+
+    def sid_to_index(self, snps):
+        """
+        The global indexes of the variants whose rsid is within snps, in the order of the dataset
+
+        :param snps: The rsids to look up
+        :type snps: list | np.ndarray
+
+        :return: The indexes
+        :rtype: np.ndarray
+        """
+        index, _ = self._merged_index()
+        return index.rsid_indexes([str(snp) for snp in snps])
+
+    def info_from_sid(self, snp_names):
+        """An array of the Variant of every variant whose rsid is within snp_names, in the order of the dataset"""
+        return self._combine(self._route(self.sid_to_index(snp_names)), self._variants)
+
+    def dosage_from_sid(self, snp_names, samples=None):
+        """
+        The dosage of every variant whose rsid is within snp_names, in the order of the dataset
+
+        :param snp_names: The rsids to extract
+        :type snp_names: list | np.ndarray
+
+        :param samples: The indexes of the samples to return, or None for every sample
+        :type samples: list[int] | np.ndarray | None
+
+        :return: The dosage as an array of (variants, iid)
+        :rtype: np.ndarray
+        """
+        return self._combine(self._route(self.sid_to_index(snp_names)), self._dosage(samples))
+
+    def dosage_from_region(self, chromosome, start, end, samples=None):
+        """
+        The variants and dosage of every variant on chromosome from start to end, both inclusive. Datasets made from a
+        template only open the file of the chromosome, otherwise every file is searched.
+
+        :param chromosome: The chromosome
+        :type chromosome: str | int
+
+        :param start: The first position
+        :type start: int
+
+        :param end: The last position
+        :type end: int
+
+        :param samples: The indexes of the samples to return, or None for every sample
+        :type samples: list[int] | np.ndarray | None
+
+        :return: An array of Variant, and the dosage as an array of (variants, iid)
+        :rtype: (np.ndarray, np.ndarray)
+        """
+        if self.chromosomes is not None:
+            file_indexes = [i for i, file_chromosome in enumerate(self.chromosomes)
+                            if str(file_chromosome) == str(chromosome)]
+        else:
+            file_indexes = range(len(self.file_paths))
+
+        routes = [(i, self.file(i).region_indexes(chromosome, start, end)) for i in file_indexes]
+        routes = [(i, indexes) for i, indexes in routes if len(indexes) > 0]
+        return self._combine(routes, self._variants), self._combine(routes, self._dosage(samples))
+
+    def _route(self, global_indexes):
+        """Split global indexes into the index of each file holding them and the indexes within that file"""
+        _, offsets = self._merged_index()
+        file_indexes = np.searchsorted(offsets, global_indexes, "right") - 1
+        return [(i, global_indexes[file_indexes == i] - offsets[i]) for i in np.unique(file_indexes)]
+
+    @staticmethod
+    def _variants(genotype_file, indexes):
+        """The Variant of each variant of a route"""
+        return genotype_file.variants(indexes)
+
+    @staticmethod
+    def _dosage(samples):
+        """A function reading the dosage of samples of a route"""
+        return lambda genotype_file, indexes: genotype_file.dosage(indexes, samples)
+
+    def _combine(self, routes, function):
+        """
+        Call function(genotype_file, indexes) of each route in parallel, and concatenate the results in the order of
+        the routes, or the result of the first file for empty indexes if there are no routes
+        """
+        if len(routes) == 0:
+            return function(self.file(0), np.array([], dtype=np.int64))
+        return np.concatenate(list(self._executor.map(lambda route: function(self.file(route[0]), route[1]), routes)))
@@ -0,0 +1,115 @@
+from . import errors_codes as ec
+from . import misc as mc
+
+import numpy as np
+
+
+class GenotypeArray:
+    def __init__(self, shape, read_variants, dtype=np.float32, chunk_variants=1000):
+        """
+        A lazy NumPy style view of the dosage of a genotype file as an array of (variants, iid), created by as_array.
+        Nothing is read until the view is indexed or converted, when only the blocks of the variants selected are read
+        and decoded. Chunks of consecutive variants are described by chunks, so Dask or similar schedulers can build a
+        task graph of independent reads.
+
+        :param shape: The (variants, iid) shape of the dosage
+        :type shape: (int, int)
+
+        :param read_variants: Called with an int64 array of variant indexes and dtype, returning their dosage as an
+            array of (variants, iid)
+        :type read_variants: Callable
+
+        :param dtype: The type of the dosage, float32, float16 or uint8 for quantised dosage
+        :type dtype: type
+
+        :param chunk_variants: The number of variants of each chunk
+        :type chunk_variants: int
+        """
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.dtype = mc.output_dtype(dtype)
+        self.chunk_variants = max(int(chunk_variants), 1)
+        self._read_variants = read_variants
+
+    def __repr__(self):
+        return f"GenotypeArray sid:iid -> {self.shape[0]}:{self.shape[1]} dtype -> {self.dtype}"
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def nbytes(self):
+        """The bytes the dosage would take if read"""
+        return self.size * self.dtype.itemsize
+
+    @property
+    def chunks(self):
+        """The length of each chunk along each axis, as Dask describes them, where every chunk holds every sample"""
+        variant_chunks = [self.chunk_variants] * (self.shape[0] // self.chunk_variants)
+        if self.shape[0] % self.chunk_variants:
+            variant_chunks.append(self.shape[0] % self.chunk_variants)
+        return tuple(variant_chunks), (self.shape[1],)
+
+    def chunk_slices(self):
+        """
+        The slice of the variants of each chunk, so each chunk can be read with view[chunk_slice]
+
+        :return: A list of the slice of each chunk
+        :rtype: list[slice]
+        """
+        return [slice(start, min(start + self.chunk_variants, self.shape[0]))
+                for start in range(0, self.shape[0], self.chunk_variants)]
+
+    def __array__(self, dtype=None, copy=None):
+        dosage = self[:, :]
+        return dosage if dtype is None else dosage.astype(dtype, copy=False)
+
+    def __getitem__(self, item):
+        """
+        Read the variants selected by the first index, then select the samples of the second. Each index may be an
+        int, a slice, a list or array of indexes, or a boolean mask, with the semantics of NumPy. A slice alongside an
+        array selects every pair of the two, whereas two arrays, or an int and an array, are broadcast together and
+        select one value for each of their pairs, so view[[1, 2], [3, 4]] has a shape of (2,).
+        """
+        item = item if isinstance(item, tuple) else (item,)
+        assert len(item) <= 2, ec.array_index_violation(len(item))
+        variant_index, sample_index = item + (slice(None, None, None),) * (2 - len(item))
+
+        # Indexing the position of every variant checks the bounds and resolves negative indexes and masks
+        variants = np.arange(self.shape[0])[variant_index]
+        if isinstance(variant_index, slice):
+            return self._read(variants)[:, sample_index]
+        elif np.ndim(variants) == 0:
+            return self._read(np.atleast_1d(variants))[0, sample_index]
+
+        # Each variant of an index array is read once, then the index is mapped onto the variants read, so it is
+        # broadcast against an index array of samples as NumPy would
+        unique, inverse = np.unique(variants.ravel(), return_inverse=True)
+        return self._read(unique)[inverse.reshape(variants.shape), sample_index]
+
+    def _read(self, variants):
+        """Read the dosage of variants as an array of (variants, iid)"""
+        return self._read_variants(variants.astype(np.int64), self.dtype).reshape(-1, self.shape[1])
+
+    def to_dask(self):
+        """
+        A dask array of this view with a chunk per entry of chunks, which reads each chunk when computed
+
+        :return: The dask array
+        :rtype: dask.array.Array
+        """
+        # dask is an optional dependency, so it is only imported when a conversion is requested
+        try:
+            import dask.array as da
+        except ImportError:
+            raise ImportError(ec.dask_missing())
+
+        return da.from_array(self, chunks=self.chunks, asarray=False, fancy=False,
+                             meta=np.empty((0, 0), dtype=self.dtype))
@@ -0,0 +1,101 @@
+from .variantObjects import Variant
+from . import errors_codes as ec
+
+from pathlib import Path
+import numpy as np
+import socket
+import struct
+import json
+
+# Every message is a little endian unsigned int of the length of a json header, the header, then any binary payload
+MESSAGE_LENGTH = struct.Struct("<I")
+
+
+class GenotypeClient:
+    def __init__(self, socket_path, timeout=None):
+        """
+        Query a GenotypeServer over its Unix socket. A client holds a single connection, so use one client per thread.
+
+        :param socket_path: The path of the Unix socket the server listens on
+        :type socket_path: Path | str
+
+        :param timeout: The seconds to wait for a response before raising socket.timeout, or None to wait indefinitely
+        :type timeout: float | None
+        """
+        self.socket_path = Path(socket_path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(str(self.socket_path))
+        self._file = self._socket.makefile("rb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        return f"GenotypeClient -> {self.socket_path}"
+
+    def close(self):
+        """Close the connection"""
+        self._file.close()
+        self._socket.close()
+
+    def datasets(self):
+        """
+        The datasets served, with the number of samples and variants of each
+
+        :return: A dict of the name of each dataset to a dict of its iid_count and sid_count
+        :rtype: dict
+        """
+        return self._request({"operation": "datasets"})[0]["datasets"]
+
+    def dosage(self, dataset, rsids=None, region=None, samples=None):
+        """
+        The dosage of the variants of a dataset, selected by either rsids or region, in file order
+
+        :param dataset: The name of the dataset
+        :type dataset: str
+
+        :param rsids: The rsids of the variants to return
+        :type rsids: list[str] | None
+
+        :param region: The chromosome, start and end position, both inclusive, of the variants to return
+        :type region: (str | int, int, int) | None
+
+        :param samples: The indexes of the samples to return, or None for every sample
+        :type samples: list[int] | None
+
+        :return: An array of Variant, and the dosage as an array of (variants, iid)
+        :rtype: (np.ndarray, np.ndarray)
+        """
+        request = {"operation": "dosage", "dataset": dataset}
+        if rsids is not None:
+            request["rsids"] = [str(rsid) for rsid in rsids]
+        if region is not None:
+            request["region"] = [str(region[0]), int(region[1]), int(region[2])]
+        if samples is not None:
+            request["samples"] = [int(sample) for sample in samples]
+
+        header, payload = self._request(request)
+        variants = np.empty(len(header["variants"]), dtype=object)
+        variants[:] = [Variant(*variant) for variant in header["variants"]]
+        return variants, np.frombuffer(payload, dtype=header["dtype"]).reshape(header["shape"])
+
+    def _request(self, request):
+        """Send a request, then read the header and payload of its response"""
+        encoded = json.dumps(request).encode("utf-8")
+        self._socket.sendall(MESSAGE_LENGTH.pack(len(encoded)) + encoded)
+
+        header = json.loads(self._read(MESSAGE_LENGTH.unpack(self._read(MESSAGE_LENGTH.size))[0]))
+        if header["status"] != "ok":
+            raise ValueError(ec.server_request_violation(header["error"]))
+        return header, self._read(header.get("nbytes", 0))
+
+    def _read(self, size):
+        """Read exactly size bytes of the response"""
+        data = self._file.read(size)
+        if len(data) < size:
+            raise ConnectionError(ec.server_connection_violation(self.socket_path))
+        return data
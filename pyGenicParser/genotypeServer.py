@@ -0,0 +1,168 @@
+from .genotypeClient import MESSAGE_LENGTH
+from .geneticDataset import GenotypeFile
+from .stats import ParserStats
+from . import errors_codes as ec
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from pathlib import Path
+import numpy as np
+import asyncio
+import json
+
+
+class GenotypeServer:
+    def __init__(self, socket_path, datasets, workers=None, stats=None):
+        """
+        A long lived asyncio service answering dosage queries over a local Unix socket, so that short jobs querying the
+        same files do not each pay the cost of opening them and their indexes. Queries by rsid, region and subset of
+        samples are answered with the dosage as a binary numpy payload, through GenotypeClient.
+
+        Reads run on a pool of threads, each with its own connection to any index. Concurrent requests for the same
+        variants and samples are coalesced, so the blocks are only read and decoded once.
+
+        :param socket_path: The path of the Unix socket to listen on, which is replaced if it already exists
+        :type socket_path: Path | str
+
+        :param datasets: A dict of the name of each dataset to its opened BgenObject or PlinkObject
+        :type datasets: dict
+
+        :param workers: The number of threads reading genotypes, defaults to that of ThreadPoolExecutor
+        :type workers: int | None
+
+        :param stats: Counts the requests answered and the requests coalesced. A new one is created if not provided
+        :type stats: ParserStats | None
+        """
+        self.socket_path = Path(socket_path)
+        self.datasets = {name: GenotypeFile(genetic_object) for name, genetic_object in datasets.items()}
+        self.stats = stats if stats is not None else ParserStats()
+
+        self._executor = ThreadPoolExecutor(workers)
+        self._inflight = {}
+        self._server = None
+        self._loop = None
+        self._thread = None
+
+    def __repr__(self):
+        return f"GenotypeServer {self.socket_path} -> {list(self.datasets.keys())}"
+
+    async def start(self):
+        """Start listening on the socket"""
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+        self._server = await asyncio.start_unix_server(self._handle_connection, path=str(self.socket_path))
+        return self
+
+    async def serve_forever(self):
+        """Start listening on the socket, then answer requests until cancelled"""
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        """Stop listening, then close the genotype files and remove the socket"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+            self._executor.shutdown()
+            for dataset in self.datasets.values():
+                dataset.close()
+            if self.socket_path.exists():
+                self.socket_path.unlink()
+
+    def run(self):
+        """Answer requests until interrupted, blocking the calling thread"""
+        asyncio.run(self.serve_forever())
+
+    def start_background(self):
+        """
+        Answer requests from an event loop running within a background thread, so the server can be used from
+        synchronous code. Call stop_background to stop it.
+
+        :return: This server
+        :rtype: GenotypeServer
+        """
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self.start(), self._loop).result()
+        return self
+
+    def stop_background(self):
+        """Stop a server started by start_background"""
+        asyncio.run_coroutine_threadsafe(self.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _handle_connection(self, reader, writer):
+        """Answer each request of a connection in turn until the client disconnects"""
+        try:
+            while True:
+                try:
+                    size = MESSAGE_LENGTH.unpack(await reader.readexactly(MESSAGE_LENGTH.size))[0]
+                    request = json.loads(await reader.readexactly(size))
+                except asyncio.IncompleteReadError:
+                    break
+
+                header, payload = await self._respond(request)
+                encoded = json.dumps(header).encode("utf-8")
+                writer.write(MESSAGE_LENGTH.pack(len(encoded)) + encoded + payload)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def _respond(self, request):
+        """The header and payload answering a request, or a header holding the error if it could not be answered"""
+        self.stats.add("requests")
+        try:
+            if request.get("operation") == "datasets":
+                return {"status": "ok", "datasets": {name: {"iid_count": dataset.sample_number,
+                                                            "sid_count": len(dataset.table)}
+                                                     for name, dataset in self.datasets.items()}}, b""
+
+            assert request.get("dataset") in self.datasets, ec.server_dataset_violation(
+                request.get("dataset"), list(self.datasets.keys()))
+            dataset = self.datasets[request["dataset"]]
+
+            loop = asyncio.get_running_loop()
+            indexes = await loop.run_in_executor(self._executor, self._indexes, dataset, request)
+            samples = request.get("samples")
+
+            # Requests resolving to the same variants and samples share a single read of their blocks
+            key = (request["dataset"], indexes.tobytes(), None if samples is None else tuple(samples))
+            future = self._inflight.get(key)
+            if future is None:
+                future = loop.run_in_executor(self._executor, self._dosage_response, dataset, indexes, samples)
+                self._inflight[key] = future
+                future.add_done_callback(lambda _: self._inflight.pop(key, None))
+            else:
+                self.stats.add("coalesced")
+
+            return await asyncio.shield(future)
+
+        except Exception as error:
+            return {"status": "error", "error": f"{type(error).__name__}: {error}"}, b""
+
+    @staticmethod
+    def _indexes(dataset, request):
+        """The indexes of the variants of a request from either its rsids or its region of [chromosome, start, end]"""
+        if "rsids" in request:
+            return dataset.rsid_indexes(request["rsids"])
+
+        assert "region" in request, ec.server_query_violation(list(request.keys()))
+        return dataset.region_indexes(*request["region"])
+
+    @staticmethod
+    def _dosage_response(dataset, indexes, samples):
+        """
+        The response of a dosage query, a header holding the chromosome, position, rsid, a1 and a2 of each variant
+        alongside the dtype and shape of the dosage, and the dosage as bytes
+        """
+        dosage = np.ascontiguousarray(dataset.dosage(indexes, samples))
+        return {"status": "ok", "variants": dataset.variant_rows(indexes), "dtype": dosage.dtype.str,
+                "shape": list(dosage.shape), "nbytes": dosage.nbytes}, dosage.tobytes()
@@ -0,0 +1,884 @@
+from functools import lru_cache
+from math import ceil, erfc
+import numpy as np
+
+
+def probability_scale(b):
+    """
+    The largest value a b bit probability can take, which represents a probability of 1
+
+    :param b: The number of bits used to store each probability
+    :type b: int
+
+    :return: 2 ** b - 1
+    :rtype: int
+    """
+    return (1 << b) - 1
+
+
+def quality_cutoff(probability, b):
+    """
+    Convert a probability threshold into the smallest integer payload value that meets it, so that thresholds can be
+    applied to the raw payload rather than to probabilities divided into float64
+
+    :param probability: The probability threshold, where 0 or less disables the threshold
+    :type probability: float
+
+    :param b: The number of bits used to store each probability
+    :type b: int
+
+    :return: The integer cut off, or None if no threshold should be applied
+    :rtype: int | None
+    """
+    if probability <= 0:
+        return None
+
+    # The small tolerance stops float error in probability * scale pushing exact values over the next integer
+    scale = probability_scale(b)
+    return int(ceil(probability * scale - 1e-9))
+
+
+def unpack_probabilities(data, b, count, indexes=None):
+    """
+    Unpack count probabilities of b bits each from the probability payload. Whole byte widths are viewed directly,
+    otherwise each value is gathered from the little endian bit stream in one vectorised pass.
+
+    :param data: The probability payload
+    :type data: bytes | memoryview
+
+    :param b: The number of bits used to store each probability, from 1 to 32
+    :type b: int
+
+    :param count: The number of probabilities stored in the payload
+    :type count: int
+
+    :param indexes: If given, only the probabilities at these indexes are unpacked, in this order
+    :type indexes: np.ndarray | None
+
+    :return: An unsigned integer array of length count, or of the length of indexes
+    :rtype: np.ndarray
+    """
+    if b in (8, 16, 32):
+        values = np.frombuffer(data, dtype={8: np.uint8, 16: "<u2", 32: "<u4"}[b], count=count)
+        return values if indexes is None else values[indexes]
+
+    # A value can start at any bit within a byte so at most 5 bytes are needed to hold 32 bits plus a 7 bit shift
+    raw = np.zeros(ceil(count * b / 8) + 5, dtype=np.uint64)
+    raw[:ceil(count * b / 8)] = np.frombuffer(data, dtype=np.uint8, count=ceil(count * b / 8))
+
+    if indexes is None:
+        bit_offsets = np.arange(count, dtype=np.uint64) * np.uint64(b)
+    else:
+        bit_offsets = np.asarray(indexes, dtype=np.uint64) * np.uint64(b)
+
+    byte_offsets = bit_offsets >> np.uint64(3)
+    window = raw[byte_offsets]
+    for i in range(1, 5):
+        window |= raw[byte_offsets + np.uint64(i)] << np.uint64(8 * i)
+
+    values = (window >> (bit_offsets & np.uint64(7))) & np.uint64(probability_scale(b))
+    return values.astype(np.uint32)
+
+
+def pack_probabilities(values, b):
+    """
+    Pack integer probabilities into a little endian bit stream of b bits each, the inverse of unpack_probabilities
+
+    :param values: An unsigned integer array of probabilities, each less than 2 ** b
+    :type values: np.ndarray
+
+    :param b: The number of bits used to store each probability, from 1 to 32
+    :type b: int
+
+    :return: The packed probabilities
+    :rtype: bytes
+    """
+    if b in (8, 16, 32):
+        return np.asarray(values, dtype={8: np.uint8, 16: "<u2", 32: "<u4"}[b]).tobytes()
+
+    # Spread the bits of each value into a row, then pack the flattened rows least significant bit first
+    values = np.asarray(values, dtype=np.uint64).ravel()
+    bits = ((values[:, None] >> np.arange(b, dtype=np.uint64)) & np.uint64(1)).astype(np.uint8)
+    return np.packbits(bits.ravel(), bitorder="little").tobytes()
+
+
+def dosage_to_probabilities(dosage):
+    """
+    Convert the dosage of the second allele into the genotype probabilities with the least uncertainty that have this
+    expected count, so that a dosage of 0.3 becomes P(AA) = 0.7 and P(AB) = 0.3, and 1.2 becomes P(AB) = 0.8 and
+    P(BB) = 0.2. Missing dosage remain NaN.
+
+    :param dosage: A float array of dosage from 0 to 2
+    :type dosage: np.ndarray
+
+    :return: A float array of (samples, 3) of P(AA), P(AB) and P(BB)
+    :rtype: np.ndarray
+    """
+    dosage = np.clip(np.asarray(dosage, dtype=np.float64), 0, 2)
+    return np.column_stack([np.clip(1 - dosage, 0, None), 1 - np.abs(1 - dosage), np.clip(dosage - 1, 0, None)])
+
+
+def quantise_probabilities(probs, b):
+    """
+    Convert genotype probabilities into the b bit integers stored by layout 2. Each value is floored then the remainder
+    is given to the genotypes with the largest fractional parts, so that the integers of every sample sum to exactly
+    2 ** b - 1 and the implied last probability is as close as possible to its true value.
+
+    :param probs: A float array of (samples, 3) of P(AA), P(AB) and P(BB) that sum to 1, where rows containing NaN or
+        of all zero are treated as missing and stored as zero
+    :type probs: np.ndarray
+
+    :param b: The number of bits used to store each probability, from 1 to 32
+    :type b: int
+
+    :return: An integer array of (samples, 2) of the stored P(AA) and P(AB) values, and a boolean array of the samples
+        that are missing
+    :rtype: (np.ndarray, np.ndarray)
+    """
+    probs = np.asarray(probs, dtype=np.float64)
+    totals = probs.sum(axis=1, keepdims=True)
+    missing = np.isnan(totals[:, 0]) | (totals[:, 0] <= 0)
+
+    # Normalise so that rounding error in the input cannot push the sum of floored values past the scale
+    scale = probability_scale(b)
+    scaled = np.where(missing[:, None], 0, probs / np.where(missing[:, None], 1, totals) * scale)
+
+    floored = np.floor(scaled)
+    remainder = (scale - floored.sum(axis=1)).astype(np.int64)
+    remainder[missing] = 0
+
+    # Rank each genotype by its fractional part, and add one to the largest until the remainder is used up
+    ranks = np.argsort(np.argsort(floored - scaled, axis=1, kind="stable"), axis=1, kind="stable")
+    floored += ranks < remainder[:, None]
+    return floored[:, :2].astype(np.uint64 if b > 31 else np.uint32), missing
+
+
+def sample_value_indexes(ploidy, phased, k, samples):
+    """
+    The indexes of the stored probabilities that belong to a selection of samples, so that only these need unpacking
+
+    :param ploidy: The ploidy of every sample in the file
+    :type ploidy: np.ndarray
+
+    :param phased: If the data is phased
+    :type phased: bool
+
+    :param k: The number of alleles
+    :type k: int
+
+    :param samples: The indexes of the selected samples
+    :type samples: np.ndarray
+
+    :return: The indexes of the selected samples probabilities, in the order of samples
+    :rtype: np.ndarray
+    """
+    stored = values_per_sample(ploidy, phased, k)
+    starts = np.concatenate([[0], np.cumsum(stored)[:-1]]).astype(np.int64)
+
+    counts = stored[samples]
+    first = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+    return np.repeat(starts[samples] - first, counts) + np.arange(counts.sum(), dtype=np.int64)
+
+
+# The .bed genotype codes as a count of the second allele within the .bim, where 01 represents missing. See
+# https://www.cog-genomics.org/plink/1.9/formats#bed
+_BED_CODES = np.array([0, np.nan, 1, 2], dtype=np.float32)
+_BED_GENOTYPES = ((np.arange(256)[:, None] >> np.arange(0, 8, 2)) & 3).astype(np.uint8)
+_BED_LOOKUP = _BED_CODES[_BED_GENOTYPES]
+_BED_ENCODE = np.array([0, 2, 3], dtype=np.uint8)
+
+# Quantised dosage is stored as uint8 of round(dosage * QUANTISED_SCALE), so 0 to 254, with QUANTISED_MISSING as missing
+QUANTISED_SCALE = 127
+QUANTISED_MISSING = 255
+_BED_QUANTISED_CODES = np.array([0, QUANTISED_MISSING, QUANTISED_SCALE, 2 * QUANTISED_SCALE], dtype=np.uint8)
+_BED_QUANTISED_LOOKUP = _BED_QUANTISED_CODES[_BED_GENOTYPES]
+
+# The upper tail of the chi square distribution with one degree of freedom is erfc(sqrt(x / 2))
+_erfc = np.frompyfunc(erfc, 1, 1)
+
+
+def bed_dosage_kernel(data, sample_number, out, samples=None):
+    """
+    Decode the genotypes of one variant from a variant major .bed file, as a count of the second allele within the
+    .bim, writing the result into out
+
+    :param data: The ceil(sample_number / 4) bytes of this variant
+    :type data: bytes | memoryview
+
+    :param sample_number: The number of samples within the .fam
+    :type sample_number: int
+
+    :param out: Float array to write the genotypes into, of length sample_number or of the length of samples. If
+        uint8, the genotypes are written as quantised dosage straight from the 2 bit codes
+    :type out: np.ndarray
+
+    :param samples: If given, only decode these samples, in this order
+    :type samples: np.ndarray | None
+
+    :return: out
+    :rtype: np.ndarray
+    """
+    if out.dtype == np.uint8:
+        codes, lookup = _BED_QUANTISED_CODES, _BED_QUANTISED_LOOKUP
+    else:
+        codes, lookup = _BED_CODES, _BED_LOOKUP
+
+    packed = np.frombuffer(data, dtype=np.uint8, count=ceil(sample_number / 4))
+    if samples is None:
+        out[:] = lookup[packed].ravel()[:sample_number]
+    else:
+        out[:] = codes[(packed[samples >> 2] >> ((samples & 3) << 1)) & 3]
+    return out
+
+
+def bed_sparse_kernel(data, sample_number, samples=None):
+    """
+    Decode the genotypes of one variant from a variant major .bed file as a sparse column, from the 2 bit codes
+    without forming a float genotype for every sample
+
+    :param data: The ceil(sample_number / 4) bytes of this variant
+    :type data: bytes | memoryview
+
+    :param sample_number: The number of samples within the .fam
+    :type sample_number: int
+
+    :param samples: If given, only decode these samples, in this order
+    :type samples: np.ndarray | None
+
+    :return: The indexes of the samples with a non zero count of the second allele, their counts, and the indexes of
+        the missing samples
+    :rtype: (np.ndarray, np.ndarray, np.ndarray)
+    """
+    packed = np.frombuffer(data, dtype=np.uint8, count=ceil(sample_number / 4))
+    if samples is None:
+        codes = _BED_GENOTYPES[packed].ravel()[:sample_number]
+    else:
+        codes = (packed[samples >> 2] >> ((samples & 3) << 1)) & 3
+
+    # Codes 10 and 11 are one and two copies of the second allele, 01 is missing
+    indices = np.flatnonzero(codes >= 2).astype(np.int32)
+    return indices, (codes[indices] - 1).astype(np.float32), np.flatnonzero(codes == 1).astype(np.int32)
+
+
+def bed_encode_kernel(calls):
+    """
+    Encode hard calls as the genotype codes of a variant major .bed file, the inverse of bed_dosage_kernel
+
+    :param calls: A float array of (variants, samples) of the count of the second allele within the .bim, where NaN is
+        missing. Values are rounded to the nearest count
+    :type calls: np.ndarray
+
+    :return: A uint8 array of (variants, ceil(samples / 4)) of the packed codes of each variant
+    :rtype: np.ndarray
+    """
+    calls = np.atleast_2d(calls)
+    missing = np.isnan(calls)
+    counts = np.clip(np.rint(np.where(missing, 0, calls)), 0, 2).astype(np.intp)
+    codes = np.where(missing, 1, _BED_ENCODE[counts]).astype(np.uint8)
+
+    # Four samples are packed into each byte, the first sample within the lowest two bits
+    codes = np.pad(codes, ((0, 0), (0, (-calls.shape[1]) % 4))).reshape(len(calls), -1, 4)
+    return (codes << np.arange(0, 8, 2, dtype=np.uint8)).sum(axis=2, dtype=np.uint8)
+
+
+def hard_calls_to_probabilities(calls):
+    """
+    Convert hard calls into the genotype probabilities of certain calls, so they can be summarised as probabilities
+
+    :param calls: A float array of (variants, samples) of the count of the second allele, where NaN is missing
+    :type calls: np.ndarray
+
+    :return: A float32 array of (variants, samples, 3) of P(AA), P(AB) and P(BB), where missing samples are NaN
+    :rtype: np.ndarray
+    """
+    probs = (np.asarray(calls)[..., None] == np.arange(3)).astype(np.float32)
+    probs[np.isnan(calls)] = np.nan
+    return probs
+
+
+def variant_qc_kernel(probs):
+    """
+    Compute the quality control statistics of each variant from its genotype probabilities in a single pass, with
+    every sum accumulated in float64.
+
+    The info score is that of IMPUTE, 1 - sum(E[g^2] - E[g]^2) / (2n * theta * (1 - theta)), and r2 that of MaCH, the
+    variance of the expected dosage over 2 * theta * (1 - theta), both being 1 for monomorphic variants. The Hardy
+    Weinberg p value is from a chi square test with one degree of freedom of the expected genotype counts.
+
+    :param probs: A float array of (variants, samples, 3) of P(AA), P(AB) and P(BB), where missing samples are NaN
+    :type probs: np.ndarray
+
+    :return: A dict of a2_frequency, maf, call_rate, hwe_p, info and r2 to a float64 array of the value of each
+        variant, where the statistics of variants without any called samples are NaN
+    :rtype: dict
+    """
+    present = ~np.isnan(probs).any(axis=2)
+    probs = np.where(present[..., None], probs, 0)
+    called = present.sum(axis=1)
+
+    # The expected genotype counts, and the expected dosage of the second allele of each sample
+    counts = probs.sum(axis=1, dtype=np.float64)
+    expected = probs[..., 1] + 2 * probs[..., 2]
+    squared_sum = counts[:, 1] + 4 * counts[:, 2]
+    expected_squared_sum = np.einsum("ij,ij->i", expected, expected, dtype=np.float64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        frequency = (counts[:, 1] + 2 * counts[:, 2]) / (2 * called)
+        variance = 2 * frequency * (1 - frequency)
+        polymorphic = variance > 0
+
+        info = np.where(polymorphic, 1 - (squared_sum - expected_squared_sum) / (called * variance), 1)
+        r2 = np.where(polymorphic, (expected_squared_sum / called - (2 * frequency) ** 2) / variance, 1)
+
+        hwe_counts = np.column_stack([(1 - frequency) ** 2, variance, frequency ** 2]) * called[:, None]
+        chi_square = np.where(hwe_counts > 0, (counts - hwe_counts) ** 2 / hwe_counts, 0).sum(axis=1)
+        hwe_p = np.where(polymorphic, _erfc(np.sqrt(chi_square / 2)).astype(np.float64), 1)
+
+    empty = called == 0
+    info[empty], r2[empty], hwe_p[empty] = np.nan, np.nan, np.nan
+    return {"a2_frequency": frequency, "maf": np.minimum(frequency, 1 - frequency),
+            "call_rate": called / max(probs.shape[1], 1), "hwe_p": hwe_p, "info": info, "r2": r2}
+
+
+def standardise_kernel(dosage):
+    """
+    Standardise the dosage of each variant by its allele frequency p as (dosage - 2p) / sqrt(2p(1 - p)), where missing
+    dosage is set to zero, the standardised mean, and variants that are monomorphic or entirely missing are dropped
+
+    :param dosage: A float array of (variants, samples), where missing is NaN
+    :type dosage: np.ndarray
+
+    :return: A float32 array of (kept variants, samples)
+    :rtype: np.ndarray
+    """
+    present = ~np.isnan(dosage)
+    count = present.sum(axis=1)
+    frequency = np.where(present, dosage, 0).sum(axis=1, dtype=np.float64) / np.maximum(count, 1) / 2
+    deviation = np.sqrt(2 * frequency * (1 - frequency))
+
+    keep = (count > 0) & (deviation > 0)
+    standardised = (dosage[keep] - 2 * frequency[keep, None]) / deviation[keep, None]
+    return np.where(present[keep], standardised, 0).astype(np.float32)
+
+
+def score_kernel(dosage, weights):
+    """
+    The contribution of a block of variants to the scores of every sample, where a missing dosage is imputed as the
+    mean dosage of the variant across the called samples
+
+    :param dosage: A float array of (variants, samples) of the dosage of the allele the weights are aligned to
+    :type dosage: np.ndarray
+
+    :param weights: A float array of (variants, scores) of the weight of each variant
+    :type weights: np.ndarray
+
+    :return: A float64 array of (samples, scores)
+    :rtype: np.ndarray
+    """
+    dosage = np.asarray(dosage, dtype=np.float64)
+    missing = np.isnan(dosage)
+    if missing.any():
+        called = (~missing).sum(axis=1)
+        means = np.where(called > 0, np.where(missing, 0, dosage).sum(axis=1) / np.maximum(called, 1), 0)
+        dosage = np.where(missing, means[:, None], dosage)
+    return dosage.T @ weights
+
+
+def _compute_dtype(out):
+    """Floats are computed in at least float32, so float16 outputs neither overflow nor lose precision until stored"""
+    return np.float64 if out.dtype == np.float64 else np.float32
+
+
+def _work_dtype(b):
+    """Integer type large enough to hold 2 * (2 ** b - 1) without overflow"""
+    return np.int32 if b <= 30 else np.int64
+
+
+def _last_probs(probs, b):
+    """The homozygous alternative integer probabilities, which are implied as the scale minus the stored values"""
+    work = _work_dtype(b)
+    return probability_scale(b) - probs[:, 0].astype(work) - probs[:, 1].astype(work)
+
+
+def _low_quality(probs, last, cutoff):
+    """Samples where no genotype meets the integer cut off"""
+    return (probs[:, 0] < cutoff) & (probs[:, 1] < cutoff) & (last < cutoff)
+
+
+def dosage_kernel(probs, b, missing, cutoff, out):
+    """
+    Compute the dosage of the second allele directly from the integer probabilities of layout 2, as
+    (2 * P(BB) + P(AB)) / scale, writing the result into out.
+
+    :param probs: An integer array of shape (samples, 2) of the stored P(AA) and P(AB) values
+    :type probs: np.ndarray
+
+    :param b: The number of bits used to store each probability
+    :type b: int
+
+    :param missing: Boolean array of samples flagged as missing
+    :type missing: np.ndarray
+
+    :param cutoff: Integer quality cut off from quality_cutoff, or None
+    :type cutoff: int | None
+
+    :param out: Float array of length samples to write the dosage into
+    :type out: np.ndarray
+
+    :return: out
+    :rtype: np.ndarray
+    """
+    scale = probability_scale(b)
+    work = _work_dtype(b)
+    last = _last_probs(probs, b)
+
+    # 2 * P(BB) + P(AB) = 2 * scale - 2 * P(AA) - P(AB), which we can form in integers before a single float conversion
+    numerator = 2 * scale - 2 * probs[:, 0].astype(work) - probs[:, 1]
+    compute = _compute_dtype(out)
+    np.multiply(numerator, compute(1 / scale), out=out, dtype=compute, casting="unsafe")
+
+    if cutoff is not None:
+        out[_low_quality(probs, last, cutoff)] = np.nan
+    out[missing] = np.nan
+    return out
+
+
+def quantised_dosage_kernel(probs, b, missing, cutoff, out, hard_call=False):
+    """
+    Compute the dosage, or hard calls, of the second allele from the integer probabilities of layout 2 as quantised
+    uint8 codes of round(dosage * QUANTISED_SCALE), using only integer arithmetic, writing the result into out. Missing
+    samples and those whose genotypes do not meet the cut off are QUANTISED_MISSING.
+
+    :param probs: An integer array of shape (samples, 2) of the stored P(AA) and P(AB) values
+    :type probs: np.ndarray
+
+    :param b: The number of bits used to store each probability
+    :type b: int
+
+    :param missing: Boolean array of samples flagged as missing
+    :type missing: np.ndarray
+
+    :param cutoff: Integer quality cut off from quality_cutoff, or None
+    :type cutoff: int | None
+
+    :param out: uint8 array of length samples to write the codes into
+    :type out: np.ndarray
+
+    :param hard_call: If True, quantise the most likely genotype as in hard_call_kernel rather than the dosage
+    :type hard_call: bool
+
+    :return: out
+    :rtype: np.ndarray
+    """
+    scale = probability_scale(b)
+    last = _last_probs(probs, b)
+
+    if hard_call:
+        best = np.maximum(probs[:, 0], probs[:, 1])
+        out[:] = np.where(last > best, 2 * QUANTISED_SCALE, np.where(probs[:, 1] > probs[:, 0], QUANTISED_SCALE, 0))
+    else:
+        # round(QUANTISED_SCALE * numerator / scale) as floor((2 * QUANTISED_SCALE * numerator + scale) / (2 * scale))
+        work = np.int64 if b > 16 else np.int32
+        numerator = 2 * scale - 2 * probs[:, 0].astype(work) - probs[:, 1]
+        out[:] = (2 * QUANTISED_SCALE * numerator + scale) // (2 * scale)
+
+    if cutoff is not None:
+        out[_low_quality(probs, last, cutoff)] = QUANTISED_MISSING
+    out[missing] = QUANTISED_MISSING
+    return out
+
+
+def quantise_dosage(dosage, out):
+    """
+    Quantise float dosage, where NaN is missing, into the uint8 codes of quantised_dosage_kernel
+
+    :param dosage: The float dosage
+    :type dosage: np.ndarray
+
+    :param out: uint8 array of the same shape to write the codes into
+    :type out: np.ndarray
+
+    :return: out
+    :rtype: np.ndarray
+    """
+    missing = np.isnan(dosage)
+    out[:] = np.rint(np.where(missing, 0, dosage) * QUANTISED_SCALE)
+    out[missing] = QUANTISED_MISSING
+    return out
+
+
+def dequantise_dosage(codes, dtype=np.float32):
+    """
+    Convert the uint8 codes of quantised dosage back into float dosage, where QUANTISED_MISSING becomes NaN
+
+    :param codes: The uint8 codes
+    :type codes: np.ndarray
+
+    :param dtype: The float type to return
+    :type dtype: type
+
+    :return: The dosage, to within 1 / (2 * QUANTISED_SCALE) of the dosage quantised
+    :rtype: np.ndarray
+    """
+    dosage = np.multiply(codes, dtype(1 / QUANTISED_SCALE), dtype=dtype)
+    dosage[codes == QUANTISED_MISSING] = np.nan
+    return dosage
+
+
+def probability_kernel(probs, b, missing, out):
+    """
+    Compute P(AA), P(AB) and P(BB) from the integer probabilities of layout 2, writing the result into out.
+
+    :param probs: An integer array of shape (samples, 2) of the stored P(AA) and P(AB) values
+    :type probs: np.ndarray
+
+    :param b: The number of bits used to store each probability
+    :type b: int
+
+    :param missing: Boolean array of samples flagged as missing
+    :type missing: np.ndarray
+
+    :param out: Float array of shape (samples, 3) to write the probabilities into
+    :type out: np.ndarray
+
+    :return: out
+    :rtype: np.ndarray
+    """
+    compute = _compute_dtype(out)
+    inverse = compute(1 / probability_scale(b))
+    np.multiply(probs, inverse, out=out[:, :2], dtype=compute, casting="unsafe")
+    np.multiply(_last_probs(probs, b), inverse, out=out[:, 2], dtype=compute, casting="unsafe")
+
+    out[missing] = np.nan
+    return out
+
+
+def hard_call_kernel(probs, b, missing, cutoff, out):
+    """
+    Call the most likely genotype as a count of the second allele (0, 1 or 2) from the integer probabilities of
+    layout 2, writing the result into out. Calls whose most likely genotype does not meet the cut off are set to NaN.
+
+    :param probs: An integer array of shape (samples, 2) of the stored P(AA) and P(AB) values
+    :type probs: np.ndarray
+
+    :param b: The number of bits used to store each probability
+    :type b: int
+
+    :param missing: Boolean array of samples flagged as missing
+    :type missing: np.ndarray
+
+    :param cutoff: Integer quality cut off from quality_cutoff, or None
+    :type cutoff: int | None
+
+    :param out: Float array of length samples to write the calls into
+    :type out: np.ndarray
+
+    :return: out
+    :rtype: np.ndarray
+    """
+    last = _last_probs(probs, b)
+
+    # The genotype index is the count of the second allele, ties favour the genotype with fewer second alleles
+    out[:] = 0
+    out[probs[:, 1] > probs[:, 0]] = 1
+    best = np.maximum(probs[:, 0], probs[:, 1])
+    out[last > best] = 2
+
+    if cutoff is not None:
+        out[np.maximum(best, last) < cutoff] = np.nan
+    out[missing] = np.nan
+    return out
+
+
+def sparse_column(dosage):
+    """
+    Split a dense float column, where NaN is missing, into the sparse column returned by sparse_dosage_kernel
+
+    :param dosage: The dosage of each sample
+    :type dosage: np.ndarray
+
+    :return: The indexes of the samples with a non zero dosage, their dosage, and the indexes of the missing samples
+    :rtype: (np.ndarray, np.ndarray, np.ndarray)
+    """
+    missing = np.isnan(dosage)
+    indices = np.flatnonzero((dosage != 0) & ~missing).astype(np.int32)
+    return indices, dosage[indices].astype(np.float32), np.flatnonzero(missing).astype(np.int32)
+
+
+def sparse_dosage_kernel(probs, b, missing, cutoff, hard_call=False):
+    """
+    Compute the dosage, or hard calls, of the second allele from the integer probabilities of layout 2 as a sparse
+    column. A dosage is only zero when P(AA) is the full scale, so the samples to keep are found from the integers and
+    only their dosage is converted to float.
+
+    :param probs: An integer array of shape (samples, 2) of the stored P(AA) and P(AB) values
+    :type probs: np.ndarray
+
+    :param b: The number of bits used to store each probability
+    :type b: int
+
+    :param missing: Boolean array of samples flagged as missing
+    :type missing: np.ndarray
+
+    :param cutoff: Integer quality cut off from quality_cutoff, or None
+    :type cutoff: int | None
+
+    :param hard_call: If True, return the most likely genotype as in hard_call_kernel rather than the dosage
+    :type hard_call: bool
+
+    :return: The indexes of the samples with a non zero dosage, their dosage, and the indexes of the missing samples,
+        being those flagged as missing or whose genotypes do not meet the cut off
+    :rtype: (np.ndarray, np.ndarray, np.ndarray)
+    """
+    scale = probability_scale(b)
+    work = _work_dtype(b)
+    last = _last_probs(probs, b)
+
+    unavailable = missing if cutoff is None else missing | _low_quality(probs, last, cutoff)
+    if hard_call:
+        best = np.maximum(probs[:, 0], probs[:, 1])
+        indices = np.flatnonzero(((probs[:, 1] > probs[:, 0]) | (last > best)) & ~unavailable)
+        values = np.where(last[indices] > best[indices], 2, 1).astype(np.float32)
+    else:
+        indices = np.flatnonzero((probs[:, 0] != scale) & ~unavailable)
+        numerator = 2 * scale - 2 * probs[indices, 0].astype(work) - probs[indices, 1]
+        values = np.multiply(numerator, np.float32(1 / scale), dtype=np.float32, casting="unsafe")
+
+    return indices.astype(np.int32), values, np.flatnonzero(unavailable).astype(np.int32)
+
+
+@lru_cache(maxsize=None)
+def genotype_allele_counts(ploidy, k):
+    """
+    The allele counts of every unphased genotype for a given ploidy and number of alleles, in the colex order that
+    layout 2 stores genotype probabilities in. For example diploid bi-allelic genotypes are AA, AB, BB.
+
+    Spec at https://www.well.ox.ac.uk/~gav/bgen_format/spec/latest.html
+
+    :param ploidy: The ploidy of the sample
+    :type ploidy: int
+
+    :param k: The number of alleles
+    :type k: int
+
+    :return: An array of shape (genotypes, k) of the count of each allele within each genotype
+    :rtype: np.ndarray
+    """
+    def colex(total, alleles):
+        if alleles == 1:
+            return [[total]]
+        return [prefix + [last] for last in range(total + 1) for prefix in colex(total - last, alleles - 1)]
+
+    counts = np.array(colex(ploidy, k), dtype=np.int64)
+    counts.setflags(write=False)
+    return counts
+
+
+def values_per_sample(ploidy, phased, k):
+    """
+    The number of probabilities stored for each sample, which for phased data is one less than the number of alleles
+    for each haplotype, and for unphased data one less than the number of possible genotypes
+
+    :param ploidy: The ploidy of each sample
+    :type ploidy: np.ndarray
+
+    :param phased: If the data is phased
+    :type phased: bool
+
+    :param k: The number of alleles
+    :type k: int
+
+    :return: The number of stored probabilities for each sample
+    :rtype: np.ndarray
+    """
+    ploidy = ploidy.astype(np.int64)
+    if phased:
+        return ploidy * (k - 1)
+
+    stored = np.zeros(len(ploidy), dtype=np.int64)
+    for p in np.unique(ploidy):
+        stored[ploidy == p] = len(genotype_allele_counts(int(p), k)) - 1
+    return stored
+
+
+def _sample_starts(ploidy, phased, k):
+    """The offset of the first probability of each sample within the unpacked values"""
+    stored = values_per_sample(ploidy, phased, k)
+    return np.concatenate([[0], np.cumsum(stored)[:-1]]).astype(np.int64)
+
+
+def _haplotype_probabilities(values, b, ploidy, k):
+    """
+    Phased probabilities as an integer array of shape (haplotypes, k), with the sample each haplotype belongs to and
+    its position within that sample
+    """
+    haplotypes = values.astype(np.int64).reshape(-1, k - 1)
+    probs = np.column_stack([haplotypes, probability_scale(b) - haplotypes.sum(axis=1)])
+
+    ploidy = ploidy.astype(np.int64)
+    sample = np.repeat(np.arange(len(ploidy)), ploidy)
+    position = np.arange(len(sample)) - np.repeat(np.cumsum(ploidy) - ploidy, ploidy)
+    return probs, sample, position
+
+
+def _genotype_groups(values, b, ploidy, k):
+    """
+    Unphased probabilities grouped by ploidy, so that each group can be decoded with one vectorised operation. Yields
+    the samples in the group, an integer array of shape (samples, genotypes), and the allele counts of each genotype
+    """
+    starts = _sample_starts(ploidy, False, k)
+    values = values.astype(np.int64)
+    for p in np.unique(ploidy):
+        samples = np.flatnonzero(ploidy == p)
+        table = genotype_allele_counts(int(p), k)
+
+        stored = values[starts[samples][:, None] + np.arange(len(table) - 1)]
+        probs = np.column_stack([stored, probability_scale(b) - stored.sum(axis=1)])
+        yield samples, probs, table
+
+
+def allele_dosage_kernel(values, b, ploidy, missing, phased, k, out):
+    """
+    Compute the expected count of every allele for each sample from any layout 2 block, writing the result into out
+
+    :param values: The unpacked integer probabilities of the block
+    :type values: np.ndarray
+
+    :param b: The number of bits used to store each probability
+    :type b: int
+
+    :param ploidy: The ploidy of each sample
+    :type ploidy: np.ndarray
+
+    :param missing: Boolean array of samples flagged as missing
+    :type missing: np.ndarray
+
+    :param phased: If the data is phased
+    :type phased: bool
+
+    :param k: The number of alleles
+    :type k: int
+
+    :param out: Float array of shape (samples, k) to write the expected allele counts into
+    :type out: np.ndarray
+
+    :return: out
+    :rtype: np.ndarray
+    """
+    inverse = out.dtype.type(1 / probability_scale(b))
+    if phased:
+        probs, sample, _ = _haplotype_probabilities(values, b, ploidy, k)
+        totals = np.zeros((len(ploidy), k), dtype=np.int64)
+        np.add.at(totals, sample, probs)
+        np.multiply(totals, inverse, out=out, dtype=out.dtype, casting="unsafe")
+    else:
+        for samples, probs, table in _genotype_groups(values, b, ploidy, k):
+            out[samples] = np.multiply(probs @ table, inverse, dtype=out.dtype, casting="unsafe")
+
+    out[missing] = np.nan
+    return out
+
+
+def haplotype_kernel(values, b, ploidy, missing, k, out):
+    """
+    Compute the probability that each haplotype of a phased layout 2 block carries an allele other than the first,
+    writing the result into out. Haplotypes beyond a sample's ploidy are set to NaN
+
+    :param values: The unpacked integer probabilities of the block
+    :type values: np.ndarray
+
+    :param b: The number of bits used to store each probability
+    :type b: int
+
+    :param ploidy: The ploidy of each sample
+    :type ploidy: np.ndarray
+
+    :param missing: Boolean array of samples flagged as missing
+    :type missing: np.ndarray
+
+    :param k: The number of alleles
+    :type k: int
+
+    :param out: Float array of shape (samples, max ploidy) to write the haplotype probabilities into
+    :type out: np.ndarray
+
+    :return: out
+    :rtype: np.ndarray
+    """
+    probs, sample, position = _haplotype_probabilities(values, b, ploidy, k)
+
+    out[:] = np.nan
+    out[sample, position] = np.multiply(probability_scale(b) - probs[:, 0], out.dtype.type(1 / probability_scale(b)),
+                                        dtype=out.dtype, casting="unsafe")
+    out[missing] = np.nan
+    return out
+
+
+def general_dosage_kernel(values, b, ploidy, missing, phased, k, cutoff, out, hard_call=False):
+    """
+    Compute the dosage of alleles other than the first from any layout 2 block, writing the result into out. For
+    bi-allelic diploid data this is the same as dosage_kernel and hard_call_kernel.
+
+    For unphased data the cut off applies to the most likely genotype, whilst for phased data every haplotype's most
+    likely allele must meet it.
+
+    :param values: The unpacked integer probabilities of the block
+    :type values: np.ndarray
+
+    :param b: The number of bits used to store each probability
+    :type b: int
+
+    :param ploidy: The ploidy of each sample
+    :type ploidy: np.ndarray
+
+    :param missing: Boolean array of samples flagged as missing
+    :type missing: np.ndarray
+
+    :param phased: If the data is phased
+    :type phased: bool
+
+    :param k: The number of alleles
+    :type k: int
+
+    :param cutoff: Integer quality cut off from quality_cutoff, or None
+    :type cutoff: int | None
+
+    :param out: Float array of length samples to write the dosage into
+    :type out: np.ndarray
+
+    :param hard_call: If True, return the count of other alleles in the most likely genotype or haplotypes
+    :type hard_call: bool
+
+    :return: out
+    :rtype: np.ndarray
+    """
+    compute = _compute_dtype(out)
+    inverse = compute(1 / probability_scale(b))
+    low_quality = np.zeros(len(ploidy), dtype=bool)
+
+    if phased:
+        probs, sample, _ = _haplotype_probabilities(values, b, ploidy, k)
+        if hard_call:
+            other = (probs.argmax(axis=1) != 0).astype(np.int64)
+        else:
+            other = probability_scale(b) - probs[:, 0]
+        out[:] = np.multiply(np.bincount(sample, other, minlength=len(ploidy)), 1 if hard_call else inverse,
+                             dtype=compute, casting="unsafe")
+
+        if cutoff is not None:
+            low_quality[sample[probs.max(axis=1) < cutoff]] = True
+
+    else:
+        for samples, probs, table in _genotype_groups(values, b, ploidy, k):
+            others = table[:, 1:].sum(axis=1)
+            if hard_call:
+                out[samples] = others[probs.argmax(axis=1)]
+            else:
+                out[samples] = np.multiply(probs @ others, inverse, dtype=compute, casting="unsafe")
+
+            if cutoff is not None:
+                low_quality[samples] = probs.max(axis=1) < cutoff
+
+    out[low_quality] = np.nan
+    out[missing] = np.nan
+    return out
@@ -1,9 +1,16 @@
 from . import errors_codes as ec
-from math import ceil
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from threading import Lock
+from pathlib import Path
 import numpy as np
+import sqlite3
 import struct
 import os
 
+# Platforms without os.pread fall back to seek and read, which must not interleave between threads
+_seek_lock = Lock()
+
 
 def set_bgi(bgi_present, base_file_path):
     """
@@ -26,6 +33,23 @@ def set_bgi(bgi_present, base_file_path):
         raise TypeError(ec.bgi_path_violation(bgi_present))
 
 
+def set_sidecar(sidecar, base_file_path):
+    """
+    The path to a sidecar index, either named base_file_path.vti in the same directory or provided as a path, or None
+    if a sidecar was not requested
+    """
+    if not sidecar:
+        return None
+    elif isinstance(sidecar, (str, Path)):
+        sidecar_path = Path(sidecar)
+    else:
+        sidecar_path = Path(f"{base_file_path}.vti")
+
+    if not sidecar_path.is_file():
+        raise IOError(f"{sidecar_path} was not found")
+    return sidecar_path
+
+
 def bits_to_int(bits):
     """Converts bits to int."""
     result = 0
@@ -40,41 +64,259 @@ def byte_to_int(byte):
     return byte
 
 
-def pack_bits(data, b):
-    """Unpacks BGEN probabilities (as bits)."""
-    # Getting the data from the bytes
-    data = np.fromiter(
-        ((byte_to_int(byte) >> i) & 1 for byte in data for i in range(8)),
-        dtype=bool,
-    )
-    data.shape = (data.shape[0] // b, b)
+def struct_unpack(struct_format, data, list_return=False):
+    if list_return:
+        return struct.unpack(struct_format, data)
+    else:
+        return struct.unpack(struct_format, data)[0]
+
+
+def length_prefixed_strings(data, count):
+    """
+    Split a buffer of count strings, each prefixed by its length as a little endian uint16, such as the sample
+    identifier block of a bgen. When every string has the same length, as is common for sample ids, the buffer is a
+    fixed width table that is split and decoded in one vectorised step, otherwise it is walked from a memoryview.
 
-    # Finding the closest full bytes (if required)
-    # TODO: Improve this so that it is more efficient
-    full_bytes = data[:, ::-1]
-    if data.shape[1] % 8 != 0:
-        nb_bits = int(ceil(b / 8)) * 8
-        full_bytes = np.zeros((data.shape[0], nb_bits), dtype=bool)
-        full_bytes[:, -b:] += data[:, ::-1]
+    :param data: The strings, without the block length or count
+    :type data: bytes
 
-    # Packing the bits
-    packed = np.packbits(full_bytes, axis=1)
+    :param count: The number of strings
+    :type count: int
 
-    # Left-shifting for final value
-    final = packed[:, 0]
-    for i in range(1, packed.shape[1]):
-        final = np.left_shift(final, 8, dtype=np.uint) | packed[:, i]
+    :return: An array of the strings
+    :rtype: np.ndarray
+    """
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if count == 0 or len(buffer) < 2:
+        return np.array([], dtype=str)
 
-    return final
+    width = int(buffer[0]) | int(buffer[1]) << 8
+    if width > 0 and len(buffer) == count * (width + 2):
+        rows = buffer.reshape(count, width + 2)
+        if np.all((rows[:, 0].astype(np.uint16) | rows[:, 1].astype(np.uint16) << 8) == width):
+            characters = rows[:, 2:]
+            # ASCII bytes are their own code points, so widening them to UCS4 is the decoded array
+            if np.all(characters < 128):
+                return np.ascontiguousarray(characters, dtype="<u4").view(f"<U{width}").ravel()
+            return np.char.decode(np.ascontiguousarray(characters).view(f"S{width}").ravel(), "utf-8")
 
+    view, strings, position = memoryview(data), [], 0
+    for _ in range(count):
+        length = view[position] | view[position + 1] << 8
+        strings.append(bytes(view[position + 2:position + 2 + length]).decode())
+        position += 2 + length
+    return np.array(strings)
 
-def struct_unpack(struct_format, data, list_return=False):
-    if list_return:
-        return struct.unpack(struct_format, data)
-    else:
-        return struct.unpack(struct_format, data)[0]
 
+def read_sample_file(sample_path):
+    """
+    Read the ID_1 and ID_2 columns of a .sample file in one bulk read, splitting each line into its whitespace
+    separated fields. The header line naming the columns and the line of their types are skipped, and every other line
+    must have a field for each column so no value is shifted onto another sample.
+
+    :param sample_path: The path to the .sample file
+    :type sample_path: Path | str
+
+    :return: An array of (samples, 2) of the ID_1 and ID_2 of each sample
+    :rtype: np.ndarray
+    """
+    with open(sample_path, "r") as sample_file:
+        lines = sample_file.read().splitlines()
+
+    header = lines[0].split() if lines else []
+    assert len(header) >= 2 and header[0].upper() == "ID_1" and header[1].upper() == "ID_2", \
+        ec.sample_file_violation(sample_path, header)
+
+    rows = [line.split() for line in lines[2:] if line.strip()]
+    assert all([len(row) == len(header) for row in rows]), ec.sample_file_violation(sample_path, header)
+    return np.array(rows, dtype=str).reshape(-1, len(header))[:, :2]
+
+
+def open_positional(file_path):
+    """
+    Open a file descriptor for positional reads, which unlike a file object has no shared position so can be read from
+    many threads at once
+
+    :param file_path: Path to the file
+    :type file_path: Path | str
+
+    :return: The file descriptor
+    :rtype: int
+    """
+    return os.open(file_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+
+
+def positional_read(file_descriptor, offset, size):
+    """
+    Read size bytes from offset without altering any shared file position
+
+    :param file_descriptor: A file descriptor from open_positional
+    :type file_descriptor: int
+
+    :param offset: The byte offset to start reading from
+    :type offset: int
+
+    :param size: The number of bytes to read
+    :type size: int
+
+    :return: The bytes read
+    :rtype: bytes
+    """
+    if hasattr(os, "pread"):
+        return os.pread(file_descriptor, size, offset)
+
+    with _seek_lock:
+        os.lseek(file_descriptor, offset, os.SEEK_SET)
+        return os.read(file_descriptor, size)
+
+
+def positional_readline(file_descriptor, offset, read_size=4096):
+    """
+    Read the line starting at offset without altering any shared file position
+
+    :param file_descriptor: A file descriptor from open_positional
+    :type file_descriptor: int
+
+    :param offset: The byte offset of the start of the line
+    :type offset: int
+
+    :param read_size: The number of bytes read at a time whilst looking for the end of the line
+    :type read_size: int
 
-def no_decompress(data):
-    """Don't decompress"""
-    return data
+    :return: The line, including its newline unless it is the last line of the file
+    :rtype: bytes
+    """
+    line = b""
+    while True:
+        data = positional_read(file_descriptor, offset + len(line), read_size)
+        end = data.find(b"\n")
+        if end >= 0 or len(data) < read_size:
+            return line + (data if end < 0 else data[:end + 1])
+        line += data
+
+
+def connect_read_only(database_path):
+    """
+    Open a read only connection to an sqlite database, such as a .bgi. Connections can only be used within the thread
+    that made them, so each thread reading an index needs its own.
+
+    :param database_path: Path to the database
+    :type database_path: Path | str
+
+    :return: The connection
+    :rtype: sqlite3.Connection
+    """
+    return sqlite3.connect(f"{Path(database_path).absolute().as_uri()}?mode=ro", uri=True)
+
+
+def prefetch_map(function, items, workers=None, prefetch=4):
+    """
+    Lazily map function over items within a pool of background threads, keeping up to prefetch results in flight ahead
+    of the consumer whilst yielding them in the order of items. Decompression and most NumPy operations release the
+    GIL, so reading ahead overlaps with whatever the consumer does with each result.
+
+    :param function: The function to call on each item
+    :type function: Callable
+
+    :param items: The items to map function over
+    :type items: Iterable
+
+    :param workers: The number of threads to use, defaults to prefetch
+    :type workers: int | None
+
+    :param prefetch: The number of results to read ahead of the consumer
+    :type prefetch: int
+
+    :return: A generator of the results of function in the order of items
+    :rtype: Generator
+    """
+    prefetch = max(prefetch, 1)
+    with ThreadPoolExecutor(max_workers=workers or prefetch) as executor:
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(function, item))
+                if len(pending) > prefetch:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+
+        # If the consumer stops early we don't want to wait on results no one will use
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def batch_items(items, batch_size):
+    """
+    Split a sequence into consecutive batches of at most batch_size
+
+    :param items: The sequence to split
+    :type items: list | np.ndarray
+
+    :param batch_size: The maximum length of each batch
+    :type batch_size: int
+
+    :return: A generator of the batches
+    :rtype: Generator
+    """
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def group_batches(groups, batch_size):
+    """
+    Split the indexes of a sequence into consecutive batches of at most batch_size that never span two groups, such as
+    chromosomes, so that each batch can be worked on independently of other groups
+
+    :param groups: The group of each item, where the items of each group are consecutive
+    :type groups: list | np.ndarray
+
+    :param batch_size: The maximum length of each batch
+    :type batch_size: int
+
+    :return: A generator of the indexes of each batch
+    :rtype: Generator
+    """
+    groups = np.asarray(groups)
+    boundaries = np.flatnonzero(groups[1:] != groups[:-1]) + 1
+    for group in np.split(np.arange(len(groups)), boundaries):
+        yield from batch_items(group, batch_size)
+
+
+def output_dtype(dtype):
+    """
+    Validate the type requested for dense dosage, being float32, float16 or uint8 for quantised dosage
+
+    :param dtype: The type requested
+    :type dtype: type | str | np.dtype
+
+    :return: The type
+    :rtype: np.dtype
+    """
+    dtype = np.dtype(dtype)
+    assert dtype in (np.float32, np.float16, np.uint8), ec.output_dtype_violation(dtype)
+    return dtype
+
+
+def chunk_size_from_budget(chunk_size, byte_budget, variant_bytes):
+    """
+    Set the number of variants per chunk, either directly or as the number of variants that fit within a byte budget
+
+    :param chunk_size: The number of variants in each chunk, used if byte_budget is None
+    :type chunk_size: int
+
+    :param byte_budget: The maximum bytes the decoded chunk may take, or None
+    :type byte_budget: int | None
+
+    :param variant_bytes: The number of bytes a single decoded variant takes
+    :type variant_bytes: int
+
+    :return: The number of variants in each chunk, which is always at least 1
+    :rtype: int
+    """
+    if byte_budget is None:
+        return max(int(chunk_size), 1)
+    else:
+        return max(int(byte_budget // max(variant_bytes, 1)), 1)
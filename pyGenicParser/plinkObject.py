@@ -1,56 +1,185 @@
 from .variantObjects import BimVariant, FamId, Variant
+from .variantTable import VariantTable
+from .sampleAccumulator import SampleAccumulator
+from .polygenicScore import ScoreWeights
+from .sparseDosage import SparseDosage
+from .sampleMajorStore import write_sample_major
+from .genotypeArray import GenotypeArray
+from .bgenWriter import BgenWriter
+from .stats import ParserStats
 from . import errors_codes as ec
+from . import kernels as kn
 from . import misc as mc
 
 from pathlib import Path
+from math import ceil
 import numpy as np
+from threading import local
 import sqlite3
+import os
 
 
 class PlinkObject:
-    def __init__(self, genetic_path, bgi_present=False):
+    def __init__(self, genetic_path, bgi_present=False, stats=None, sidecar=None):
+        """
+
+        :param genetic_path: The path to the plink files, with or without a plink suffix
+        :type genetic_path: Path | str
+
+        :param bgi_present: If True, connect to the .bim.bgi made by create_bim_bgi
+        :type bgi_present: bool
+
+        :param stats: Records per stage timers and counters of the work done. A new one is created if not provided
+        :type stats: ParserStats | None
+
+        :param sidecar: Takes a value of True if a sidecar made by create_sidecar is in the same directory and named
+            bim_file_path.vti, otherwise can be passed as a path. If set, variants are looked up from the memory mapped
+            sidecar rather than the .bim.bgi
+        :type sidecar: bool | str | Path | None
+        """
+        self.stats = stats if stats is not None else ParserStats()
         self.bed_file_path, self.bim_file_path, self.fam_file_path = self.validate_paths(genetic_path)
-        self.bim_file = open(self.bim_file_path, "r")
-        self.fam_file = open(self.fam_file_path, "r")
 
-        # Set the bgi file if present, and store this for indexing if required.
+        # Lines of the .bim are read positionally, so one object can be read from many threads without a shared seek
+        self._bim_binary = open(self.bim_file_path, "rb", buffering=0)
+
+        # Set the bgi file if present, and store this for indexing if required. Each thread queries the .bim.bgi through
+        # its own read only connection, as sqlite connections and cursors cannot be shared between threads
         self.bgi_present = bgi_present
         self.bgi_file = mc.set_bgi(self.bgi_present, self.bim_file_path)
+        self._thread_index = local()
         if self.bgi_file:
             self.bim_connection, self.bim_index = self._connect_to_bgi_index()
+            self._thread_index.cursor = self.bim_index
         else:
             self.bim_connection, self.bim_index = None, None
 
+        sidecar_path = mc.set_sidecar(sidecar, self.bim_file_path)
+        self.variant_table = VariantTable.from_sidecar(sidecar_path) if sidecar_path else None
+
     def close_all(self):
         """Close all open files"""
-        self.bim_file.close()
-        self.fam_file.close()
+        self._bim_binary.close()
 
     def info_array(self, as_variant=False):
         """Return an array of all the variants in the bgen file"""
-        assert self.bim_index, ec.index_violation("info_array")
+        assert self.bim_index or self.variant_table, ec.index_violation("info_array")
         if as_variant:
-            self.bim_index.execute("SELECT chromosome, position, rsid, allele1, allele2 FROM Variant")
+            rows = self._index_rows(["chromosome", "position", "rsid", "allele1", "allele2"])
             return np.array([Variant(chromosome, position, snp_id, a1, a2) for chromosome, position, snp_id, a1, a2
-                             in self.bim_index.fetchall()])
+                             in rows])
         else:
-            self.bim_index.execute("SELECT chromosome, rsid, morgan_pos, position, allele1, allele2 FROM Variant")
+            rows = self._index_rows(["chromosome", "rsid", "morgan_pos", "position", "allele1", "allele2"])
             return np.array([BimVariant(chromosome, variant_id, morgan_pos, bp_position, a1, a2)
-                             for chromosome, variant_id, morgan_pos, bp_position, a1, a2 in self.bim_index.fetchall()])
+                             for chromosome, variant_id, morgan_pos, bp_position, a1, a2 in rows])
 
     def info_from_sid(self, snp_names, as_variant=False):
         """Construct an array of variant identifiers for all the snps provided to snp_names"""
-        assert self.bim_index, ec.index_violation("variant_info_from_sid")
+        assert self.bim_index or self.variant_table, ec.index_violation("variant_info_from_sid")
         if as_variant:
-            self.bim_index.execute("SELECT chromosome, position, rsid, allele1, allele2 FROM Variant"
-                                   " WHERE rsid IN {}".format(tuple(snp_names)))
+            rows = self._index_rows(["chromosome", "position", "rsid", "allele1", "allele2"], snp_names)
             return np.array([Variant(chromosome, position, snp_id, a1, a2) for chromosome, position, snp_id, a1, a2
-                             in self.bim_index.fetchall()])
+                             in rows])
         else:
-            self.bim_index.execute("SELECT chromosome, rsid, morgan_pos, position, allele1, allele2 FROM Variant"
-                                   " WHERE rsid IN {}".format(tuple(snp_names)))
+            rows = self._index_rows(["chromosome", "rsid", "morgan_pos", "position", "allele1", "allele2"], snp_names)
             return np.array([BimVariant(chromosome, variant_id, morgan_pos, bp_position, a1, a2)
-                             for chromosome, variant_id, morgan_pos, bp_position, a1, a2 in self.bim_index.fetchall()])
+                             for chromosome, variant_id, morgan_pos, bp_position, a1, a2 in rows])
+
+    def _index_rows(self, columns, snp_names=None):
+        """
+        Fetch columns of the Variant table for all variants, or only those whose rsid is within snp_names, in file
+        order. Rows come from the sidecar if one was opened, otherwise from the .bim.bgi.
+
+        :param columns: The names of the columns of the Variant table to fetch
+        :type columns: list[str]
+
+        :param snp_names: The rsids of the variants to fetch, or None for all variants
+        :type snp_names: list | np.ndarray | None
+
+        :return: The rows
+        :rtype: list
+        """
+        if self.variant_table is not None:
+            with self.stats.time("index"):
+                indexes = None if snp_names is None else self.variant_table.rsid_indexes(snp_names)
+                rows = self.variant_table.rows(columns, indexes)
+            self.stats.add("index_rows", len(rows))
+            return rows
+
+        sql = f"SELECT {', '.join(columns)} FROM Variant"
+        if snp_names is None:
+            return self._query(sql)
+        # A tuple of 1 will lead to sql crashing if using IN, so we need to account for length 1 arrays
+        elif len(snp_names) == 1:
+            return self._query(f"{sql} WHERE rsid = '{snp_names[0]}'")
+        else:
+            return self._query(f"{sql} WHERE rsid IN {tuple(snp_names)}")
+
+    def create_sidecar(self, write_path=None):
+        """
+        Write the variants as a sidecar, a compact binary index that can be memory mapped, which is quicker to open
+        and query than the .bim.bgi. The variants are taken from the .bim.bgi if there is one, otherwise from the .bim.
+
+        :param write_path: The path to write the sidecar to, defaults to bim_file_path.vti
+        :type write_path: Path | str | None
+
+        :return: The path the sidecar was written to
+        :rtype: Path
+        """
+        write_path = Path(f"{self.bim_file_path.absolute()}.vti") if write_path is None else Path(write_path)
+        self.load_variant_table().to_sidecar(write_path)
+        return write_path
+
+    def load_variant_table(self):
+        """
+        Hold the variants in memory as a VariantTable of VariantTable.BIM_COLUMNS, so later lookups use it rather than
+        the .bim.bgi. The variants are taken from the .bim.bgi if there is one, otherwise from the .bim.
+
+        :return: The variant table
+        :rtype: VariantTable
+        """
+        if self.variant_table is not None:
+            self.stats.add("cache_hits")
+            return self.variant_table
+
+        if self.bim_index:
+            rows = self._query(f"SELECT {', '.join(VariantTable.BIM_COLUMNS)} FROM Variant")
+        else:
+            # See https://www.cog-genomics.org/plink/1.9/formats#bed for the position of each variant in the .bed
+            variant_size = int(ceil(self._sample_number() / 4))
+            rows, cumulative_seek = [], 0
+            with open(self.bim_file_path, "r") as bim_file:
+                for index, line in enumerate(bim_file):
+                    chromosome, variant_id, morgan_pos, bp_position, a1, a2 = line.split()
+                    rows.append([3 + index * variant_size, cumulative_seek, variant_id, chromosome, morgan_pos,
+                                 bp_position, a1, a2])
+                    cumulative_seek += len(line)
+
+        self.variant_table = VariantTable.from_rows(rows, VariantTable.BIM_COLUMNS)
+        return self.variant_table
+
+    def _query(self, sql):
+        """
+        Execute a query against the index and fetch all of its rows
+
+        :param sql: The query
+        :type sql: str
+
+        :return: The rows
+        :rtype: list
+        """
+        with self.stats.time("sql"):
+            rows = self._index_cursor().execute(sql).fetchall()
+        self.stats.add("sql_rows", len(rows))
+        return rows
+
+    def _index_cursor(self):
+        """The cursor of this thread's read only connection to the .bim.bgi, connecting on its first query"""
+        cursor = getattr(self._thread_index, "cursor", None)
+        if cursor is None:
+            cursor = mc.connect_read_only(f"{self.bim_file_path.absolute()}.bgi").cursor()
+            self._thread_index.cursor = cursor
+        return cursor
 
     def create_bim_bgi(self, bgi_write_path=None):
         """
@@ -68,7 +197,6 @@ class PlinkObject:
 
         if Path(write_path).exists():
             print(f"Bgi Already exists for {self.bim_file_path.name}")
-            self.close_all()
         else:
             # Establish the connection
             connection = sqlite3.connect(write_path)
@@ -80,7 +208,6 @@ class PlinkObject:
             # Set the number of snps to the be the length of the dict, and get the length of iid from fam length
             sid_count = len(bim_dict)
             iid_count = len(self.get_family_identifiers())
-            self.close_all()
 
             # Construct the bed array based on its byte formula
             # See https://www.cog-genomics.org/plink/1.9/formats#bed
@@ -121,7 +248,7 @@ class PlinkObject:
 
     def _connect_to_bgi_index(self):
         """Connect to the index (which is an SQLITE database)."""
-        bim_file = sqlite3.connect(str(self.bim_file_path.absolute()) + ".bgi")
+        bim_file = mc.connect_read_only(f"{self.bim_file_path.absolute()}.bgi")
         return bim_file, bim_file.cursor()
 
     def construct_bim_index(self, bgi_index=False):
@@ -131,13 +258,14 @@ class PlinkObject:
         """
         indexer = {}
         cumulative_seek = 0
-        for line in self.bim_file:
-            chromosome, variant_id, morgan_pos, bp_position, a1, a2 = line.split()
-            if bgi_index:
-                indexer[variant_id] = [cumulative_seek, variant_id, chromosome, morgan_pos, bp_position, a1, a2]
-            else:
-                indexer[variant_id] = cumulative_seek
-            cumulative_seek += len(line)
+        with open(self.bim_file_path, "r") as bim_file:
+            for line in bim_file:
+                chromosome, variant_id, morgan_pos, bp_position, a1, a2 = line.split()
+                if bgi_index:
+                    indexer[variant_id] = [cumulative_seek, variant_id, chromosome, morgan_pos, bp_position, a1, a2]
+                else:
+                    indexer[variant_id] = cumulative_seek
+                cumulative_seek += len(line)
 
         return indexer
 
@@ -148,22 +276,520 @@ class PlinkObject:
         :param as_variant: If you want it as a standardised across parameter variant, or a Bim Variant with morgan pos
         :return: The line
         """
-        self.bim_file.seek(seek)
-        chromosome, variant_id, morgan_pos, bp_position, a1, a2 = self.bim_file.readline().split()
+        line = mc.positional_readline(self._bim_binary.fileno(), seek).decode()
+        chromosome, variant_id, morgan_pos, bp_position, a1, a2 = line.split()
 
         if as_variant:
             return BimVariant(chromosome, variant_id, morgan_pos, bp_position, a1, a2).to_variant()
         else:
             return BimVariant(chromosome, variant_id, morgan_pos, bp_position, a1, a2)
 
+    def iter_variants(self, batch_size=1000, prefetch=4, workers=None, as_variant=False, sparse=False,
+                      dtype=np.float32):
+        """
+        Iterate through the variants of the .bed in batches, whilst a pool of background threads reads and decodes the
+        following batches so that disk reads overlap with whatever is done with each batch. Does not require a .bgi, as
+        the .bim is read sequentially and the position of each variant within the .bed follows from its index.
+
+        :param batch_size: The number of variants in each batch
+        :type batch_size: int
+
+        :param prefetch: The number of batches to read ahead of the consumer
+        :type prefetch: int
+
+        :param workers: The number of background threads, defaults to prefetch
+        :type workers: int | None
+
+        :param as_variant: If you want it as a standardised across parameter variant, or a Bim Variant with morgan pos
+        :type as_variant: bool
+
+        :param sparse: If True, each batch of dosage is a SparseDosage of (iid, variants) decoded straight from the
+            2 bit codes, for rare variants whose dosage is mostly zero
+        :type sparse: bool
+
+        :param dtype: The type of the dense dosage, float32, float16 or uint8 where uint8 is quantised dosage as in
+            kernels.quantised_dosage_kernel, looked up straight from the 2 bit codes
+        :type dtype: type
+
+        :return: A generator of (variants, dosage) where dosage is an array of (variants, iid) of the count of a2
+        :rtype: Generator
+        """
+        sample_number = self._sample_number()
+        file_descriptor = mc.open_positional(self.bed_file_path)
+        try:
+            self._validate_bed(file_descriptor)
+            yield from mc.prefetch_map(lambda batch: self._read_bed_batch(file_descriptor, batch, sample_number,
+                                                                          sparse, dtype),
+                                       self._bim_batches(batch_size, as_variant), workers, prefetch)
+        finally:
+            os.close(file_descriptor)
+
+    def dosage_chunks(self, chunk_size=1000, byte_budget=None, prefetch=2, as_variant=False, sparse=False,
+                      dtype=np.float32):
+        """
+        Iterate through the variants of the .bed in contiguous chunks, decoding each chunk into a single preallocated
+        (iid, chunk) buffer that is reused for every chunk, so a full pass of the file runs in bounded memory. The raw
+        bytes of the following chunks are read in the background whilst the current chunk is used.
+
+        Note
+        -----
+        As the buffer is reused, the dosage yielded is overwritten by the next chunk so copy it if it needs keeping.
+
+        :param chunk_size: The number of variants in each chunk
+        :type chunk_size: int
+
+        :param byte_budget: If set, the chunk size is instead the number of variants whose dosage fit within this many
+            bytes
+        :type byte_budget: int | None
+
+        :param prefetch: The number of chunks to read ahead of the consumer
+        :type prefetch: int
+
+        :param as_variant: If you want it as a standardised across parameter variant, or a Bim Variant with morgan pos
+        :type as_variant: bool
+
+        :param sparse: If True, each chunk is instead a new SparseDosage of (iid, variants), so no buffer is allocated
+            and byte_budget is ignored
+        :type sparse: bool
+
+        :param dtype: The type of the buffer, float32, float16 or uint8 as in iter_variants, so smaller types fit more
+            variants within byte_budget
+        :type dtype: type
+
+        :return: A generator of (variants, dosage) where dosage is a view of the buffer of (iid, variants)
+        :rtype: Generator
+        """
+        if sparse:
+            yield from self.iter_variants(chunk_size, prefetch, 1, as_variant, sparse=True)
+            return
+
+        sample_number = self._sample_number()
+        variant_size = int(ceil(sample_number / 4))
+        dtype = mc.output_dtype(dtype)
+        chunk_size = mc.chunk_size_from_budget(chunk_size, byte_budget, sample_number * dtype.itemsize)
+        buffer = np.empty((sample_number, chunk_size), dtype=dtype, order="F")
+
+        def read_chunk(batch):
+            start, variants = batch
+            return variants, self._read_bed(file_descriptor, 3 + start * variant_size, variant_size * len(variants))
+
+        file_descriptor = mc.open_positional(self.bed_file_path)
+        try:
+            self._validate_bed(file_descriptor)
+            for variants, data in mc.prefetch_map(read_chunk, self._bim_batches(chunk_size, as_variant),
+                                                  prefetch=prefetch):
+                data = memoryview(data)
+                with self.stats.time("decode"):
+                    for i in range(len(variants)):
+                        kn.bed_dosage_kernel(data[i * variant_size:(i + 1) * variant_size], sample_number, buffer[:, i])
+                self.stats.add("blocks_decoded", len(variants))
+
+                variant_array = np.empty(len(variants), dtype=object)
+                variant_array[:] = variants
+                yield variant_array, buffer[:, :len(variants)]
+        finally:
+            os.close(file_descriptor)
+
+    def to_bgen(self, write_path, bit_depth=8, compression=1, workers=None, batch_size=1000, bgi=True):
+        """
+        Convert the plink files into a layout 2 bgen, with the IID of each sample as its sample identifier. The .bed is
+        read sequentially in batches whilst the genotype blocks are compressed by a pool of worker processes, so the
+        conversion runs in bounded memory.
+
+        :param write_path: The path to write the bgen to
+        :type write_path: Path | str
+
+        :param bit_depth: The number of bits used to store each probability, hard calls are exact at any bit depth
+        :type bit_depth: int
+
+        :param compression: 0 for uncompressed, 1 for zlib, 2 for zstd
+        :type compression: int
+
+        :param workers: The number of worker processes compressing blocks, defaults to the cpu count
+        :type workers: int | None
+
+        :param batch_size: The number of variants read at a time
+        :type batch_size: int
+
+        :param bgi: Write a .bgi alongside the bgen if True, or at this path if a path is provided
+        :type bgi: bool | Path | str
+
+        :return: Nothing, writes the files then stops
+        :rtype: None
+        """
+        with open(self.fam_file_path, "r") as fam_file:
+            sample_ids = [line.split()[1] for line in fam_file if line.strip()]
+
+        with BgenWriter(write_path, len(sample_ids), bit_depth, compression, sample_ids, bgi, workers,
+                        stats=self.stats) as writer:
+            for variants, dosage in self.iter_variants(batch_size, as_variant=True):
+                writer.write(variants, dosage)
+
+    def variant_qc(self, batch_size=100, prefetch=4, workers=None):
+        """
+        Compute the minor allele frequency, call rate, Hardy Weinberg p value and the IMPUTE info and MaCH r2 scores of
+        every variant in a single streaming pass of the .bed, treating each call as certain so info and r2 are 1 for
+        every polymorphic variant. Batches are read, decoded and summarised by a pool of background threads.
+
+        :param batch_size: The number of variants in each batch
+        :type batch_size: int
+
+        :param prefetch: The number of batches to summarise ahead of the consumer
+        :type prefetch: int
+
+        :param workers: The number of background threads, defaults to prefetch
+        :type workers: int | None
+
+        :return: A table of VariantTable.QC_COLUMNS, with a row for each variant
+        :rtype: VariantTable
+        """
+        return VariantTable.from_variant_qc(self._map_probabilities(
+            lambda variants, probs: (variants, kn.variant_qc_kernel(probs)), batch_size, prefetch, workers))
+
+    def sample_qc(self, batch_size=100, prefetch=4, workers=None):
+        """
+        Accumulate the missing rate, heterozygosity and dosage of every sample within the .fam over all variants in a
+        single streaming pass, in memory proportional to the number of samples. Each batch is summed by a pool of
+        background threads into its own accumulator, which are merged as they complete.
+
+        :param batch_size: The number of variants in each batch
+        :type batch_size: int
+
+        :param prefetch: The number of batches to sum ahead of the merge
+        :type prefetch: int
+
+        :param workers: The number of background threads, defaults to prefetch
+        :type workers: int | None
+
+        :return: The accumulated sums, whose summary gives the statistics of each sample in the order of the .fam
+        :rtype: SampleAccumulator
+        """
+        sample_number = self._sample_number()
+        accumulator = SampleAccumulator(sample_number)
+        for batch_accumulator in self._map_probabilities(
+                lambda variants, probs: SampleAccumulator(sample_number).update(probs), batch_size, prefetch, workers):
+            accumulator.merge(batch_accumulator)
+        return accumulator
+
+    def polygenic_score(self, weights, batch_size=1000, prefetch=4, workers=None):
+        """
+        Score every sample within the .fam on one or more polygenic scores. The variants of the weights are resolved to
+        their position within the .bed with a single lookup of the index, or a single pass of the .bim if there is no
+        index, and their alleles aligned to the weights before any genotype data is read. Batches are then read in file
+        order, with the batches of each chromosome scored by a pool of background threads and summed.
+
+        Missing calls are imputed as the mean dosage of the variant, and variants whose alleles do not include the
+        effect allele are skipped, being counted as score_mismatched within stats alongside score_variants. The weights
+        of an rsid with many rows are summed, each row after the first being counted as score_duplicates.
+
+        :param weights: The weights, or the path to a weight file of rsid, effect allele and weights
+        :type weights: ScoreWeights | Path | str
+
+        :param batch_size: The number of variants in each batch
+        :type batch_size: int
+
+        :param prefetch: The number of batches to score ahead of the sum
+        :type prefetch: int
+
+        :param workers: The number of background threads, defaults to prefetch
+        :type workers: int | None
+
+        :return: A float64 array of (iid, scores) of the score of each sample, in the order of weights.names
+        :rtype: np.ndarray
+        """
+        weights = ScoreWeights.load(weights)
+        sample_number = self._sample_number()
+        variant_size = int(ceil(sample_number / 4))
+
+        columns = ["bed_start_position", "chromosome", "rsid", "allele1", "allele2"]
+        if self.variant_table is not None or self.bim_index:
+            rows = self._index_rows(columns, weights.rsids)
+        else:
+            rows = self._scan_bim_rows(weights.rsids, variant_size)
+        bed_starts = np.array([row[0] for row in rows], dtype=np.int64)
+        chromosome, rsid, a1, a2 = [np.array([row[i] for row in rows], dtype=object) for i in range(1, 5)]
+
+        variant_weights, offset, mismatched, duplicates = weights.align(rsid, a1, a2)
+        self.stats.add("score_variants", len(rows) - mismatched)
+        self.stats.add("score_mismatched", mismatched)
+        self.stats.add("score_duplicates", duplicates)
+
+        def score_batch(indexes):
+            dosage = self._read_bed_variants(file_descriptor, bed_starts[indexes], sample_number)
+            with self.stats.time("score"):
+                return kn.score_kernel(dosage, variant_weights[indexes])
+
+        scores = np.tile(offset, (sample_number, 1))
+        file_descriptor = mc.open_positional(self.bed_file_path)
+        try:
+            self._validate_bed(file_descriptor)
+            for batch_scores in mc.prefetch_map(score_batch, mc.group_batches(chromosome, batch_size), workers,
+                                                prefetch):
+                scores += batch_scores
+        finally:
+            os.close(file_descriptor)
+        return scores
+
+    def _scan_bim_rows(self, snp_names, variant_size):
+        """
+        The bed_start_position, chromosome, rsid, allele1 and allele2 of each variant whose rsid is within snp_names,
+        from a single pass of the .bim, in file order
+        """
+        snp_names = set(snp_names)
+        rows = []
+        with self.stats.time("scan"), open(self.bim_file_path, "r") as bim_file:
+            for index, line in enumerate(bim_file):
+                chromosome, variant_id, morgan_pos, bp_position, a1, a2 = line.split()
+                if variant_id in snp_names:
+                    # See https://www.cog-genomics.org/plink/1.9/formats#bed, the 3 bytes being the magic number
+                    rows.append([3 + index * variant_size, chromosome, variant_id, a1, a2])
+        return rows
+
+    def _map_probabilities(self, function, batch_size, prefetch, workers):
+        """
+        Read the hard calls of every variant in batches as the probabilities of certain calls, yielding
+        function(variants, probs) of each batch in order, where probs is an array of (variants, iid, 3). Batches are
+        read, decoded and passed to function by a pool of background threads, with the time spent within function
+        recorded as the qc stage.
+        """
+        sample_number = self._sample_number()
+
+        def map_batch(batch):
+            variants, calls = self._read_bed_batch(file_descriptor, batch, sample_number)
+            with self.stats.time("qc"):
+                return function(variants, kn.hard_calls_to_probabilities(calls))
+
+        file_descriptor = mc.open_positional(self.bed_file_path)
+        try:
+            self._validate_bed(file_descriptor)
+            yield from mc.prefetch_map(map_batch, self._bim_batches(batch_size, True), workers, prefetch)
+        finally:
+            os.close(file_descriptor)
+
+    def _bim_batches(self, batch_size, as_variant):
+        """Read the bim sequentially, yielding the index of the first variant and the variants of each batch"""
+        with open(self.bim_file_path, "r") as bim_file:
+            batch = []
+            start = 0
+            for index, line in enumerate(bim_file):
+                variant = BimVariant(*line.split())
+                batch.append(variant.to_variant() if as_variant else variant)
+
+                if len(batch) == batch_size:
+                    yield start, batch
+                    start, batch = index + 1, []
+
+            if batch:
+                yield start, batch
+
+    def _read_bed_batch(self, file_descriptor, batch, sample_number, sparse=False, dtype=np.float32):
+        """
+        Read and decode a batch of consecutive variants with a single positional read, which holds no state on the
+        object so can be run within threads
+
+        :param file_descriptor: A file descriptor from mc.open_positional
+        :type file_descriptor: int
+
+        :param batch: The index of the first variant, and the variants of the batch
+        :type batch: (int, list)
+
+        :param sample_number: The number of samples within the .fam
+        :type sample_number: int
+
+        :param sparse: If True, return the dosage as a SparseDosage
+        :type sparse: bool
+
+        :param dtype: The type of the dense dosage
+        :type dtype: type
+
+        :return: An array of variants, and the dosage of these variants
+        :rtype: (np.ndarray, np.ndarray | SparseDosage)
+        """
+        start, variants = batch
+        variant_size = int(ceil(sample_number / 4))
+
+        # See https://www.cog-genomics.org/plink/1.9/formats#bed, the 3 bytes being the magic number and mode
+        data = self._read_bed(file_descriptor, 3 + start * variant_size, variant_size * len(variants))
+
+        variant_array = np.empty(len(variants), dtype=object)
+        variant_array[:] = variants
+        return variant_array, self._decode_bed(data, len(variants), sample_number, sparse, dtype)
+
+    def _decode_bed(self, data, variant_number, sample_number, sparse=False, dtype=np.float32):
+        """
+        Decode the bytes of consecutive variants of the .bed
+
+        :return: The dosage as an array of (variants, iid) of dtype, or as a SparseDosage of (iid, variants) if sparse
+        :rtype: np.ndarray | SparseDosage
+        """
+        data = memoryview(data)
+        variant_size = int(ceil(sample_number / 4))
+
+        with self.stats.time("decode"):
+            if sparse:
+                dosage = SparseDosage.from_columns(
+                    [kn.bed_sparse_kernel(data[i * variant_size:(i + 1) * variant_size], sample_number)
+                     for i in range(variant_number)], sample_number)
+            else:
+                dosage = np.empty((variant_number, sample_number), dtype=mc.output_dtype(dtype))
+                for i in range(variant_number):
+                    kn.bed_dosage_kernel(data[i * variant_size:(i + 1) * variant_size], sample_number, dosage[i])
+        self.stats.add("blocks_decoded", variant_number)
+        return dosage
+
+    def as_array(self, dtype=np.float32, chunk_variants=1000):
+        """
+        A lazy view of the dosage of the .bed as an array of (variants, iid), as stacking iter_variants would return,
+        which only reads the variants it is indexed by
+
+        :param dtype: The type of the dosage, float32, float16 or uint8 as in iter_variants
+        :type dtype: type
+
+        :param chunk_variants: The number of variants of each chunk described to schedulers such as Dask
+        :type chunk_variants: int
+
+        :return: The view
+        :rtype: GenotypeArray
+        """
+        sample_number = self._sample_number()
+        return GenotypeArray((self._bed_variant_number(sample_number), sample_number),
+                             lambda indexes, array_dtype: self._read_variant_indexes(indexes, sample_number,
+                                                                                     array_dtype),
+                             dtype, chunk_variants)
+
+    def _read_variant_indexes(self, indexes, sample_number, dtype=np.float32):
+        """
+        Read the dosage of the variants at indexes, with a single read if they are consecutive
+
+        :return: The dosage as an array of (variants, iid)
+        :rtype: np.ndarray
+        """
+        variant_size = int(ceil(sample_number / 4))
+        file_descriptor = mc.open_positional(self.bed_file_path)
+        try:
+            self._validate_bed(file_descriptor)
+            if len(indexes) > 1 and np.all(np.diff(indexes) == 1):
+                data = self._read_bed(file_descriptor, 3 + int(indexes[0]) * variant_size, variant_size * len(indexes))
+                return self._decode_bed(data, len(indexes), sample_number, dtype=dtype)
+            return self._read_bed_variants(file_descriptor, 3 + indexes * variant_size, sample_number, dtype)
+        finally:
+            os.close(file_descriptor)
+
+    def to_sample_major(self, write_path, chunk_samples=16, compression=1, memory_budget=2 ** 28, prefetch=4,
+                        workers=None):
+        """
+        Transpose the genotypes of the .bed into a sample major store read by SampleMajorStore, so every genotype of an
+        individual is a single contiguous read. The transpose runs in bounded memory.
+
+        :param write_path: The path to write the store to
+        :type write_path: Path | str
+
+        :param chunk_samples: The number of samples compressed together, which are decompressed as a whole to read any
+            one of them
+        :type chunk_samples: int
+
+        :param compression: 0 for uncompressed, which can be memory mapped, 1 for zlib, 2 for zstd
+        :type compression: int
+
+        :param memory_budget: The bytes the batches of variants being transposed may take, including those read ahead
+        :type memory_budget: int
+
+        :param prefetch: The number of batches to read ahead of the transpose
+        :type prefetch: int
+
+        :param workers: The number of background threads, defaults to prefetch
+        :type workers: int | None
+
+        :return: Nothing, writes the store then stops
+        :rtype: None
+        """
+        # Each genotype takes four bytes decoded and one quantised
+        sample_number = self._sample_number()
+        batch_size = mc.chunk_size_from_budget(None, memory_budget // (prefetch + 1), sample_number * 5)
+        write_sample_major(write_path, self._dosage_batches(batch_size, 0, prefetch, workers), sample_number,
+                           self._bed_variant_number(sample_number), chunk_samples, compression, self.stats)
+
+    def _dosage_batches(self, batch_size, first_batch=0, prefetch=4, workers=None):
+        """
+        The dosage of each batch of variants, as an array of (variants, iid), from first_batch onwards so a pass that
+        was interrupted can be resumed from the batch it reached. The number of variants follows from the size of the
+        .bed, so the .bim is not read.
+        """
+        sample_number = self._sample_number()
+        variant_size = int(ceil(sample_number / 4))
+        variant_number = self._bed_variant_number(sample_number)
+
+        def read_batch(start):
+            count = min(batch_size, variant_number - start)
+            data = self._read_bed(file_descriptor, 3 + start * variant_size, variant_size * count)
+            return self._decode_bed(data, count, sample_number)
+
+        file_descriptor = mc.open_positional(self.bed_file_path)
+        try:
+            self._validate_bed(file_descriptor)
+            yield from mc.prefetch_map(read_batch, range(first_batch * batch_size, variant_number, batch_size),
+                                       workers, prefetch)
+        finally:
+            os.close(file_descriptor)
+
+    def _read_bed_variants(self, file_descriptor, bed_starts, sample_number, dtype=np.float32):
+        """
+        Read and decode the variants starting at each of bed_starts, which need not be consecutive
+
+        :param file_descriptor: A file descriptor from mc.open_positional
+        :type file_descriptor: int
+
+        :param bed_starts: The bed_start_position of each variant
+        :type bed_starts: np.ndarray
+
+        :param sample_number: The number of samples within the .fam
+        :type sample_number: int
+
+        :param dtype: The type of the dosage
+        :type dtype: type
+
+        :return: The dosage of these variants as an array of (variants, iid)
+        :rtype: np.ndarray
+        """
+        variant_size = int(ceil(sample_number / 4))
+        dosage = np.empty((len(bed_starts), sample_number), dtype=mc.output_dtype(dtype))
+        for i, start in enumerate(bed_starts):
+            data = self._read_bed(file_descriptor, int(start), variant_size)
+            with self.stats.time("decode"):
+                kn.bed_dosage_kernel(data, sample_number, dosage[i])
+        self.stats.add("blocks_decoded", len(bed_starts))
+        return dosage
+
+    def _read_bed(self, file_descriptor, start, size):
+        """Read size bytes of the .bed from start"""
+        with self.stats.time("read"):
+            data = mc.positional_read(file_descriptor, start, size)
+        self.stats.add("bytes_read", len(data))
+        return data
+
+    def _validate_bed(self, file_descriptor):
+        """Check the .bed has the plink magic number and is stored variant major"""
+        magic = mc.positional_read(file_descriptor, 0, 3)
+        assert magic == b"\x6c\x1b\x01", ec.bed_magic_violation(self.bed_file_path, magic)
+
+    def _bed_variant_number(self, sample_number):
+        """The number of variants, from the size of the .bed after its 3 byte magic number"""
+        return (os.path.getsize(self.bed_file_path) - 3) // int(ceil(sample_number / 4))
+
+    def _sample_number(self):
+        """The number of samples, being the number of lines within the .fam"""
+        with open(self.fam_file_path, "r") as fam_file:
+            return sum(1 for line in fam_file if line.strip())
+
     def get_family_identifiers(self):
         """
         This will iterate through the fam file and extract the information
         """
         fam_data = []
-        for line in self.fam_file:
-            fid, iid, i_fid, i_mid, sex, phenotype = line.split()
-            fam_data.append(FamId(fid, iid, i_fid, i_mid, sex, phenotype))
+        with open(self.fam_file_path, "r") as fam_file:
+            for line in fam_file:
+                fid, iid, i_fid, i_mid, sex, phenotype = line.split()
+                fam_data.append(FamId(fid, iid, i_fid, i_mid, sex, phenotype))
 
         return fam_data
 
@@ -0,0 +1,113 @@
+from . import errors_codes as ec
+
+from pathlib import Path
+import numpy as np
+
+
+class ScoreWeights:
+    def __init__(self, rsids, effect_alleles, weights, names=None):
+        """
+        The weights of one or more polygenic scores, each row being the rsid, the allele the weights are the effect of,
+        and the weight of each score
+
+        :param rsids: The rsid of each variant
+        :type rsids: list | np.ndarray
+
+        :param effect_alleles: The allele whose count each weight multiplies
+        :type effect_alleles: list | np.ndarray
+
+        :param weights: An array of (variants,) or (variants, scores) of the weight of each variant within each score.
+            An rsid may have many rows, whose weights are summed when aligned
+        :type weights: list | np.ndarray
+
+        :param names: The name of each score, defaults to score_0, score_1 ...
+        :type names: list[str] | None
+        """
+        self.rsids = np.asarray(rsids, dtype=object)
+        self.effect_alleles = np.array([str(allele).upper() for allele in effect_alleles], dtype=object)
+        # A file of only a header has no weights to infer the number of scores from, so it is taken from the names
+        if names is not None:
+            scores = len(names) or 1
+        else:
+            scores = -1 if len(self.rsids) else 1
+        self.weights = np.asarray(weights, dtype=np.float64).reshape(len(self.rsids), scores)
+        self.names = list(names) if names is not None else [f"score_{i}" for i in range(self.weights.shape[1])]
+
+        assert len(self.effect_alleles) == len(self.rsids), ec.column_length_violation()
+        assert len(self.names) == self.weights.shape[1], ec.column_length_violation()
+
+    def __repr__(self):
+        return f"ScoreWeights variants:scores -> {len(self.rsids)}:{len(self.names)}"
+
+    @classmethod
+    def load(cls, weights):
+        """Load weights from a weight file, or return them if they already are ScoreWeights"""
+        return weights if isinstance(weights, ScoreWeights) else cls.from_file(weights)
+
+    @classmethod
+    def from_file(cls, file_path, separator=None):
+        """
+        Read a weight file of rsid, effect allele and then one or more columns of weights. If the first line has a
+        weight that is not a number it is taken as a header, and the names of the weight columns as the score names.
+
+        :param file_path: The path to the weight file
+        :type file_path: Path | str
+
+        :param separator: The column separator, defaults to any whitespace
+        :type separator: str | None
+
+        :return: The weights
+        :rtype: ScoreWeights
+        """
+        with open(Path(file_path), "r") as weight_file:
+            lines = [line.strip().split(separator) for line in weight_file if line.strip()]
+
+        names = None
+        if lines:
+            try:
+                [float(weight) for weight in lines[0][2:]]
+            except ValueError:
+                names, lines = lines[0][2:], lines[1:]
+
+        return cls([line[0] for line in lines], [line[1] for line in lines], [line[2:] for line in lines], names)
+
+    def align(self, rsids, a1, a2):
+        """
+        Align the weights to variants of a file, where the dosage counts a2. Weights whose effect allele is a1 are
+        negated, with twice the weight added to the offset of the score, as w * (2 - dosage) = 2w - w * dosage.
+        Variants whose alleles do not include the effect allele are given a weight of zero. The aligned weights of every
+        row of an rsid are summed, so two rows of a weight of 1 score the same as one row of a weight of 2.
+
+        :param rsids: The rsid of each variant, each of which must be within the weights
+        :type rsids: np.ndarray
+
+        :param a1: The first allele of each variant
+        :type a1: np.ndarray
+
+        :param a2: The second allele of each variant, counted by the dosage
+        :type a2: np.ndarray
+
+        :return: An array of (variants, scores) of the aligned weight of each variant, the (scores,) offset of each
+            score, the number of variants whose alleles did not include the effect allele of any of their rows, and the
+            number of rows summed into the weights of a variant that already had a row
+        :rtype: (np.ndarray, np.ndarray, int, int)
+        """
+        lookup = {}
+        for index, rsid in enumerate(self.rsids):
+            lookup.setdefault(rsid, []).append(index)
+
+        # Each row of the weights against the variant of its rsid, so every row of a duplicated rsid is kept
+        matches = [lookup[rsid] for rsid in rsids]
+        variants = np.repeat(np.arange(len(rsids)), [len(match) for match in matches]).astype(np.int64)
+        rows = np.array([index for match in matches for index in match], dtype=np.int64)
+        effect = self.effect_alleles[rows]
+
+        sign = np.where(effect == np.char.upper(np.asarray(a2).astype(str))[variants], 1.0,
+                        np.where(effect == np.char.upper(np.asarray(a1).astype(str))[variants], -1.0, 0.0))
+        weights = np.zeros((len(rsids), len(self.names)), dtype=np.float64)
+        np.add.at(weights, variants, self.weights[rows] * sign[:, None])
+        offset = (2 * self.weights[rows] * (sign < 0)[:, None]).sum(axis=0)
+
+        matched = np.zeros(len(rsids), dtype=bool)
+        matched[variants[sign != 0]] = True
+        return weights, offset, int((~matched).sum()), len(rows) - len(rsids)
@@ -0,0 +1,168 @@
+from .bgenObject import BgenObject
+from . import errors_codes as ec
+from . import kernels as kn
+
+from hashlib import blake2b
+from pathlib import Path
+import numpy as np
+import os
+
+
+class GRMBuilder:
+    def __init__(self, genetic_object, batch_size=1000, prefetch=4, workers=None, samples=None, checkpoint=None,
+                 checkpoint_every=10):
+        """
+        Build the genetic relationship matrix of the samples of a BgenObject or PlinkObject in a single streaming pass,
+        as the mean over variants of the product of the standardised dosage of each pair of samples. Batches of
+        variants are standardised by their allele frequency, with missing dosage set to the mean, then accumulated as
+        a float32 matrix product, which numpy hands to BLAS syrk for the diagonal tiles and gemm otherwise.
+
+        The matrix can be split into tiles of sample pairs, each built in its own process or on its own node and
+        joined by assemble. The partial sums can be checkpointed to disk, so a build that is stopped resumes from the
+        last batch it saved. A checkpoint records the file, samples, number of variants, tile and batch size it was
+        built from, and is only resumed by a build of the same.
+
+        :param genetic_object: The file to build from. The samples of a BgenObject are those within its iid_index, so
+            slice it to build the matrix of a subset
+        :type genetic_object: pyGenicParser.BgenObject | pyGenicParser.PlinkObject
+
+        :param batch_size: The number of variants in each batch
+        :type batch_size: int
+
+        :param prefetch: The number of batches to read ahead of the accumulation
+        :type prefetch: int
+
+        :param workers: The number of background threads reading batches, defaults to prefetch
+        :type workers: int | None
+
+        :param samples: The indexes of the samples to keep after decoding, or None for all. For a PlinkObject this is
+            the only way to build the matrix of a subset
+        :type samples: list[int] | np.ndarray | None
+
+        :param checkpoint: The path to save the partial sums to, and to resume them from if it exists
+        :type checkpoint: Path | str | None
+
+        :param checkpoint_every: The number of batches between each save of the checkpoint
+        :type checkpoint_every: int
+        """
+        self.genetic_object = genetic_object
+        self.stats = genetic_object.stats
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.workers = workers
+        self.samples = None if samples is None else np.asarray(samples, dtype=np.int64)
+        self.checkpoint = None if checkpoint is None else Path(checkpoint)
+        self.checkpoint_every = checkpoint_every
+
+        # The samples of the file the matrix is built from, and the file and number of variants they are read from
+        if isinstance(genetic_object, BgenObject):
+            file_samples = np.arange(genetic_object._sample_number)[genetic_object.iid_index]
+            source, variant_number = genetic_object.file_path, genetic_object.sid_count
+        else:
+            file_samples = np.arange(genetic_object._sample_number())
+            source, variant_number = genetic_object.bed_file_path, genetic_object._bed_variant_number(len(file_samples))
+        file_samples = file_samples if self.samples is None else file_samples[self.samples]
+        self.sample_number = len(file_samples)
+
+        # What a checkpoint must have been built from to be resumed, the samples being held as a hash of their indexes
+        self._source = {"source": str(Path(source).absolute()), "variant_number": int(variant_number),
+                        "samples": blake2b(file_samples.astype("<i8").tobytes(), digest_size=16).hexdigest()}
+
+        # The number of variants that were not monomorphic or entirely missing, set by build
+        self.variant_count = 0
+
+    def __repr__(self):
+        return f"GRMBuilder iid -> {self.sample_number}"
+
+    def tiles(self, tile_count):
+        """
+        Split the sample pairs into the tiles on and above the diagonal of a tile_count by tile_count grid, as the
+        matrix is symmetric
+
+        :param tile_count: The number of groups of samples along each side of the matrix
+        :type tile_count: int
+
+        :return: The row start, row end, column start and column end of each tile
+        :rtype: list[(int, int, int, int)]
+        """
+        bounds = np.linspace(0, self.sample_number, tile_count + 1).astype(int)
+        return [(int(bounds[i]), int(bounds[i + 1]), int(bounds[j]), int(bounds[j + 1]))
+                for i in range(tile_count) for j in range(i, tile_count)]
+
+    def build(self, tile=None):
+        """
+        Build the relationship matrix, or a tile of it
+
+        :param tile: The row start, row end, column start and column end of the tile from tiles, or None for the whole
+            matrix
+        :type tile: (int, int, int, int) | None
+
+        :return: A float32 array of (rows, columns) of the relationship between each pair of samples of the tile
+        :rtype: np.ndarray
+        """
+        tile = (0, self.sample_number, 0, self.sample_number) if tile is None else tuple(int(t) for t in tile)
+        row_start, row_end, column_start, column_end = tile
+        diagonal = (row_start, row_end) == (column_start, column_end)
+
+        sums, variant_count, next_batch = self._resume(tile)
+        batches = self.genetic_object._dosage_batches(self.batch_size, next_batch, self.prefetch, self.workers)
+        for next_batch, dosage in enumerate(batches, next_batch + 1):
+            if self.samples is not None:
+                dosage = dosage[:, self.samples]
+
+            with self.stats.time("grm"):
+                standardised = kn.standardise_kernel(dosage)
+                rows = np.ascontiguousarray(standardised[:, row_start:row_end])
+                if diagonal:
+                    sums += rows.T @ rows
+                else:
+                    sums += rows.T @ np.ascontiguousarray(standardised[:, column_start:column_end])
+
+            variant_count += len(standardised)
+            self.stats.add("grm_variants", len(standardised))
+            if self.checkpoint is not None and next_batch % self.checkpoint_every == 0:
+                self._save(tile, sums, variant_count, next_batch)
+
+        if self.checkpoint is not None:
+            self._save(tile, sums, variant_count, next_batch)
+
+        self.variant_count = variant_count
+        return sums / np.float32(max(variant_count, 1))
+
+    @staticmethod
+    def assemble(tiles):
+        """
+        Join tiles built on and above the diagonal into the full symmetric matrix
+
+        :param tiles: The (row start, row end, column start, column end) and built array of every tile
+        :type tiles: list[((int, int, int, int), np.ndarray)]
+
+        :return: A float32 array of (iid, iid)
+        :rtype: np.ndarray
+        """
+        sample_number = max([max(tile[1], tile[3]) for tile, _ in tiles])
+        grm = np.zeros((sample_number, sample_number), dtype=np.float32)
+        for (row_start, row_end, column_start, column_end), values in tiles:
+            grm[row_start:row_end, column_start:column_end] = values
+            grm[column_start:column_end, row_start:row_end] = values.T
+        return grm
+
+    def _resume(self, tile):
+        """The sums, number of variants and next batch saved within the checkpoint, or new ones if there is none"""
+        if self.checkpoint is None or not self.checkpoint.exists():
+            return np.zeros((tile[1] - tile[0], tile[3] - tile[2]), dtype=np.float32), 0, 0
+
+        with np.load(self.checkpoint) as saved:
+            expected = dict(self._source, tile=tile, batch_size=self.batch_size)
+            found = {name: saved[name].tolist() if name in saved else None for name in expected}
+            found["tile"] = tuple(found["tile"]) if found["tile"] is not None else None
+            assert found == expected, ec.checkpoint_violation(self.checkpoint, found, expected)
+            return saved["sums"], int(saved["variant_count"]), int(saved["next_batch"])
+
+    def _save(self, tile, sums, variant_count, next_batch):
+        """Save the partial sums to a temporary file then move it over the checkpoint, so a save is never partial"""
+        temporary = Path(f"{self.checkpoint}.tmp")
+        with open(temporary, "wb") as checkpoint_file:
+            np.savez(checkpoint_file, sums=sums, variant_count=variant_count, next_batch=next_batch, tile=tile,
+                     batch_size=self.batch_size, **self._source)
+        os.replace(temporary, self.checkpoint)
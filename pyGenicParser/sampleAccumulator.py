@@ -0,0 +1,83 @@
+from . import errors_codes as ec
+
+import numpy as np
+
+
+class SampleAccumulator:
+    def __init__(self, sample_number):
+        """
+        Running per sample sums over variants, so sample level statistics can be computed in a single streaming pass
+        in memory proportional to the number of samples. Each block of variants is added with one vectorised operation
+        per sum, accumulated in float64, and accumulators of separate ranges of variants can be merged.
+
+        :param sample_number: The number of samples within every block of variants
+        :type sample_number: int
+        """
+        self.sample_number = sample_number
+        self.variant_number = 0
+        self.called = np.zeros(sample_number, dtype=np.int64)
+        self.heterozygous = np.zeros(sample_number, dtype=np.float64)
+        self.dosage_sum = np.zeros(sample_number, dtype=np.float64)
+        self.dosage_squared_sum = np.zeros(sample_number, dtype=np.float64)
+
+    def __repr__(self):
+        return f"SampleAccumulator iid:sid -> {self.sample_number}:{self.variant_number}"
+
+    def update(self, probs):
+        """
+        Add a block of variants to the running sums
+
+        :param probs: A float array of (variants, samples, 3) of P(AA), P(AB) and P(BB), where missing samples are NaN
+        :type probs: np.ndarray
+
+        :return: This accumulator
+        :rtype: SampleAccumulator
+        """
+        assert probs.shape[1] == self.sample_number, ec.sample_size_violation(self.sample_number, probs.shape[1])
+
+        present = ~np.isnan(probs).any(axis=2)
+        probs = np.where(present[..., None], probs, 0)
+        dosage = probs[..., 1] + 2 * probs[..., 2]
+
+        self.variant_number += len(probs)
+        self.called += present.sum(axis=0)
+        self.heterozygous += probs[..., 1].sum(axis=0, dtype=np.float64)
+        self.dosage_sum += dosage.sum(axis=0, dtype=np.float64)
+        self.dosage_squared_sum += np.einsum("ij,ij->j", dosage, dosage, dtype=np.float64)
+        return self
+
+    def merge(self, other):
+        """
+        Add the sums of an accumulator of a different range of variants for the same samples
+
+        :param other: The accumulator to merge into this one
+        :type other: SampleAccumulator
+
+        :return: This accumulator
+        :rtype: SampleAccumulator
+        """
+        assert other.sample_number == self.sample_number, ec.sample_size_violation(self.sample_number,
+                                                                                   other.sample_number)
+        self.variant_number += other.variant_number
+        self.called += other.called
+        self.heterozygous += other.heterozygous
+        self.dosage_sum += other.dosage_sum
+        self.dosage_squared_sum += other.dosage_squared_sum
+        return self
+
+    def summary(self):
+        """
+        The per sample statistics of the variants accumulated so far. Rates are over the variants called for each
+        sample, so are NaN for samples without any called variants.
+
+        :return: A dict of missing_rate, heterozygosity, the expected fraction of called variants that are
+            heterozygous, and mean_dosage and dosage_variance, of the dosage of the second allele, to a float64 array
+            of the value of each sample
+        :rtype: dict
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean_dosage = self.dosage_sum / self.called
+            return {"missing_rate": 1 - self.called / max(self.variant_number, 1),
+                    "heterozygosity": self.heterozygous / self.called,
+                    "mean_dosage": mean_dosage,
+                    "dosage_variance": self.dosage_squared_sum / self.called - mean_dosage ** 2}
@@ -0,0 +1,220 @@
+from .bgenCodecs import get_codec
+from .stats import ParserStats
+from . import errors_codes as ec
+from . import kernels as kn
+from . import misc as mc
+
+from pathlib import Path
+import numpy as np
+import struct
+import os
+
+# The magic, version, sample number, variant number, samples per chunk and compression flag of a store
+STORE_HEADER = struct.Struct("<4sIQQIB")
+STORE_MAGIC = b"SMGS"
+
+
+def write_sample_major(write_path, batches, sample_number, variant_number, chunk_samples=16, compression=1,
+                       stats=None):
+    """
+    Transpose variant major dosage into a sample major store, whose genotypes are the uint8 quantised dosage of
+    kernels.quantised_dosage_kernel. The store is a header, the file offset of each chunk of chunk_samples samples
+    followed by the end of the file, then each chunk holding the genotypes of its samples sample by sample, compressed
+    with the codec of a bgen compression flag.
+
+    The transpose is external so it runs in bounded memory. The first pass transposes each batch of variants and
+    appends the tile of each chunk of samples to a temporary file. The second pass gathers the tiles of each chunk
+    of samples across every batch. Memory is bounded by a batch of variants in the first pass, and by chunk_samples
+    genotypes of every variant in the second.
+
+    :param write_path: The path to write the store to
+    :type write_path: Path | str
+
+    :param batches: A generator of the float dosage of each batch of variants as an array of (variants, samples),
+        where missing is NaN
+    :type batches: Iterable
+
+    :param sample_number: The number of samples of each batch
+    :type sample_number: int
+
+    :param variant_number: The total number of variants across the batches
+    :type variant_number: int
+
+    :param chunk_samples: The number of samples of each chunk, which is decompressed as a whole to read any sample
+    :type chunk_samples: int
+
+    :param compression: 0 for uncompressed, which can be memory mapped, 1 for zlib, 2 for zstd
+    :type compression: int
+
+    :param stats: Times the transpose. A new one is created if not provided
+    :type stats: ParserStats | None
+
+    :return: Nothing, writes the file then stops
+    :rtype: None
+    """
+    stats = stats if stats is not None else ParserStats()
+    codec = get_codec(compression)
+    chunk_starts = range(0, sample_number, chunk_samples)
+
+    write_path = Path(write_path)
+    temporary = Path(f"{write_path}.tmp")
+    try:
+        # First pass, appending the (chunk samples, batch variants) tile of each chunk of every batch in turn
+        widths = []
+        with open(temporary, "wb") as runs:
+            for dosage in batches:
+                with stats.time("transpose"):
+                    codes = kn.quantise_dosage(dosage, np.empty(dosage.shape, dtype=np.uint8)).T
+                    for start in chunk_starts:
+                        runs.write(np.ascontiguousarray(codes[start:start + chunk_samples]).tobytes())
+                widths.append(len(dosage))
+        assert sum(widths) == variant_number, ec.column_length_violation()
+
+        # Second pass, gathering the tiles of each chunk across the batches, where the tiles of a chunk begin at
+        # start * width within each batch as every chunk before it holds chunk_samples samples
+        offsets = [STORE_HEADER.size + 8 * (len(chunk_starts) + 1)]
+        file_descriptor = mc.open_positional(temporary)
+        try:
+            with open(write_path, "wb") as store:
+                store.write(STORE_HEADER.pack(STORE_MAGIC, 1, sample_number, variant_number, chunk_samples,
+                                              compression))
+                store.seek(offsets[0])
+
+                for start in chunk_starts:
+                    rows = min(chunk_samples, sample_number - start)
+                    chunk = np.empty((rows, variant_number), dtype=np.uint8)
+
+                    column, batch_offset = 0, 0
+                    for width in widths:
+                        tile = mc.positional_read(file_descriptor, batch_offset + start * width, rows * width)
+                        chunk[:, column:column + width] = np.frombuffer(tile, dtype=np.uint8).reshape(rows, width)
+                        column += width
+                        batch_offset += sample_number * width
+
+                    with stats.time("transpose"):
+                        data = codec.compress(chunk.tobytes())
+                    store.write(data)
+                    offsets.append(offsets[-1] + len(data))
+
+                store.seek(STORE_HEADER.size)
+                store.write(np.array(offsets, dtype="<u8").tobytes())
+        finally:
+            os.close(file_descriptor)
+    finally:
+        if temporary.exists():
+            temporary.unlink()
+
+
+class SampleMajorStore:
+    def __init__(self, file_path, stats=None):
+        """
+        Read the genotypes of individuals from a store written by to_sample_major, where every genotype of a sample is
+        held contiguously. Reading a sample is a single positional read of its chunk, or of its own row if the store is
+        uncompressed, so reads can be made from many threads at once.
+
+        :param file_path: The path to the store
+        :type file_path: Path | str
+
+        :param stats: Records the reads and decompression. A new one is created if not provided
+        :type stats: ParserStats | None
+        """
+        self.file_path = Path(file_path)
+        self.stats = stats if stats is not None else ParserStats()
+
+        self._file_descriptor = mc.open_positional(self.file_path)
+        magic, _, self.sample_number, self.variant_number, self.chunk_samples, self.compression = \
+            STORE_HEADER.unpack(mc.positional_read(self._file_descriptor, 0, STORE_HEADER.size))
+        assert magic == STORE_MAGIC, ec.store_magic_violation(self.file_path, magic)
+
+        chunk_number = -(-self.sample_number // self.chunk_samples)
+        self._offsets = np.frombuffer(mc.positional_read(self._file_descriptor, STORE_HEADER.size,
+                                                         8 * (chunk_number + 1)), dtype="<u8").astype(np.int64)
+        self._codec = get_codec(self.compression)
+
+    def __repr__(self):
+        return f"SampleMajorStore iid:sid -> {self.sample_number}:{self.variant_number}"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def shape(self):
+        """The (iid, variants) shape of the genotypes"""
+        return self.sample_number, self.variant_number
+
+    def close(self):
+        """Close the store"""
+        os.close(self._file_descriptor)
+
+    def sample(self, index, dtype=np.float32):
+        """
+        Every genotype of one sample
+
+        :param index: The index of the sample
+        :type index: int
+
+        :param dtype: The float type to return the dosage as, or uint8 for the quantised dosage stored
+        :type dtype: type
+
+        :return: The dosage of each variant
+        :rtype: np.ndarray
+        """
+        return self.samples([index], dtype)[0]
+
+    def samples(self, indexes, dtype=np.float32):
+        """
+        Every genotype of many samples, reading each chunk holding them once
+
+        :param indexes: The indexes of the samples
+        :type indexes: list[int] | np.ndarray
+
+        :param dtype: The float type to return the dosage as, or uint8 for the quantised dosage stored
+        :type dtype: type
+
+        :return: An array of (samples, variants) of the dosage
+        :rtype: np.ndarray
+        """
+        indexes = np.asarray(indexes, dtype=np.int64)
+        assert np.all((indexes >= 0) & (indexes < self.sample_number)), ec.store_sample_violation(
+            self.sample_number, indexes)
+
+        codes = np.empty((len(indexes), self.variant_number), dtype=np.uint8)
+        if self.compression == 0:
+            for i, index in enumerate(indexes):
+                codes[i] = np.frombuffer(self._read(self._offsets[0] + index * self.variant_number,
+                                                    self.variant_number), dtype=np.uint8)
+        else:
+            chunks = indexes // self.chunk_samples
+            for chunk in np.unique(chunks):
+                codes[chunks == chunk] = self._read_chunk(chunk)[indexes[chunks == chunk] % self.chunk_samples]
+
+        return codes if np.dtype(dtype) == np.uint8 else kn.dequantise_dosage(codes, dtype)
+
+    def as_memmap(self):
+        """
+        The genotypes of an uncompressed store as a read only memory map
+
+        :return: A uint8 array of (iid, variants) of the quantised dosage
+        :rtype: np.memmap
+        """
+        assert self.compression == 0, ec.store_memmap_violation(self.file_path, self.compression)
+        return np.memmap(self.file_path, dtype=np.uint8, mode="r", offset=int(self._offsets[0]), shape=self.shape)
+
+    def _read_chunk(self, chunk):
+        """Read and decompress a chunk of samples as an array of (chunk samples, variants)"""
+        rows = min(self.chunk_samples, self.sample_number - chunk * self.chunk_samples)
+        data = self._read(self._offsets[chunk], self._offsets[chunk + 1] - self._offsets[chunk])
+        with self.stats.time("decompress"):
+            data = self._codec.decompress(data, rows * self.variant_number)
+        self.stats.add("bytes_decompressed", len(data))
+        return np.frombuffer(data, dtype=np.uint8).reshape(rows, self.variant_number)
+
+    def _read(self, start, size):
+        """Read size bytes of the store from start"""
+        with self.stats.time("read"):
+            data = mc.positional_read(self._file_descriptor, int(start), int(size))
+        self.stats.add("bytes_read", len(data))
+        return data
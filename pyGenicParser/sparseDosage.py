@@ -0,0 +1,191 @@
+from . import errors_codes as ec
+from . import kernels as kn
+
+import numpy as np
+
+
+class SparseDosage:
+    def __init__(self, shape, data, indices, indptr, missing_indices, missing_indptr):
+        """
+        The dosage of many variants held in compressed sparse column format, a column per variant and a row per
+        sample, so only the non zero dosages of rare variants are stored. Missing dosages are not stored as NaN values
+        but as a second set of sparse columns holding only their sample indexes, which toarray restores as NaN.
+
+        :param shape: The (iid, variants) shape of the dense dosage
+        :type shape: (int, int)
+
+        :param data: The float32 non zero dosages, column by column
+        :type data: np.ndarray
+
+        :param indices: The int32 sample index of each non zero dosage
+        :type indices: np.ndarray
+
+        :param indptr: The int64 start of each column within data and indices, followed by its total length
+        :type indptr: np.ndarray
+
+        :param missing_indices: The int32 sample index of each missing dosage, column by column
+        :type missing_indices: np.ndarray
+
+        :param missing_indptr: The int64 start of each column within missing_indices, followed by its total length
+        :type missing_indptr: np.ndarray
+        """
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.missing_indices = missing_indices
+        self.missing_indptr = missing_indptr
+
+        assert len(self.indptr) == self.shape[1] + 1, ec.column_length_violation()
+        assert len(self.missing_indptr) == self.shape[1] + 1, ec.column_length_violation()
+
+    def __repr__(self):
+        return f"SparseDosage iid:sid -> {self.shape[0]}:{self.shape[1]} nnz -> {self.nnz}"
+
+    def __len__(self):
+        return self.shape[1]
+
+    @property
+    def nnz(self):
+        """The number of non zero dosages stored"""
+        return len(self.data)
+
+    @property
+    def missing_count(self):
+        """The number of missing dosages"""
+        return len(self.missing_indices)
+
+    @classmethod
+    def from_columns(cls, columns, sample_number):
+        """
+        Construct from the sparse columns of each variant, as returned by kernels.sparse_dosage_kernel
+
+        :param columns: The sample indexes of the non zero dosages, their dosages, and the sample indexes of the missing
+            dosages of each variant
+        :type columns: list[(np.ndarray, np.ndarray, np.ndarray)]
+
+        :param sample_number: The number of samples of each variant
+        :type sample_number: int
+
+        :return: The dosage of the variants
+        :rtype: SparseDosage
+        """
+        def concatenate(arrays, dtype):
+            return np.concatenate(arrays).astype(dtype, copy=False) if arrays else np.empty(0, dtype=dtype)
+
+        def pointers(arrays):
+            return np.concatenate([[0], np.cumsum([len(array) for array in arrays], dtype=np.int64)]).astype(np.int64)
+
+        indices = [column[0] for column in columns]
+        missing = [column[2] for column in columns]
+        return cls((sample_number, len(columns)), concatenate([column[1] for column in columns], np.float32),
+                   concatenate(indices, np.int32), pointers(indices), concatenate(missing, np.int32),
+                   pointers(missing))
+
+    @classmethod
+    def from_dense(cls, dosage):
+        """
+        Construct from a dense float array of (iid, variants), where NaN is missing
+
+        :param dosage: The dense dosage
+        :type dosage: np.ndarray
+
+        :return: The dosage of the variants
+        :rtype: SparseDosage
+        """
+        return cls.from_columns([kn.sparse_column(column) for column in np.asarray(dosage, dtype=np.float32).T],
+                                dosage.shape[0])
+
+    @classmethod
+    def concatenate(cls, batches):
+        """
+        Join the variants of many batches of the same samples, in order
+
+        :param batches: The batches to join, of at least one batch
+        :type batches: list[SparseDosage]
+
+        :return: The dosage of every variant
+        :rtype: SparseDosage
+        """
+        sample_number = batches[0].shape[0]
+        for batch in batches[1:]:
+            assert batch.shape[0] == sample_number, ec.sample_size_violation(sample_number, batch.shape[0])
+
+        def pointers(name, values):
+            offsets = np.cumsum([0] + [len(getattr(batch, values)) for batch in batches[:-1]], dtype=np.int64)
+            return np.concatenate([[0]] + [getattr(batch, name)[1:] + offset
+                                           for batch, offset in zip(batches, offsets)]).astype(np.int64)
+
+        return cls((sample_number, sum([batch.shape[1] for batch in batches])),
+                   np.concatenate([batch.data for batch in batches]),
+                   np.concatenate([batch.indices for batch in batches]), pointers("indptr", "indices"),
+                   np.concatenate([batch.missing_indices for batch in batches]),
+                   pointers("missing_indptr", "missing_indices"))
+
+    def select(self, index):
+        """
+        The variants selected by a slice or an array of indexes, such as sid_index
+
+        :param index: The variants to select
+        :type index: slice | np.ndarray | list
+
+        :return: The dosage of the selected variants
+        :rtype: SparseDosage
+        """
+        columns = np.arange(self.shape[1])[index]
+        positions, indptr = self._gather(self.indptr, columns)
+        missing_positions, missing_indptr = self._gather(self.missing_indptr, columns)
+        return SparseDosage((self.shape[0], len(columns)), self.data[positions], self.indices[positions], indptr,
+                            self.missing_indices[missing_positions], missing_indptr)
+
+    @staticmethod
+    def _gather(indptr, columns):
+        """The positions of the stored values of each column in turn, and the pointers of these columns"""
+        starts, lengths = indptr[columns], indptr[columns + 1] - indptr[columns]
+        new_indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        positions = np.arange(new_indptr[-1], dtype=np.int64) + np.repeat(starts - new_indptr[:-1], lengths)
+        return positions, new_indptr
+
+    def column(self, index):
+        """
+        The dense dosage of one variant
+
+        :param index: The index of the variant
+        :type index: int
+
+        :return: The float32 dosage of each sample, where missing is NaN
+        :rtype: np.ndarray
+        """
+        dosage = np.zeros(self.shape[0], dtype=np.float32)
+        start, end = self.indptr[index], self.indptr[index + 1]
+        dosage[self.indices[start:end]] = self.data[start:end]
+        dosage[self.missing_indices[self.missing_indptr[index]:self.missing_indptr[index + 1]]] = np.nan
+        return dosage
+
+    def toarray(self):
+        """
+        The dense dosage
+
+        :return: A float32 array of (iid, variants), where missing is NaN
+        :rtype: np.ndarray
+        """
+        dosage = np.zeros(self.shape, dtype=np.float32)
+        dosage[self.indices, np.repeat(np.arange(self.shape[1]), np.diff(self.indptr))] = self.data
+        dosage[self.missing_indices, np.repeat(np.arange(self.shape[1]), np.diff(self.missing_indptr))] = np.nan
+        return dosage
+
+    def to_scipy(self):
+        """
+        The non zero dosages as a scipy.sparse.csc_matrix, which has no notion of missing so use missing_indices
+        alongside it
+
+        :return: The (iid, variants) matrix
+        :rtype: scipy.sparse.csc_matrix
+        """
+        # scipy is an optional dependency, so it is only imported when a conversion is requested
+        try:
+            from scipy.sparse import csc_matrix
+        except ImportError:
+            raise ImportError(ec.scipy_missing())
+
+        return csc_matrix((self.data, self.indices, self.indptr), shape=self.shape)
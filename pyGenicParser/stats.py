@@ -0,0 +1,115 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+from threading import Lock
+
+
+class ParserStats:
+    def __init__(self, callback=None):
+        """
+        Records how long each stage of parsing takes alongside counters of the work done, so slow extractions can be
+        attributed to queries, reads, decompression or decoding. Timing a stage costs two calls to perf_counter and a
+        lock, so it is cheap enough to always be enabled.
+
+        Stages timed by the parsers are sql, read, decompress and decode, and the counters are sql_rows, bytes_read,
+        bytes_decompressed and blocks_decoded, alongside cache_hits of each reuse of a variant table or of sample
+        identifiers loaded by an earlier call. BgenObject without a .bgi also times scan and index, counting
+        variants_scanned and index_rows, variant_qc times qc, polygenic_score times score, counting score_variants,
+        score_mismatched and score_duplicates, GRMBuilder times grm, counting grm_variants, to_sample_major times
+        transpose, to_plink counts the multi-allelic variants it skips as variants_skipped, and VCFObject times parse
+        and write.
+
+        :param callback: Called with a dict of operation, count, total and elapsed seconds whenever a parser reports its
+            progress through a long running operation. If None, progress is only recorded
+        :type callback: Callable | None
+        """
+        self.callback = callback
+        self.timers = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.progress_log = {}
+        self._created = perf_counter()
+
+        # Prefetching and concurrent readers update stats from many threads
+        self._lock = Lock()
+
+    def __repr__(self):
+        timers = ", ".join([f"{stage}: {seconds:.3f}s" for stage, seconds in self.timers.items()])
+        counters = ", ".join([f"{name}: {value}" for name, value in self.counters.items()])
+        return f"ParserStats({timers}; {counters})"
+
+    @contextmanager
+    def time(self, stage):
+        """
+        Time the code within the context as a stage, adding to any time already recorded for it
+
+        :param stage: The name of the stage
+        :type stage: str
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            with self._lock:
+                self.timers[stage] += elapsed
+
+    def add(self, counter, value=1):
+        """
+        Add a value to a counter
+
+        :param counter: The name of the counter
+        :type counter: str
+
+        :param value: The value to add
+        :type value: int
+        """
+        with self._lock:
+            self.counters[counter] += value
+
+    def progress(self, operation, count, total=None):
+        """
+        Record progress through a long running operation, and pass it on to the callback if one was set
+
+        :param operation: The name of the operation, for example Extracted
+        :type operation: str
+
+        :param count: The number of items processed so far
+        :type count: int
+
+        :param total: The total number of items, if known
+        :type total: int | None
+        """
+        update = {"operation": operation, "count": count, "total": total,
+                  "elapsed": perf_counter() - self._created}
+        with self._lock:
+            self.progress_log[operation] = update
+
+        if self.callback:
+            self.callback(update)
+
+    def summary(self):
+        """
+        The current timers and counters
+
+        :return: A dict of timers in seconds, counters, and the latest progress of each operation
+        :rtype: dict
+        """
+        with self._lock:
+            return {"timers": dict(self.timers), "counters": dict(self.counters),
+                    "progress": dict(self.progress_log)}
+
+    def reset(self):
+        """Clear all timers, counters and progress"""
+        with self._lock:
+            self.timers.clear()
+            self.counters.clear()
+            self.progress_log.clear()
+            self._created = perf_counter()
+
+
+def print_progress(update):
+    """A progress callback for ParserStats that prints each update as a line, in the style of the old progress prints"""
+    if update["total"] is None:
+        print(f"{update['operation']} {update['count']} lines")
+    else:
+        print(f"{update['operation']} {update['count']} of {update['total']} lines")
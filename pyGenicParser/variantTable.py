@@ -0,0 +1,313 @@
+from . import errors_codes as ec
+
+from hashlib import blake2b
+from threading import Lock
+from pathlib import Path
+import numpy as np
+import sqlite3
+import json
+
+
+class VariantTable:
+    # The columns of the Variant table of a .bgi, in the order create_bgi writes them
+    COLUMNS = ["file_start_position", "size_in_bytes", "chromosome", "position", "rsid", "allele1", "allele2"]
+
+    # The columns of the Variant table of a .bim.bgi, in the order create_bim_bgi writes them
+    BIM_COLUMNS = ["bed_start_position", "bim_start_position", "rsid", "chromosome", "morgan_pos", "position",
+                   "allele1", "allele2"]
+
+    # The columns of the table returned by variant_qc, the statistics being those of kn.variant_qc_kernel
+    QC_STATISTICS = ["a2_frequency", "maf", "call_rate", "hwe_p", "info", "r2"]
+    QC_COLUMNS = ["chromosome", "position", "rsid", "allele1", "allele2"] + QC_STATISTICS
+
+    _INTEGER_COLUMNS = ["file_start_position", "size_in_bytes", "position", "bed_start_position", "bim_start_position"]
+    _FLOAT_COLUMNS = ["morgan_pos"] + QC_STATISTICS
+
+    # The magic number of a sidecar, and the alignment of each array within it so they can be viewed in place
+    _SIDECAR_MAGIC = b"GPVTI001"
+    _ALIGNMENT = 8
+
+    def __init__(self, columns, length=None, heaps=None, rsid_hashes=None):
+        """
+        An in memory, columnar, equivalent of the Variant table of a .bgi. Each column is a numpy array in file order,
+        so that variants can be looked up without an sqlite database.
+
+        Tables loaded from a sidecar keep their string columns as a heap of bytes that is only decoded for the rows
+        requested, and look up rsids through a sorted array of their hashes. Heaps are decoded under a lock held by the
+        table, so one table can be read from many threads at once.
+
+        :param columns: A dict of each column name to a list or array of its values
+        :type columns: dict
+
+        :param length: The number of variants, only required if columns is empty
+        :type length: int | None
+
+        :param heaps: A dict of each string column not within columns to its (offsets, heap) of bytes
+        :type heaps: dict | None
+
+        :param rsid_hashes: The sorted hashes of each rsid and the index of the variant of each hash
+        :type rsid_hashes: (np.ndarray, np.ndarray) | None
+        """
+        self.columns = {name: self._column_array(name, values) for name, values in columns.items()}
+        self._heaps = heaps if heaps is not None else {}
+        self._heap_lock = Lock()
+        self._rsid_hashes = rsid_hashes
+        self._length = length if length is not None else len(next(iter(self.columns.values())))
+
+        assert all([len(column) == self._length for column in self.columns.values()]), ec.column_length_violation()
+
+    def __repr__(self):
+        return f"VariantTable -> {len(self)} variants"
+
+    def __len__(self):
+        return self._length
+
+    @classmethod
+    def _column_array(cls, name, values):
+        """Columns of positions are stored as int64, morgan positions as float64 and everything else as objects"""
+        if name in cls._INTEGER_COLUMNS:
+            return np.asarray(values, dtype=np.int64)
+        elif name in cls._FLOAT_COLUMNS:
+            return np.asarray(values, dtype=np.float64)
+        else:
+            return np.asarray(values, dtype=object)
+
+    @classmethod
+    def from_rows(cls, rows, names=None):
+        """
+        Construct the table from rows of values in the order of names
+
+        :param rows: The rows of each variant
+        :type rows: list
+
+        :param names: The name of each column, defaults to COLUMNS
+        :type names: list[str] | None
+
+        :return: The table
+        :rtype: VariantTable
+        """
+        names = cls.COLUMNS if names is None else names
+        if len(rows) == 0:
+            return cls({name: [] for name in names})
+        return cls({name: column for name, column in zip(names, zip(*rows))})
+
+    @classmethod
+    def from_variant_qc(cls, batches):
+        """
+        Construct a table of QC_COLUMNS from batches of variants and their statistics
+
+        :param batches: An iterable of (variants, statistics) where variants is an array of Variant and statistics the
+            dict of kn.variant_qc_kernel
+        :type batches: Iterable
+
+        :return: The table
+        :rtype: VariantTable
+        """
+        rows, statistics = [], {name: [] for name in cls.QC_STATISTICS}
+        for variants, batch_statistics in batches:
+            rows += [[v.chromosome, v.bp_position, v.snp_id, v.a1, v.a2] for v in variants]
+            for name in cls.QC_STATISTICS:
+                statistics[name].append(batch_statistics[name])
+
+        table = cls.from_rows(rows, cls.QC_COLUMNS[:5])
+        for name, values in statistics.items():
+            table.columns[name] = cls._column_array(name, np.concatenate(values) if values else [])
+        return table
+
+    @property
+    def names(self):
+        """The names of all the columns of the table"""
+        with self._heap_lock:
+            return list(self.columns.keys()) + list(self._heaps.keys())
+
+    def column(self, name, indexes=None):
+        """
+        A column of the table, or only the values at indexes. String columns of a sidecar are decoded in full the first
+        time the whole column is requested, and otherwise only at indexes.
+
+        :param name: The name of the column
+        :type name: str
+
+        :param indexes: The indexes of the variants to return, or None for all variants
+        :type indexes: np.ndarray | None
+
+        :return: The values
+        :rtype: np.ndarray
+        """
+        # The column is decoded and its heap removed as one step, so other threads see either the heap or the column
+        with self._heap_lock:
+            if name not in self.columns and indexes is None:
+                offsets, heap = self._heaps[name]
+                self.columns[name] = self._column_array(name, bytes(heap).decode("utf-8").split("\n")[:-1])
+                del self._heaps[name]
+
+            column = self.columns.get(name)
+            offsets, heap = self._heaps[name] if column is None else (None, None)
+
+        if column is not None:
+            return column if indexes is None else column[indexes]
+
+        return np.array([bytes(heap[offsets[i]:offsets[i + 1] - 1]).decode("utf-8") for i in indexes], dtype=object)
+
+    def rows(self, columns, indexes=None):
+        """
+        Fetch columns of the table as rows, in the same form as fetchall of an sqlite cursor
+
+        :param columns: The names of the columns to return within each row
+        :type columns: list[str]
+
+        :param indexes: The indexes of the variants to return, or None for all variants
+        :type indexes: np.ndarray | None
+
+        :return: A list of tuples of each variant's values
+        :rtype: list
+        """
+        return list(zip(*[self.column(name, indexes).tolist() for name in columns]))
+
+    def rsid_indexes(self, snp_names):
+        """
+        The indexes of the variants whose rsid is within snp_names, in file order as would be returned by sqlite
+
+        :param snp_names: The rsids to look up
+        :type snp_names: list | np.ndarray
+
+        :return: The indexes
+        :rtype: np.ndarray
+        """
+        if self._rsid_hashes is None:
+            return np.flatnonzero(np.isin(self.column("rsid"), np.asarray(snp_names, dtype=object)))
+
+        # Find every variant whose rsid hash matches, then check the rsids themselves in case of a collision
+        hashes, order = self._rsid_hashes
+        queries = np.unique(self.rsid_hash(snp_names))
+        left, right = np.searchsorted(hashes, queries, "left"), np.searchsorted(hashes, queries, "right")
+        candidates = np.sort(np.concatenate([order[l:r] for l, r in zip(left, right)] + [np.array([], np.int64)]))
+        return candidates[np.isin(self.column("rsid", candidates), np.asarray(snp_names, dtype=object))]
+
+    @staticmethod
+    def rsid_hash(snp_names):
+        """
+        A stable 64 bit hash of each rsid, as the built in hash of str differs between interpreters
+
+        :param snp_names: The rsids
+        :type snp_names: list | np.ndarray
+
+        :return: The hashes
+        :rtype: np.ndarray
+        """
+        return np.array([int.from_bytes(blake2b(str(snp).encode("utf-8"), digest_size=8).digest(), "little")
+                         for snp in snp_names], dtype=np.uint64)
+
+    def to_bgi(self, write_path):
+        """
+        Write the table as a .bgi, an sqlite database with the same Variant table as create_bgi makes
+
+        :param write_path: The path to write the .bgi to
+        :type write_path: Path | str
+
+        :return: Nothing, writes the file then stops
+        :rtype: None
+        """
+        connection = sqlite3.connect(str(Path(write_path)))
+        c = connection.cursor()
+
+        # Create our core table that mimics Variant bgi from bgenix
+        c.execute('''
+             CREATE TABLE Variant (
+             file_start_position INTEGER,
+             size_in_bytes INTEGER,
+             chromosome INTEGER,
+             position INTEGER,
+             rsid TEXT,
+             allele1 TEXT,
+             allele2 TEXT
+               )''')
+        c.executemany(f"INSERT INTO Variant VALUES ({', '.join(['?'] * len(self.COLUMNS))})",
+                      self.rows(self.COLUMNS))
+
+        # Commit the file
+        connection.commit()
+        connection.close()
+
+    def to_sidecar(self, write_path):
+        """
+        Write the table as a sidecar, a single binary file that can be memory mapped. It holds a json header describing
+        where each array starts, followed by the integer and float columns as arrays, each string column as a heap of
+        newline terminated utf-8 strings with the offset of each string, and the sorted hashes of the rsids.
+
+        :param write_path: The path to write the sidecar to
+        :type write_path: Path | str
+
+        :return: Nothing, writes the file then stops
+        :rtype: None
+        """
+        arrays, header = [], {"length": len(self), "columns": {}}
+        for name in self.names:
+            values = self.column(name)
+            if values.dtype == object:
+                encoded = [f"{value}\n".encode("utf-8") for value in values]
+                offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+                np.cumsum([len(value) for value in encoded], out=offsets[1:])
+                header["columns"][name] = {"kind": "str", "arrays": [len(arrays), len(arrays) + 1]}
+                arrays += [offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)]
+            else:
+                header["columns"][name] = {"kind": values.dtype.name, "arrays": [len(arrays)]}
+                arrays.append(values)
+
+        hashes = self.rsid_hash(self.column("rsid"))
+        order = np.argsort(hashes, kind="stable")
+        header["rsid_hash"] = [len(arrays), len(arrays) + 1]
+        arrays += [hashes[order], order.astype(np.int64)]
+
+        # Arrays are written after the header at aligned offsets from the end of the header, which the header records
+        # as (offset, dtype, length)
+        header["arrays"], position = [], 0
+        for array in arrays:
+            header["arrays"].append([position, array.dtype.str, len(array)])
+            position = self._aligned(position + array.nbytes)
+
+        encoded_header = json.dumps(header).encode("utf-8")
+        data_start = self._aligned(len(self._SIDECAR_MAGIC) + 8 + len(encoded_header))
+
+        with open(write_path, "wb") as sidecar:
+            sidecar.write(self._SIDECAR_MAGIC + np.uint64(len(encoded_header)).tobytes() + encoded_header)
+            for (start, _, _), array in zip(header["arrays"], arrays):
+                sidecar.write(b"\0" * (data_start + start - sidecar.tell()))
+                sidecar.write(np.ascontiguousarray(array).tobytes())
+
+    @classmethod
+    def from_sidecar(cls, sidecar_path):
+        """
+        Open a sidecar written by to_sidecar. The file is memory mapped, so opening it only reads the header and the
+        arrays are paged in as they are used.
+
+        :param sidecar_path: The path to the sidecar
+        :type sidecar_path: Path | str
+
+        :return: The table
+        :rtype: VariantTable
+        """
+        mapped = np.memmap(sidecar_path, dtype=np.uint8, mode="r")
+        magic_size = len(cls._SIDECAR_MAGIC)
+        assert bytes(mapped[:magic_size]) == cls._SIDECAR_MAGIC, ec.sidecar_magic_violation(sidecar_path)
+
+        header_size = int(mapped[magic_size:magic_size + 8].view(np.uint64)[0])
+        header = json.loads(bytes(mapped[magic_size + 8:magic_size + 8 + header_size]).decode("utf-8"))
+        data_start = cls._aligned(magic_size + 8 + header_size)
+        arrays = [mapped[data_start + start:data_start + start + np.dtype(dtype).itemsize * length].view(dtype)
+                  for start, dtype, length in header["arrays"]]
+
+        columns, heaps = {}, {}
+        for name, column in header["columns"].items():
+            if column["kind"] == "str":
+                heaps[name] = tuple(arrays[index] for index in column["arrays"])
+            else:
+                columns[name] = arrays[column["arrays"][0]]
+
+        hashes, order = [arrays[index] for index in header["rsid_hash"]]
+        return cls(columns, header["length"], heaps, (hashes, order))
+
+    @staticmethod
+    def _aligned(position):
+        """Round a position up to the next multiple of the alignment"""
+        return -(-position // VariantTable._ALIGNMENT) * VariantTable._ALIGNMENT
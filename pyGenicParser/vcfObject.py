@@ -1,12 +1,22 @@
-from miscSupports import validate_path, open_setter, decode_line, flatten, terminal_time
+from miscSupports import validate_path, open_setter, decode_line, flatten
+from .stats import ParserStats
 from pathlib import Path
 import numpy as np
 import gzip
 
 
 class VCFObject:
-    def __init__(self, path):
+    def __init__(self, path, stats=None):
+        """
+
+        :param path: The path to the vcf, which may be gzipped
+        :type path: Path | str
 
+        :param stats: Records per stage timers, counters, and the progress of covert_to_summary. Pass a ParserStats with
+            a callback, such as stats.print_progress, to be updated on progress. A new one is created if not provided
+        :type stats: ParserStats | None
+        """
+        self.stats = stats if stats is not None else ParserStats()
         self._path = validate_path(path)
         self._zipped = (self._path.suffix == ".gz")
 
@@ -43,7 +53,8 @@ class VCFObject:
 
         with open_setter(self._path)(self._path) as file:
 
-            for line_byte in file:
+            # Read via readline, as text files cannot tell their position whilst being iterated
+            for line_byte in iter(file.readline, b"" if self._zipped else ""):
 
                 # Decode line
                 line = decode_line(line_byte, self._zipped, "\t")
@@ -128,41 +139,49 @@ class VCFObject:
             for count_index, line_byte in enumerate(file):
 
                 if count_index % 100000 == 0:
-                    print(f"Extracted {count_index} lines")
+                    self.stats.progress("Extracted", count_index)
 
-                # Decode line
-                line = decode_line(line_byte, self._zipped, "\t")
+                with self.stats.time("parse"):
+                    out_rows.append(self._parse_line(line_byte, info, log_p_convert))
+
+            self.stats.progress("Extracted", len(out_rows), len(out_rows))
+
+        with self.stats.time("write"):
+            self._write_summary(write_directory, write_name, out_rows)
 
-                row = line[:7] + ["NA" for _ in range(len(self._info_dict.keys()))] + \
-                    ["NA" for _ in range(len(self._format_dict.keys()) * self._format_length)]
+    def _parse_line(self, line_byte, info, log_p_convert):
+        """Parse a line of the vcf into a row of the summary"""
+        # Decode line
+        line = decode_line(line_byte, self._zipped, "\t")
 
-                if ("INFO" in self.data_headers) and info:
+        row = line[:7] + ["NA" for _ in range(len(self._info_dict.keys()))] + \
+            ["NA" for _ in range(len(self._format_dict.keys()) * self._format_length)]
 
-                    # Extract the info parameters
-                    parameters = line[self._data_dict["INFO"]].split(";")
+        if ("INFO" in self.data_headers) and info:
 
-                    for para in parameters:
-                        key, value = para.split("=")
-                        row[self.header_dict[f"{key}_info"]] = value
+            # Extract the info parameters
+            parameters = line[self._data_dict["INFO"]].split(";")
 
-                if "FORMAT" in self.data_headers:
-                    parameter_names = line[self._data_dict["FORMAT"]].split(":")
+            for para in parameters:
+                key, value = para.split("=")
+                row[self.header_dict[f"{key}_info"]] = value
 
-                    for index, i in enumerate(range(self._data_dict["FORMAT"] + 1, len(line))):
-                        parameter_values = line[i].replace("\n", "").split(":")
+        if "FORMAT" in self.data_headers:
+            parameter_names = line[self._data_dict["FORMAT"]].split(":")
 
-                        for name, value in zip(parameter_names, parameter_values):
-                            header_name = f"{name}_format_{index}"
+            for index, i in enumerate(range(self._data_dict["FORMAT"] + 1, len(line))):
+                parameter_values = line[i].replace("\n", "").split(":")
 
-                            # If p values are stored as log's, convert them if requested
-                            if log_p_convert and (header_name == log_p_convert):
-                                value = str(10 ** -float(value))
+                for name, value in zip(parameter_names, parameter_values):
+                    header_name = f"{name}_format_{index}"
 
-                            row[self.header_dict[header_name]] = value
+                    # If p values are stored as log's, convert them if requested
+                    if log_p_convert and (header_name == log_p_convert):
+                        value = str(10 ** -float(value))
 
-                out_rows.append(np.array(row)[np.array(list(self.write_headers.values()))].tolist())
+                    row[self.header_dict[header_name]] = value
 
-        self._write_summary(write_directory, write_name, out_rows)
+        return np.array(row)[np.array(list(self.write_headers.values()))].tolist()
 
     def _write_summary(self, write_directory, write_name, out_rows):
         with gzip.open(Path(write_directory, f"{write_name}.tsv.gz"), "wb") as f:
@@ -172,9 +191,9 @@ class VCFObject:
 
             for index, row in enumerate(out_rows):
                 if index % 100000 == 0:
-                    print(f"Written {index} lines")
+                    self.stats.progress("Written", index, len(out_rows))
 
                 f.write("\t".join([value for value in row]).encode("utf-8"))
                 f.write("\n".encode("utf-8"))
 
-        print(f"Finished writing {len(out_rows)} lines to gzipped csv at {terminal_time()}")
+        self.stats.progress("Written", len(out_rows), len(out_rows))
@@ -25,9 +25,14 @@ PYTHON_REQUIRES = ">=3.7"
 
 INSTALL_REQUIRES = [
     'numpy',
-    'zstd',
 ]
 
+# zstd is only required to read bgen files compressed via z-standard, and fast for the faster decompression backends
+EXTRAS_REQUIRE = {
+    'zstd': ['zstd'],
+    'fast': ['zstandard', 'isal', 'deflate'],
+}
+
 CLASSIFIERS = [
     'Programming Language :: Python :: 3.7',
     'License :: OSI Approved :: MIT License',
@@ -56,6 +61,7 @@ if __name__ == "__main__":
         download_url=DOWNLOAD_URL,
         python_requires=PYTHON_REQUIRES,
         install_requires=INSTALL_REQUIRES,
+        extras_require=EXTRAS_REQUIRE,
         include_package_data=True,
         packages=find_packages(),
         classifiers=CLASSIFIERS